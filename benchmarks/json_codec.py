@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# SPDX-FileCopyrightText: 2014-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+'''
+Compares the speed of the json codecs of frestq (see frestq/utils.py)
+encoding and decoding typical payloads: a small RESTQP message and a large
+task output_data, like the results of a mixnet. It also compares json with
+msgpack, the binary wire format of the messages exchanged with the peers that
+support it.
+
+Usage: python benchmarks/json_codec.py [--number N] [--json-datetimes MODE]
+'''
+
+import os
+import sys
+import random
+import argparse
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+from frestq.utils import JSON_CODECS, set_json_datetimes, encode_body,\
+    decode_body, msgpack, JSON_MIMETYPE, MSGPACK_MIMETYPE
+
+
+def message_payload():
+    now = datetime.utcnow()
+    return {
+        "action": "frestq.update_task",
+        "queue_name": "internal.frestq",
+        "sender_url": "https://authority1.example.com:5000/api/queues",
+        "message_id": "0c4d8e34-1e2f-4d0b-9a4b-6b0e27c1f1a5",
+        "task_id": "5e8a1c3b-0d4f-4a5e-8f6b-7c9d0e1f2a3b",
+        "data": {"output_data": {"status": "ok", "votes": 120},
+                 "status": "finished"},
+        "pingback_date": now,
+        "expiration_date": now + timedelta(hours=1),
+        "info_text": None,
+    }
+
+
+def mixnet_output(num_ciphertexts):
+    rand = random.Random(0)
+    def big_number():
+        return str(rand.getrandbits(2048))
+    return {
+        "created": datetime.utcnow(),
+        "proofs": [
+            {"commitment": big_number(), "response": big_number(),
+             "challenge": big_number()}
+            for i in range(num_ciphertexts // 10)
+        ],
+        "ciphertexts": [
+            {"alpha": big_number(), "beta": big_number()}
+            for i in range(num_ciphertexts)
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20,
+                        help="times to repeat each operation")
+    parser.add_argument("--ciphertexts", type=int, default=5000,
+                        help="ciphertexts in the large payload")
+    parser.add_argument("--json-datetimes", default="strings",
+                        choices=["strings", "tagged"],
+                        help="how datetimes are encoded in json")
+    args = parser.parse_args()
+    set_json_datetimes(args.json_datetimes)
+
+    payloads = [
+        ("message", message_payload(), args.number * 1000),
+        ("output_data", mixnet_output(args.ciphertexts), args.number),
+    ]
+    if len(JSON_CODECS) < 2:
+        print("only the json codec is available, install orjson to compare")
+
+    for name, payload, number in payloads:
+        results = dict()
+        for codec_name, codec_class in sorted(JSON_CODECS.items()):
+            codec = codec_class()
+            data = codec.dumps(payload)
+            assert JSON_CODECS['json']().loads(data) == codec.loads(data)
+            results[codec_name] = (
+                timeit.timeit(lambda: codec.dumps(payload), number=number),
+                timeit.timeit(lambda: codec.loads(data), number=number))
+            print("%-12s %-7s %7d bytes  dumps %9.3f ms  loads %9.3f ms" % (
+                name, codec_name, len(data),
+                1000 * results[codec_name][0] / number,
+                1000 * results[codec_name][1] / number))
+
+        if 'orjson' in results:
+            print("%-12s speedup dumps x%.1f, loads x%.1f" % (
+                name,
+                results['json'][0] / results['orjson'][0],
+                results['json'][1] / results['orjson'][1]))
+
+        if msgpack is None:
+            continue
+        json_data = encode_body(payload, JSON_MIMETYPE)[0].encode('utf-8')
+        data, mimetype = encode_body(payload, MSGPACK_MIMETYPE)
+        assert mimetype == MSGPACK_MIMETYPE
+        assert decode_body(data, mimetype) == decode_body(json_data)
+        dumps_time = timeit.timeit(
+            lambda: encode_body(payload, MSGPACK_MIMETYPE), number=number)
+        loads_time = timeit.timeit(
+            lambda: decode_body(data, MSGPACK_MIMETYPE), number=number)
+        print("%-12s %-7s %7d bytes  dumps %9.3f ms  loads %9.3f ms" % (
+            name, 'msgpack', len(data), 1000 * dumps_time / number,
+            1000 * loads_time / number))
+        print("%-12s msgpack size x%.2f of json" % (
+            name, len(data) / len(json_data)))
+
+
+if __name__ == "__main__":
+    main()
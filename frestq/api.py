@@ -6,14 +6,18 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import json
+import time
 import logging
 from datetime import datetime
 
+import OpenSSL
 from flask import Blueprint, request, make_response
 from flask import current_app
 
 from .action_handlers import ActionHandlers
-from .utils import loads, dumps
+from .metrics import Metrics, HANDLER_DURATION, MESSAGES_RECEIVED
+from .utils import loads, dumps, encode_body, wire_formats, msgpack,\
+    cert_fingerprint, MSGPACK_MIMETYPE
 
 api = Blueprint('api', __name__)
 
@@ -26,6 +30,31 @@ def error(status, message=""):
     return make_response(data, status)
 
 
+@api.after_request
+def accept_post(response):
+    '''
+    Announces the wire formats in which we accept messages, so that the
+    senders that support msgpack can use it, and if we have a blob store, so
+    that the senders can send references to their blobs
+    '''
+    from .blobs import BlobStore
+    if request.method == 'POST':
+        response.headers['Accept-Post'] = ", ".join(wire_formats())
+        if BlobStore.enabled():
+            response.headers['X-Frestq-Features'] = 'blobs'
+    return response
+
+
+def check_wire_format():
+    '''
+    Returns an error response if the body of the request is in a wire format
+    that can't be decoded, or None
+    '''
+    if request.mimetype == MSGPACK_MIMETYPE and msgpack is None:
+        return error(415, "msgpack is not supported")
+    return None
+
+
 def call_action_handler(msg_id, queue_name):
     '''
     Calls asynchronously to the action handler
@@ -38,28 +67,62 @@ def call_action_handler(msg_id, queue_name):
     action_handler = ActionHandlers.get_action_handler(msg.action, queue_name)
     if not action_handler:
         raise Exception('action handler not found')
-    if action_handler.get('is_task', False):
-        post_task(msg, action_handler)
-    else:
-        action_handler["handler_func"](msg)
+    start_time = time.monotonic()
+    try:
+        if action_handler.get('is_task', False):
+            post_task(msg, action_handler)
+        else:
+            action_handler["handler_func"](msg)
+    finally:
+        HANDLER_DURATION.observe(time.monotonic() - start_time,
+                                 queue=queue_name, action=msg.action)
 
 
-@api.route('/queues/<queue_name>/', methods=['POST'])
-def post_message(queue_name):
+class MessageError(Exception):
     '''
-    Post a message in a queue.
+    Raised when a received message is not valid
+    '''
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
 
-    For input and out format, refer to RESTQP.md
+
+def get_sender_ssl_cert():
     '''
-    # 1. register message in the db model
+    Returns the certificate of the sender of the current request, if any
+    '''
+    sender_ssl_cert = request.environ.get('X-Sender-SSL-Certificate', None)
+    # NOTE: nginx adds \t to the certificate because otherwise it would be not
+    # possible to send it as a proxy header, so we have to remove those tabs.
+    # A PEM certificate does never contain tabs, so this replace is safe anyway.
+    # For more details see:
+    # - https://www.ruby-forum.com/topic/155918 and
+    # - http://nginx.org/en/docs/http/ngx_http_ssl_module.html
+    if sender_ssl_cert:
+        sender_ssl_cert = sender_ssl_cert.replace('\t', '')
+    return sender_ssl_cert
+
+
+def receive_message(data, queue_name, sender_ssl_cert, received=None):
+    '''
+    Checks a received message and registers it in the db session, without
+    committing it. Raises MessageError if the message is invalid, if it's
+    a local message and the certificate is not ours, or if its data is sent
+    as stored by the sender and it references blobs we don't have, which the
+    sender uploads before retrying. See blobs.py
 
+    Returns a tuple (msg, is_new). is_new is False if the message had already
+    been received, which happens when the sender retries a delivery. In that
+    case its action handler must not be called again. received is an
+    optional dict with the already received messages by id, used to avoid
+    querying for them.
+    '''
     from .app import db
+    from .blobs import StoredValue, missing_blobs
     from .models import Message
 
-    logging.debug('RECEIVED MESSAGE in queue %s' % queue_name)
-    data = request.get_json(force=True, silent=True)
-    if not data:
-        return error(400, "invalid json")
+    if not isinstance(data, dict):
+        raise MessageError(400, "invalid json")
 
     # check input data
     requirements = [
@@ -70,60 +133,316 @@ def post_message(queue_name):
     for req in requirements:
         if req['name'] not in data or not isinstance(data[req['name']],
             req['isinstance']):
-            return error(400, "invalid/notfound %s parameter" % req['name'])
+            raise MessageError(400, "invalid/notfound %s parameter" % req['name'])
 
-    sender_ssl_cert = request.environ.get('X-Sender-SSL-Certificate', None)
-    # NOTE: nginx adds \t to the certificate because otherwise it would be not
-    # possible to send it as a proxy header, so we have to remove those tabs.
-    # A PEM certificate does never contain tabs, so this replace is safe anyway.
-    # For more details see:
-    # - https://www.ruby-forum.com/topic/155918 and
-    # - http://nginx.org/en/docs/http/ngx_http_ssl_module.html
     if sender_ssl_cert:
-        sender_ssl_cert = sender_ssl_cert.replace('\t', '')
+        try:
+            cert_fingerprint(sender_ssl_cert)
+        except OpenSSL.crypto.Error:
+            raise MessageError(400, "invalid sender certificate")
 
     # check for a local message
     if data['sender_url'] == current_app.config.get('ROOT_URL'):
         # check that the certificate is really local
         from .protocol import certs_differ, SecurityException
         local_ssl_cert = current_app.config['SSL_CERT_STRING']
-        if certs_differ(sender_ssl_cert, local_ssl_cert):
-            raise SecurityException()
+        try:
+            if certs_differ(sender_ssl_cert, local_ssl_cert):
+                raise SecurityException()
+        except SecurityException:
+            raise MessageError(403, "invalid certificate for a local message")
 
         logging.debug('The MESSAGE is LOCAL and with id %s' % data['message_id'])
         msg = Message.query.get(data['message_id'])
+        if not msg:
+            raise MessageError(400, "local message %s not found" % data['message_id'])
+        return msg, True
+
+    if received is None:
+        msg = Message.query.get(data['message_id'])
     else:
-        logging.debug('The MESSAGE is NOT LOCAL and with id %s' % data['message_id'])
-        kwargs = {
-                'id': data.get('message_id', ''),
-                'action': data.get('action', ''),
-                'queue_name': queue_name,
-                'sender_url': data.get('sender_url', ''),
-                'receiver_url': current_app.config.get('ROOT_URL'),
-                'is_received': True,
-                'sender_ssl_cert': sender_ssl_cert,
-                'input_data': data.get('data', None),
-                'pingback_date': data.get('pingback_date', None),
-                'expiration_date': data.get('expiration_date', None),
-                'info_text': data.get('info_text', None),
-                'task_id': data.get('task_id', None),
-                'output_status': 200
-        }
-        msg = Message(**kwargs)
-        db.session.add(msg)
-        db.session.commit()
+        msg = received.get(data['message_id'], None)
+    if msg:
+        logging.debug('The MESSAGE with id %s was already received' % msg.id)
+        return msg, False
+
+    logging.debug('The MESSAGE is NOT LOCAL and with id %s' % data['message_id'])
+    input_data = data.get('data', None)
+    if data.get('stored_data', False) is True:
+        missing = missing_blobs(input_data)
+        if missing:
+            raise MessageError(503, "blob %s not found" % missing[0])
+        input_data = StoredValue(input_data)
+
+    priority = data.get('priority', None)
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        priority = None
+    kwargs = {
+            'id': data.get('message_id', ''),
+            'action': data.get('action', ''),
+            'queue_name': queue_name,
+            'sender_url': data.get('sender_url', ''),
+            'receiver_url': current_app.config.get('ROOT_URL'),
+            'is_received': True,
+            'sender_ssl_cert': sender_ssl_cert,
+            'input_data': input_data,
+            'pingback_date': data.get('pingback_date', None),
+            'expiration_date': data.get('expiration_date', None),
+            'info_text': data.get('info_text', None),
+            'task_id': data.get('task_id', None),
+            'priority': priority,
+            'output_status': 200
+    }
+    msg = Message(**kwargs)
+    db.session.add(msg)
+    MESSAGES_RECEIVED.inc(queue=queue_name)
+    return msg, True
+
+
+@api.route('/queues/', methods=['GET'])
+def get_queues_stats():
+    '''
+    Returns the saturation statistics of the pool of each queue of this
+    process, by queue name
+    '''
+    from .fscheduler import FScheduler
+    return make_response(dumps(FScheduler.get_all_stats()), 200)
+
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    '''
+    Returns the metrics of this process in the Prometheus text format. See
+    metrics.py
+    '''
+    response = make_response(Metrics.render(), 200)
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
+@api.route('/queues/<queue_name>/max/', methods=['POST'])
+def set_queue_max(queue_name):
+    '''
+    Changes the number of threads of a queue of this process. Only allowed to
+    this same frestq server, identified by its certificate.
+
+    Input format: {"max_threads": <number>}
+    '''
+    from .fscheduler import FScheduler
+    from .protocol import certs_differ, SecurityException
+
+    try:
+        if certs_differ(get_sender_ssl_cert(),
+                        current_app.config.get('SSL_CERT_STRING', '')):
+            return error(403, "only allowed to this server")
+    except (SecurityException, OpenSSL.crypto.Error):
+        return error(403, "only allowed to this server")
+
+    data = request.get_json(force=True, silent=True)
+    max_threads = data.get('max_threads', None)\
+        if isinstance(data, dict) else None
+    if not isinstance(max_threads, int) or isinstance(max_threads, bool) or\
+            max_threads < 1:
+        return error(400, "invalid max_threads")
 
+    sched = FScheduler._schedulers.get(queue_name, None)
+    if sched is None:
+        return error(404, "queue %s not found" % queue_name)
+    if not sched.set_max_threads(max_threads):
+        return error(400, "the number of processes of queue %s cannot be "
+                     "changed" % queue_name)
+    return make_response("", 200)
+
+
+@api.route('/queues/blobs/<blob_id>/', methods=['HEAD'])
+def head_blob(blob_id):
+    '''
+    Answers whether a blob is in the blob store, so that the senders only
+    upload the blobs we don't have. See blobs.py
+    '''
+    from .blobs import BlobStore, BLOB_ID_RE
+    if BLOB_ID_RE.fullmatch(blob_id) is None or not BlobStore.exists(blob_id):
+        return error(404, "blob not found")
+    return make_response("", 200)
+
+
+@api.route('/queues/blobs/<blob_id>/', methods=['PUT'])
+def put_blob(blob_id):
+    '''
+    Stores in the blob store a blob uploaded by a sender, referenced in a
+    message it's going to send. The body is streamed to disk in chunks of
+    BLOB_CHUNK_SIZE bytes, and rejected if it doesn't match the id. See
+    blobs.py
+    '''
+    from .blobs import BlobStore, BLOB_ID_RE
+    if not BlobStore.enabled():
+        return error(404, "there's no blob store")
+    if BLOB_ID_RE.fullmatch(blob_id) is None:
+        return error(400, "invalid blob id")
+    if current_app.config.get('ALLOW_ONLY_SSL_CONNECTIONS') and\
+            not get_sender_ssl_cert():
+        return error(403, "a sender certificate is required")
+
+    chunk_size = current_app.config.get('BLOB_CHUNK_SIZE', 1024*1024)
+    chunks = iter(lambda: request.stream.read(chunk_size), b'')
+    try:
+        BlobStore.add(blob_id, chunks, request.content_length)
+    except ValueError as e:
+        return error(400, str(e))
+    return make_response("", 201)
+
+
+@api.route('/queues/<queue_name>/', methods=['POST'])
+def post_message(queue_name):
+    '''
+    Post a message in a queue.
+
+    For input and out format, refer to RESTQP.md
+    '''
+    # 1. register message in the db model
+    logging.debug('RECEIVED MESSAGE in queue %s' % queue_name)
+    unsupported = check_wire_format()
+    if unsupported is not None:
+        return unsupported
+    data = request.get_json(force=True, silent=True)
+    if not data:
+        return error(400, "invalid json")
+
+    try:
+        msg, is_new = receive_message(data, queue_name, get_sender_ssl_cert())
+    except MessageError as e:
+        return error(e.status, e.message)
+
+    if commit_and_schedule([msg] if is_new else [], queue_name):
+        return error(404, "Action handler %s not found in the queue %s" %(
+            msg.action, queue_name))
+
+    # 4. return output message
+    return make_response("", msg.output_status)
+
+
+@api.route('/queues/<queue_name>/batch/', methods=['POST'])
+def post_message_batch(queue_name):
+    '''
+    Post a list of messages in a queue. All the messages are registered in
+    the database with a single commit.
+
+    Returns a list with the message_id and the status of each message, which
+    is the status post_message() would have answered with.
+    '''
+    from .models import Message
+
+    unsupported = check_wire_format()
+    if unsupported is not None:
+        return unsupported
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, list):
+        return error(400, "invalid json")
+    logging.debug('RECEIVED BATCH of %d MESSAGES in queue %s' % (
+        len(data), queue_name))
+
+    # fetch the messages already received with a single query
+    msg_ids = [
+        item['message_id']
+        for item in data
+        if isinstance(item, dict) and isinstance(item.get('message_id'), str)
+    ]
+    received = dict()
+    if msg_ids:
+        received = dict(
+            (msg.id, msg)
+            for msg in Message.query.filter(Message.id.in_(msg_ids))
+            if msg.is_received
+        )
+
+    sender_ssl_cert = get_sender_ssl_cert()
+    results = []
+    new_msgs = []
+    for item in data:
+        message_id = item.get('message_id') if isinstance(item, dict) else None
+        try:
+            msg, is_new = receive_message(item, queue_name, sender_ssl_cert,
+                                          received)
+        except MessageError as e:
+            results.append(dict(message_id=message_id, status=e.status,
+                                message=e.message))
+            continue
+        result = dict(message_id=msg.id, status=msg.output_status or 200)
+        results.append(result)
+        if is_new:
+            received[msg.id] = msg
+            new_msgs.append((msg, result))
+
+    not_found = commit_and_schedule([msg for msg, result in new_msgs],
+                                    queue_name)
+    for msg, result in new_msgs:
+        if msg in not_found:
+            result['status'] = 404
+            result['message'] = "Action handler %s not found in the queue %s" %(
+                msg.action, queue_name)
+
+    # answer in the same wire format of the request
+    body, mimetype = encode_body(results, request.mimetype)
+    response = make_response(body, 200)
+    response.mimetype = mimetype
+    return response
+
+
+def schedule_action_handler(msg, queue_name):
+    '''
+    Schedules the call to the action handler of a received message. Returns
+    False if there's no action handler for it.
+    '''
     action_handler = ActionHandlers.get_action_handler(msg.action, queue_name)
     if not action_handler:
         logging.error('Action handler for action %s not found (message id %s)' % (
             msg.action, msg.id))
-        return error(404, "Action handler %s not found in the queue %s" %(
-            msg.action, queue_name))
+        return False
 
-    # 3. call to action handle
+    # 3. call to action handle. The messages of each peer are taken in turns
     from .fscheduler import FScheduler
+    priority = msg.priority
+    if priority is None:
+        priority = action_handler.get('priority', 0)
     sched = FScheduler.get_scheduler(queue_name)
-    sched.add_now_job(call_action_handler, [msg.id, queue_name])
+    sched.add_now_job(call_action_handler, [msg.id, queue_name],
+                      priority=priority, fair_key=msg.sender_url)
+    return True
 
-    # 4. return output message
-    return make_response("", msg.output_status)
+
+def commit_and_schedule(msgs, queue_name):
+    '''
+    Commits the received messages and schedules the call to their action
+    handlers. Returns the messages without action handler.
+
+    The messages are committed before scheduling the action handlers in
+    memory, so that the jobs find them. If READY_QUEUE is enabled, the jobs
+    are committed along with the messages instead.
+    '''
+    from .app import db
+
+    if not current_app.config.get('READY_QUEUE', False):
+        db.session.commit()
+    not_found = [
+        msg
+        for msg in msgs
+        if not schedule_action_handler(msg, queue_name)
+    ]
+    db.session.commit()
+    return not_found
+
+
+def deliver_local_message(msg):
+    '''
+    Delivers a message sent to ourselves without doing an HTTP request.
+    Returns the status code the message would have been answered with.
+
+    There's no certificate to check: the message never leaves this process,
+    and its sender certificate is our own one, set by send_message(). When
+    local messages go through HTTP instead, post_message() checks that the
+    certificate of the request is ours.
+    '''
+    logging.debug('DELIVERING LOCAL MESSAGE with id %s' % msg.id)
+    if not schedule_action_handler(msg, msg.queue_name):
+        return 404
+    return 200
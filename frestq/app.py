@@ -16,14 +16,16 @@ from flask_sqlalchemy import SQLAlchemy
 from flask import json as json_flask
 from flask.wrappers import Request
 
-from .utils import loads
+from .utils import decode_body, set_json_codec, set_json_datetimes,\
+    MSGPACK_MIMETYPE
 
 logging.basicConfig(level=logging.DEBUG)
 
 class FrestqRequest(Request):
     '''
     We have to customize request so that by default it can overload the json
-    object_hook for json.loads() so that it auto-parses datetimes
+    object_hook for json.loads() so that it auto-parses datetimes. Bodies in
+    msgpack are decoded too, see utils.decode_body
     '''
 
     def get_json(self, force=False, silent=False, cache=True):
@@ -41,13 +43,13 @@ class FrestqRequest(Request):
         if cache and self._cached_json[silent] is not Ellipsis:
             return self._cached_json[silent]
 
-        if not (force or self.is_json):
+        if not (force or self.is_json or self.mimetype == MSGPACK_MIMETYPE):
             return None
 
         data = self.get_data(cache=cache)
 
         try:
-            rv = loads(data.decode('utf-8'))
+            rv = decode_body(data, self.mimetype)
         except ValueError as e:
             if silent:
                 rv = None
@@ -92,6 +94,9 @@ class FrestqApp(Flask):
         else:
             logging.warning("FRESTQ_SETTINGS not set")
 
+        set_json_codec(self.config.get('JSON_CODEC', 'auto'))
+        set_json_datetimes(self.config.get('JSON_DATETIMES', 'strings'))
+
         # store cert in
         if self.config.get('SSL_CERT_PATH', None) and\
             self.config.get('SSL_KEY_PATH', None):
@@ -107,11 +112,23 @@ class FrestqApp(Flask):
 
         logging.info("Launching with ROOT_URL = %s", self.config['ROOT_URL'])
         FScheduler.start_all_schedulers()
+
+        from .outbox import start_outbox
+        start_outbox()
+
+        from .ready_queue import start_ready_queue
+        start_ready_queue()
+
+        from .autoscaler import start_autoscaler
+        start_autoscaler()
      
     def parse_args(self, extra_parse_func):
         parser = argparse.ArgumentParser()
         parser.add_argument("--createdb", help="create the database",
                             action="store_true")
+        parser.add_argument("--upgradedb",
+                            help="upgrade the schema of the database",
+                            action="store_true")
         parser.add_argument("--messages", help="list last messages",
                             action="store_true")
         parser.add_argument("--tasks", help="list last tasks",
@@ -127,8 +144,17 @@ class FrestqApp(Flask):
         parser.add_argument("--show-external", help="prints an external task details")
         parser.add_argument("--show-activity", help="prints activity",
                             action="store_true")
+        parser.add_argument("--since",
+                            help="with --show-activity, count only the jobs "
+                            "since this local time (YYYY-MM-DD[ HH:MM[:SS]]) "
+                            "or time ago (30m, 2h, 1d)", default=None)
         parser.add_argument("--finish", help="finish an external task",
                             nargs=2, default=None)
+        parser.add_argument("--set-queue-max",
+                            help="change the number of threads of a queue of "
+                            "the running server",
+                            nargs=2, metavar=("QUEUE", "MAX_THREADS"),
+                            default=None)
         parser.add_argument("--with-parents",
                             help="show in the tree parent tasks too",
                             action="store_true")
@@ -163,7 +189,13 @@ class FrestqApp(Flask):
         if self.pargs is not None:
             if self.pargs.createdb:
                 print("creating the database: " + self.config.get('SQLALCHEMY_DATABASE_URI', ''))
-                db.create_all()
+                from .migrations import create_db
+                create_db()
+                return
+            elif self.pargs.upgradedb:
+                print("upgrading the database: " + self.config.get('SQLALCHEMY_DATABASE_URI', ''))
+                from .migrations import upgrade_db
+                upgrade_db()
                 return
             elif self.pargs.messages:
                 list_messages(self.pargs)
@@ -188,6 +220,9 @@ class FrestqApp(Flask):
             elif self.pargs.show_activity:
                 show_activity(self.pargs)
                 return
+            elif self.pargs.set_queue_max:
+                set_queue_max(self.pargs)
+                return
             elif self.pargs.console:
                 import ipdb; ipdb.set_trace()
                 return
@@ -235,6 +270,125 @@ ROOT_URL = 'http://127.0.0.1:5000/api/queues'
 # time a thread can be reserved in for synchronization purposes. In seconds.
 RESERVATION_TIMEOUT = 60
 
+# keep-alive HTTP sessions used to send messages to peers: maximum number of
+# pooled connections per peer, maximum number of peers with an open session
+# and seconds after which an unused peer session is closed
+HTTP_POOL_MAXSIZE = 10
+HTTP_POOL_MAX_PEERS = 32
+HTTP_POOL_IDLE_TIMEOUT = 300
+
+# number of threads of the internal schedulers of frestq: the one handling the
+# protocol messages and the one executing the reservation timeouts. The
+# messages sent to other peers are delivered by a third one, the outbox, see
+# OUTBOX_MAX_THREADS. Each has its own pool so that a burst of jobs of one kind
+# does not delay the others. Their saturation statistics are available in
+# GET /api/queues/
+INTERNAL_MAX_THREADS = 10
+INTERNAL_TIMER_MAX_THREADS = 4
+
+# deliver the messages we send to ourselves directly instead of doing an HTTP
+# request to our own ROOT_URL
+LOCAL_MESSAGES_SHORTCUT = True
+
+# outbox of sent messages: number of threads delivering messages, maximum
+# number of messages being delivered concurrently to the same peer, maximum
+# number of delivery attempts before marking a message as dead, initial and
+# maximum delay between attempts in seconds (exponential backoff with jitter),
+# seconds after which a delivery that didn't finish is considered lost, and
+# interval in seconds to check for overdue messages. Due messages for the same
+# peer and queue are sent together in batches of up to OUTBOX_BATCH_SIZE
+# messages, and delivery is delayed OUTBOX_BATCH_WINDOW seconds to coalesce
+# messages sent within that window (0 means no delay, so messages are only
+# coalesced when they are waiting for the peer concurrency limit). The
+# requests to the peers time out after OUTBOX_CONNECT_TIMEOUT seconds without
+# connecting and OUTBOX_READ_TIMEOUT seconds without receiving data, each
+# capped to a quarter of OUTBOX_SENDING_TIMEOUT so that a delivery to a hung
+# peer doesn't outlive its lease and the message is not sent twice
+OUTBOX_MAX_THREADS = 10
+OUTBOX_MAX_PEER_CONCURRENCY = 4
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_RETRY_DELAY = 1
+OUTBOX_MAX_RETRY_DELAY = 300
+OUTBOX_SENDING_TIMEOUT = 600
+OUTBOX_SWEEP_INTERVAL = 60
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_BATCH_WINDOW = 0
+OUTBOX_CONNECT_TIMEOUT = 10
+OUTBOX_READ_TIMEOUT = 60
+
+# store the jobs ready to be executed in the database instead of in memory, so
+# that they are not lost if the process dies and they are shared among all the
+# frestq processes using the same database. Each process polls the ready queue
+# every READY_QUEUE_POLL_INTERVAL seconds, and the jobs claimed by a process
+# that didn't renew its claim in READY_QUEUE_CLAIM_TIMEOUT seconds are claimed
+# again by other process. A job that raises an exception is released to be
+# claimed again, and removed once it failed READY_QUEUE_MAX_ATTEMPTS times. See
+# ready_queue.py
+READY_QUEUE = False
+READY_QUEUE_POLL_INTERVAL = 1
+READY_QUEUE_CLAIM_TIMEOUT = 300
+READY_QUEUE_MAX_ATTEMPTS = 3
+
+# activity log of the schedulers (activity.json.log, see --show-activity). It's
+# written by a background thread and rotated when it reaches
+# ACTIVITY_LOG_MAX_BYTES (0 means never), or if ACTIVITY_LOG_ROTATE_WHEN is set
+# (for example 'midnight'), by time as in logging.TimedRotatingFileHandler.
+# ACTIVITY_LOG_BACKUP_COUNT old segments are kept, gzipped if
+# ACTIVITY_LOG_COMPRESS. Only a fraction ACTIVITY_LOG_DEBUG_SAMPLE_RATE of the
+# job events, which are most of the log, is written
+ACTIVITY_LOG_MAX_BYTES = 100*1024*1024
+ACTIVITY_LOG_ROTATE_WHEN = None
+ACTIVITY_LOG_BACKUP_COUNT = 10
+ACTIVITY_LOG_COMPRESS = True
+ACTIVITY_LOG_DEBUG_SAMPLE_RATE = 1.0
+
+# json codec used to encode and decode the messages, the json columns and the
+# activity log: "orjson" (much faster, needs the orjson package), "json" (the
+# json module of the standard library) or "auto" to use orjson if installed
+JSON_CODEC = 'auto'
+
+# how datetimes are encoded and decoded in json. With "strings", they are
+# encoded as ISO format strings, and every decoded string that looks like one
+# is decoded as a datetime, which older peers expect. With "tagged", they are
+# encoded as {"$datetime": "<ISO format>"} and only those (and the dates of the
+# RESTQP messages) are decoded, which is faster with payloads with many
+# strings. Only use "tagged" when all the peers have been upgraded to a version
+# that decodes tagged datetimes, and note that the datetimes already stored in
+# json columns as strings are then not decoded.
+JSON_DATETIMES = 'strings'
+
+# wire format of the messages exchanged with other peers. With "auto", if the
+# msgpack package is installed, this peer announces that it accepts messages in
+# msgpack and sends them in msgpack to the peers that announce the same, which
+# is more compact and faster to decode. Other peers get json. With "json",
+# messages are always sent and answered in json.
+WIRE_FORMAT = 'auto'
+
+# content addressed store of the big values of the json columns of tasks and
+# messages. Values encoded in more than BLOB_THRESHOLD bytes are stored once as
+# files in the BLOB_STORE_PATH directory, which must be shared by all the
+# frestq processes using the same database, and referenced by their hash in
+# the database and in the messages sent to peers with a blob store, to which
+# they are uploaded only if they don't have them. A relative path is relative
+# to ROOT_PATH. Blobs are never deleted, so the directory grows with the
+# payloads. Disabled by default (None). See blobs.py
+#
+# Only the blobs are streamed: they are uploaded to the peers from their files
+# and written to the blob store in chunks as they are received. The bodies of
+# the messages are always encoded and decoded whole in memory, so when the blob
+# store is disabled nothing is streamed and big payloads are whole in memory
+# while they are sent and received.
+BLOB_STORE_PATH = None
+BLOB_THRESHOLD = 1024*1024
+
+# size in bytes of the chunks in which the blobs uploaded by the peers are
+# written to the blob store, so that a blob is never whole in memory
+BLOB_CHUNK_SIZE = 1024*1024
+
+# interval in seconds between adjustments of the number of threads of the
+# queues with autoscaling. See QUEUES_OPTIONS
+AUTOSCALE_INTERVAL = 10
+
 app.config.from_object(__name__)
 
 # boostrap our little application
@@ -247,8 +401,30 @@ ALLOW_ONLY_SSL_CONNECTIONS = False
 #QUEUES_OPTIONS = {
     #'mycustom_queue': {
         #'max_threads': 3,
+    #},
+    #'my_bursty_queue': {
+        #'max_threads': 2,
+        #'autoscale': {
+            #'min_threads': 2,
+            #'max_threads': 50,
+        #}
+    #},
+    #'my_cpu_bound_queue': {
+        #'executor': 'process',
+        #'max_processes': 4,
     #}
 #}
+# the jobs of a queue with the "process" executor are executed in a pool of
+# max_processes worker processes (by default, one per CPU) instead of threads,
+# so that CPU bound action handlers can use all the cores. The jobs must be
+# module level functions with picklable arguments, as the jobs of frestq are.
+# Worker processes do not share the in-memory task locks, so use a database
+# with row locks (like postgresql) with them.
+# the number of threads of a queue with "autoscale" is adjusted every
+# AUTOSCALE_INTERVAL seconds between its min_threads and max_threads, depending
+# on the jobs waiting and the time they take to execute. See autoscaler.py.
+# The number of threads of any queue with threads can also be changed while
+# running with the --set-queue-max command or POST /api/queues/<queue>/max/
 # thread data mapper is a function that would be called when a Synchronous task
 # in this queue is going to be executed. It allows to set queue-specific
 # settings, and even custom queue settings that can be used by you later.
@@ -263,7 +439,7 @@ app.register_blueprint(api, url_prefix='/api')
 from . import protocol
 from .utils import (list_messages, list_tasks, task_tree, show_task,
                     show_message, show_external_task, finish_task,
-                    show_activity)
+                    show_activity, set_queue_max)
 
 if __name__ == "__main__":
     app.run()
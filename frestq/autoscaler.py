@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# SPDX-FileCopyrightText: 2014-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import math
+import logging
+
+from .app import app
+from .fscheduler import FScheduler, INTERNAL_TIMER_SCHEDULER_NAME
+
+# Autoscaler of the thread pools of the queues.
+#
+# The queues with the "autoscale" option in QUEUES_OPTIONS change their number
+# of threads every AUTOSCALE_INTERVAL seconds, between the min_threads and
+# max_threads of the option. The threads needed are estimated with the
+# statistics of the pool (see PriorityThreadPoolExecutor.get_stats):
+#
+# * the time spent executing jobs in the last interval divided by the interval
+#   is the number of threads that were busy on average, and
+# * the jobs waiting for a thread need the threads to execute them within the
+#   next interval, given the average time the jobs of the queue take.
+#
+# The pool grows at once to the threads needed plus some headroom, and shrinks
+# at most by a quarter each interval, so that a burst of jobs that comes in
+# waves does not find the pool shrunk in between.
+
+# extra threads over the estimated, as a fraction of these
+HEADROOM = 0.25
+
+class Autoscaler(object):
+    '''
+    Adjusts the number of threads of the queues with autoscaling
+    '''
+    # statistics of each queue in the previous adjustment
+    _last_stats = dict()
+
+    @staticmethod
+    def needed_threads(stats, last_stats, interval):
+        '''
+        Estimates the number of threads needed by a queue from its current
+        statistics and those of the previous adjustment
+        '''
+        run_time = stats['run_time'] - last_stats['run_time']
+        needed = max(run_time / interval, stats['busy'])
+
+        if stats['waiting']:
+            if stats['avg_run_time']:
+                needed += stats['waiting'] * stats['avg_run_time'] / interval
+            else:
+                # nothing finished yet, so we don't know how long jobs take
+                needed += stats['waiting']
+
+        return int(math.ceil(needed * (1 + HEADROOM)))
+
+    @staticmethod
+    def adjust():
+        '''
+        Adjusts the number of threads of each queue with autoscaling
+        '''
+        interval = app.config.get('AUTOSCALE_INTERVAL', 10)
+        for queue_name, sched in list(FScheduler._schedulers.items()):
+            if not sched.autoscale:
+                continue
+
+            stats = sched.get_stats()
+            last_stats = Autoscaler._last_stats.get(queue_name, None)
+            Autoscaler._last_stats[queue_name] = stats
+            if last_stats is None or 'run_time' not in stats:
+                continue
+
+            min_threads = sched.autoscale.get('min_threads', 1)
+            max_threads = sched.autoscale.get('max_threads',
+                                              FScheduler.max_threads)
+            current = stats['max_workers']
+            target = Autoscaler.needed_threads(stats, last_stats, interval)
+            if target < current:
+                target = max(target, current - max(1, current // 4))
+            target = min(max(target, min_threads), max_threads)
+
+            if target != current:
+                logging.debug("AUTOSCALING queue %s from %d to %d threads "\
+                    "(busy = %d, waiting = %d)" % (queue_name, current,
+                    target, stats['busy'], stats['waiting']))
+                sched.set_max_threads(target)
+
+
+def start_autoscaler():
+    '''
+    Schedules the periodic adjustment of the queues with autoscaling, if any
+    '''
+    queues_opts = app.config.get('QUEUES_OPTIONS', dict())
+    if not any(opts.get('autoscale', None) for opts in queues_opts.values()):
+        return
+
+    sched = FScheduler.get_scheduler(INTERNAL_TIMER_SCHEDULER_NAME)
+    sched.add_interval_job(Autoscaler.adjust,
+                           seconds=app.config.get('AUTOSCALE_INTERVAL', 10))
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+# SPDX-FileCopyrightText: 2014-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import os
+import re
+import hashlib
+import tempfile
+
+from .utils import dumps, loads
+
+# Content addressed store of the big values of the json columns.
+#
+# When a value of a json column (see models.JSONEncodedDict) is encoded in more
+# than BLOB_THRESHOLD bytes, it's stored as a file in BLOB_STORE_PATH named by
+# the sha256 of its json, and the column only stores a reference to it:
+# {"$blob": "<sha256>", "size": <bytes>}. If the value is a dict, its values
+# that are that big are stored as blobs instead of the whole dict, unless the
+# dict would still be that big. Thus blobs never contain references, and the
+# references of a value are found without reading any blob. This way the
+# payloads copied from task to message to task, like the output_data of a task
+# sent in the update of the task, are stored only once.
+#
+# So that the data of the users can't be taken for a reference, the dicts with
+# a "$blob" key where a reference can be (the value and the values of a dict
+# value) are always stored escaped, as {"$blob": <dict>}, and only the
+# references have a string there. References are only resolved if the blob
+# store is enabled.
+#
+# The messages sent to the peers that announce that they have a blob store
+# (with the X-Frestq-Features response header) also contain the data as it's
+# stored, with the references instead of the values, and are flagged with
+# "stored_data". Before sending a message, the sender uploads to the receiver
+# the blobs it doesn't already have, and the receiver only accepts messages
+# whose blobs it has, see missing_blobs(). This way a receiver never makes
+# requests to the senders. Other peers get the values.
+#
+# The blob store is disabled unless BLOB_STORE_PATH is set. Blobs are never
+# deleted, as they might be referenced by any row.
+
+BLOB_KEY = '$blob'
+
+BLOB_ID_RE = re.compile(r'[0-9a-f]{64}')
+
+class StoredValue(object):
+    '''
+    A value of a json column as it's stored, with references to blobs and
+    escaped dicts, like the data of the messages received from peers with a
+    blob store. It's stored as is, see dump_blobs()
+    '''
+    def __init__(self, value):
+        self.value = value
+
+
+class BlobNotFound(Exception):
+    '''
+    Raised when a referenced blob is not in the blob store
+    '''
+    pass
+
+
+class BlobStore(object):
+    '''
+    Blobs stored in files in BLOB_STORE_PATH, in subdirectories by the first
+    two characters of their id
+    '''
+    @staticmethod
+    def enabled():
+        from .app import app
+        return bool(app.config.get('BLOB_STORE_PATH', None))
+
+    @staticmethod
+    def threshold():
+        '''
+        Returns the size in bytes above which json values are stored as blobs,
+        or None if the blob store is disabled
+        '''
+        from .app import app
+        if not BlobStore.enabled():
+            return None
+        return app.config.get('BLOB_THRESHOLD', 1024*1024)
+
+    @staticmethod
+    def path(blob_id):
+        '''
+        Returns the path of the file of a blob. A relative BLOB_STORE_PATH is
+        relative to ROOT_PATH
+        '''
+        from .app import app
+        return os.path.join(app.config.get('ROOT_PATH', ""),
+                            app.config.get('BLOB_STORE_PATH'), blob_id[:2],
+                            blob_id)
+
+    @staticmethod
+    def exists(blob_id):
+        return BlobStore.enabled() and os.path.exists(BlobStore.path(blob_id))
+
+    @staticmethod
+    def add(blob_id, chunks, size=None):
+        '''
+        Stores a blob given an iterable of chunks of its contents in bytes, if
+        it's not already stored. The chunks are hashed as they are written, so
+        a blob is never whole in memory. Raises ValueError if the id is not the
+        sha256 of the data, or if it's bigger than the given size.
+        '''
+        path = BlobStore.path(blob_id)
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # written to a temporary file and renamed, so that a blob file is
+        # always complete even if several threads store it at the same time
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            sha256 = hashlib.sha256()
+            written = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    written += len(chunk)
+                    if size is not None and written > size:
+                        raise ValueError("blob %s is bigger than %d bytes" % (
+                            blob_id, size))
+                    sha256.update(chunk)
+                    f.write(chunk)
+            if sha256.hexdigest() != blob_id:
+                raise ValueError("the data of blob %s does not match its id" %
+                                 blob_id)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    @staticmethod
+    def put(data):
+        '''
+        Stores a blob given its contents in bytes. Returns its id.
+        '''
+        blob_id = hashlib.sha256(data).hexdigest()
+        BlobStore.add(blob_id, [data])
+        return blob_id
+
+    @staticmethod
+    def get(blob_id):
+        '''
+        Returns the contents of a blob in bytes
+        '''
+        if not BlobStore.exists(blob_id):
+            raise BlobNotFound("blob %s not found" % blob_id)
+        with open(BlobStore.path(blob_id), 'rb') as f:
+            return f.read()
+
+
+def is_blob_ref(value):
+    return isinstance(value, dict) and len(value) == 2 and\
+        isinstance(value.get(BLOB_KEY, None), str) and\
+        BLOB_ID_RE.fullmatch(value[BLOB_KEY]) is not None
+
+def _escape(value):
+    if isinstance(value, dict) and BLOB_KEY in value:
+        return {BLOB_KEY: value}
+    return value
+
+def _unescape(value):
+    if isinstance(value, dict) and len(value) == 1 and\
+            isinstance(value.get(BLOB_KEY, None), dict):
+        return value[BLOB_KEY]
+    return value
+
+def _ref(data):
+    return {BLOB_KEY: hashlib.sha256(data).hexdigest(), 'size': len(data)}
+
+def dump_blobs(value):
+    '''
+    Encodes a value of a json column, storing it or its big values as blobs
+    '''
+    if isinstance(value, StoredValue):
+        return dumps(value.value)
+
+    if isinstance(value, dict) and\
+            any(isinstance(item, dict) and BLOB_KEY in item
+                for item in value.values()):
+        value = dict((key, _escape(item)) for key, item in value.items())
+    data = dumps(_escape(value))
+    threshold = BlobStore.threshold()
+    if threshold is None or len(data) <= threshold:
+        return data
+
+    if isinstance(value, dict):
+        blobs = dict()
+        for key, item in value.items():
+            item_data = dumps(item)
+            if len(item_data) > threshold:
+                blobs[key] = item_data.encode('utf-8')
+        if blobs:
+            value = dict(value)
+            value.update(
+                (key, _ref(item_data)) for key, item_data in blobs.items())
+            refs_data = dumps(_escape(value))
+            if len(refs_data) <= threshold:
+                for item_data in blobs.values():
+                    BlobStore.put(item_data)
+                return refs_data
+
+    data = data.encode('utf-8')
+    BlobStore.put(data)
+    return dumps(_ref(data))
+
+def blob_refs(value):
+    '''
+    Returns the references to blobs of a decoded json column
+    '''
+    if is_blob_ref(value):
+        return [value]
+    value = _unescape(value)
+    if isinstance(value, dict):
+        return [item for item in value.values() if is_blob_ref(item)]
+    return []
+
+def load_blobs(value):
+    '''
+    Replaces the references to blobs of a decoded json column with their
+    values, if the blob store is enabled, and unescapes its dicts. Raises
+    BlobNotFound if a blob is not in the blob store.
+    '''
+    enabled = BlobStore.enabled()
+    if enabled and is_blob_ref(value):
+        value = loads(BlobStore.get(value[BLOB_KEY]))
+    value = _unescape(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if enabled and is_blob_ref(item):
+                value[key] = _unescape(loads(BlobStore.get(item[BLOB_KEY])))
+            elif isinstance(item, dict):
+                value[key] = _unescape(item)
+    return value
+
+def blob_ids(value):
+    '''
+    Returns the ids of the blobs referenced by a decoded json column. The
+    blobs are not read, as they never contain references
+    '''
+    return [ref[BLOB_KEY] for ref in blob_refs(value)]
+
+def missing_blobs(value):
+    '''
+    Returns the ids of the blobs referenced by a decoded json column that are
+    not in the blob store
+    '''
+    return [
+        blob_id
+        for blob_id in blob_ids(value)
+        if not BlobStore.exists(blob_id)
+    ]
@@ -36,7 +36,9 @@ def message_action(action, queue, **kwargs):
 
 def task(action, queue, **kwargs):
     """
-    Decorator for tasks
+    Decorator for tasks. The priority keyword argument sets the priority of
+    the tasks received for this action handler, see
+    fscheduler.PriorityThreadPoolExecutor
     """
 
     # Check if perm is given as string in order not to decorate
@@ -5,29 +5,81 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
-import logging
 import os
+import sys
+import gzip
+import time
+import queue
+import atexit
+import random
+import shutil
+import logging
+import logging.handlers
+import concurrent.futures
+from collections import OrderedDict, deque
+from datetime import datetime
+from threading import Lock
 from sqlalchemy import exc
 
 from apscheduler.events import *
+from apscheduler.executors.base import BaseExecutor, run_job
 from apscheduler.schedulers.background import BackgroundScheduler as Scheduler
 from apscheduler.triggers.base import BaseTrigger
-from apscheduler.util import convert_to_datetime
+from apscheduler.util import convert_to_datetime, obj_to_ref, ref_to_obj
 
+from .metrics import JOB_LATENCY, JOBS_FINISHED
+
+# the internal jobs of frestq are split in three schedulers, each one with its
+# own pool of threads, so that a burst of jobs of one kind doesn't delay the
+# others: the protocol jobs (the handlers of the protocol messages and the jobs
+# queuing task updates and synchronization messages in the outbox), the
+# deliveries of the messages of the outbox to the other peers, which are the
+# only jobs doing HTTP requests, and the timeouts of the reservations
 INTERNAL_SCHEDULER_NAME = "internal.frestq"
+INTERNAL_TIMER_SCHEDULER_NAME = "internal.frestq.timer"
+
+# scheduler used to deliver the messages of the outbox
+OUTBOX_SCHEDULER_NAME = "internal.frestq.outbox"
 
+# app config setting with the default max_threads of the internal schedulers
+INTERNAL_MAX_THREADS_SETTINGS = {
+    INTERNAL_SCHEDULER_NAME: 'INTERNAL_MAX_THREADS',
+    INTERNAL_TIMER_SCHEDULER_NAME: 'INTERNAL_TIMER_MAX_THREADS',
+    OUTBOX_SCHEDULER_NAME: 'OUTBOX_MAX_THREADS',
+}
+
+# priority of the jobs handling the synchronization protocol between frestq
+# peers, which should not wait behind other jobs. Jobs without priority have
+# priority 0. See PriorityThreadPoolExecutor
+PROTOCOL_PRIORITY = 10
+
+# names of the scheduler events in the activity log
 EVENT_IDS = dict(
-  EVENT_SCHEDULER_START = 1,
-  EVENT_SCHEDULER_SHUTDOWN = 2,
-  EVENT_JOBSTORE_ADDED = 4,
-  EVENT_JOBSTORE_REMOVED = 8,
-  EVENT_JOBSTORE_JOB_ADDED = 16,
-  EVENT_JOBSTORE_JOB_REMOVED = 32,
-  EVENT_JOB_EXECUTED = 64,
-  EVENT_JOB_ERROR = 128,
-  EVENT_JOB_MISSED = 256,
-  EVENT_JOB_LAUNCHING = 512
+  EVENT_SCHEDULER_START = EVENT_SCHEDULER_STARTED,
+  EVENT_SCHEDULER_SHUTDOWN = EVENT_SCHEDULER_SHUTDOWN,
+  EVENT_SCHEDULER_PAUSED = EVENT_SCHEDULER_PAUSED,
+  EVENT_SCHEDULER_RESUMED = EVENT_SCHEDULER_RESUMED,
+  EVENT_EXECUTOR_ADDED = EVENT_EXECUTOR_ADDED,
+  EVENT_EXECUTOR_REMOVED = EVENT_EXECUTOR_REMOVED,
+  EVENT_JOBSTORE_ADDED = EVENT_JOBSTORE_ADDED,
+  EVENT_JOBSTORE_REMOVED = EVENT_JOBSTORE_REMOVED,
+  EVENT_ALL_JOBS_REMOVED = EVENT_ALL_JOBS_REMOVED,
+  EVENT_JOB_ADDED = EVENT_JOB_ADDED,
+  EVENT_JOB_REMOVED = EVENT_JOB_REMOVED,
+  EVENT_JOB_MODIFIED = EVENT_JOB_MODIFIED,
+  EVENT_JOB_EXECUTED = EVENT_JOB_EXECUTED,
+  EVENT_JOB_ERROR = EVENT_JOB_ERROR,
+  EVENT_JOB_MISSED = EVENT_JOB_MISSED,
+  EVENT_JOB_SUBMITTED = EVENT_JOB_SUBMITTED,
+  EVENT_JOB_MAX_INSTANCES = EVENT_JOB_MAX_INSTANCES
 )
+EVENT_NAMES = dict((value, key) for key, value in EVENT_IDS.items())
+
+# job events written in the activity log with info level, because
+# show_activity needs them all to know the jobs being executed. The rest of
+# the job events are written with debug level, and can be sampled
+ACTIVITY_JOB_EVENTS = [EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR,
+                       EVENT_JOB_MISSED, EVENT_JOB_ADDED]
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -45,53 +97,379 @@ class NowTrigger(BaseTrigger):
         return '<%s>' % (self.__class__.__name__)
 
 
+class PriorityThreadPoolExecutor(BaseExecutor):
+    '''
+    Executor that runs the jobs in a thread pool in order of priority, instead
+    of in order of arrival. Jobs with the same priority are taken in turns
+    from each fair_key, so that a task with lots of subtasks does not delay
+    the jobs of the other tasks in the queue.
+
+    The priority and fair_key are attributes of the job function, see
+    FScheduler.add_now_job.
+
+    The number of threads can be changed while running with resize. It also
+    keeps statistics of the saturation of the pool, see get_stats.
+    '''
+    def __init__(self, max_workers=10):
+        super(PriorityThreadPoolExecutor, self).__init__()
+        self.max_workers = int(max_workers)
+        self._pool_size = self.max_workers
+        self._pool = concurrent.futures.ThreadPoolExecutor(self._pool_size)
+
+        # jobs waiting for a thread, by priority and fair_key
+        self._waiting = dict()
+        self._lock = Lock()
+
+        # statistics
+        self._num_waiting = 0
+        self._peak_waiting = 0
+        self._busy = 0
+        self._submitted = 0
+        self._delayed = 0
+        self._completed = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._run_time = 0.0
+
+    def _do_submit_job(self, job, run_times):
+        priority = getattr(job.func, 'priority', 0) or 0
+        fair_key = getattr(job.func, 'fair_key', None)
+        with self._lock:
+            self._waiting.setdefault(priority, OrderedDict())\
+                .setdefault(fair_key, deque())\
+                .append((job, run_times, time.monotonic()))
+
+            # the job is delayed if there's no free thread to run it
+            if self._busy >= self.max_workers:
+                self._delayed += 1
+            self._submitted += 1
+            self._num_waiting += 1
+            self._peak_waiting = max(self._peak_waiting, self._num_waiting)
+            self._dispatch()
+
+    def _dispatch(self):
+        '''
+        Runs the next waiting jobs while there are free threads. Must be
+        called with the lock acquired.
+        '''
+        while self._waiting and self._busy < self.max_workers:
+            job, run_times = self._next_job()
+            self._pool.submit(self._run_job, job, run_times)
+
+    def _next_job(self):
+        priority = max(self._waiting)
+        turns = self._waiting[priority]
+        fair_key, jobs = next(iter(turns.items()))
+        job, run_times, submit_time = jobs.popleft()
+        if jobs:
+            turns.move_to_end(fair_key)
+        else:
+            del turns[fair_key]
+            if not turns:
+                del self._waiting[priority]
+
+        wait_time = time.monotonic() - submit_time
+        self._wait_time += wait_time
+        self._max_wait_time = max(self._max_wait_time, wait_time)
+        self._num_waiting -= 1
+        self._busy += 1
+        return job, run_times
+
+    def _run_job(self, job, run_times):
+        start_time = time.monotonic()
+
+        # the latency is measured when the job is picked up by a thread, so
+        # that it doesn't include its execution time
+        scheduled = run_times[0]
+        JOB_LATENCY.observe(
+            (datetime.now(scheduled.tzinfo) - scheduled).total_seconds(),
+            queue=self._scheduler.queue_name)
+        try:
+            events = run_job(job, job._jobstore_alias, run_times,
+                             self._logger.name)
+        except BaseException:
+            exc_info = sys.exc_info()
+            self._run_job_error(job.id, exc_info[1], exc_info[2])
+        else:
+            self._run_job_success(job.id, events)
+        finally:
+            with self._lock:
+                self._busy -= 1
+                self._completed += 1
+                self._run_time += time.monotonic() - start_time
+                self._dispatch()
+
+    def resize(self, max_workers):
+        '''
+        Changes the number of threads of the pool. When it shrinks, the jobs
+        being executed are not interrupted, but no other job is started until
+        the number of busy threads is below the new size.
+        '''
+        max_workers = int(max_workers)
+        with self._lock:
+            if max_workers > self._pool_size:
+                # the running jobs finish in the old pool, whose threads
+                # exit then
+                old_pool = self._pool
+                self._pool_size = max_workers
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+                old_pool.shutdown(wait=False)
+            self.max_workers = max_workers
+            self._dispatch()
+
+    def get_stats(self):
+        '''
+        Returns the saturation statistics of the pool: number of threads, busy
+        threads, jobs waiting for a thread (now and at most), jobs submitted,
+        completed and delayed because all the threads were busy, the average
+        and maximum time in seconds jobs waited for a thread, and the total
+        and average time in seconds the jobs took to execute
+        '''
+        with self._lock:
+            started = self._submitted - self._num_waiting
+            return dict(
+                max_workers=self.max_workers,
+                busy=self._busy,
+                waiting=self._num_waiting,
+                peak_waiting=self._peak_waiting,
+                submitted=self._submitted,
+                completed=self._completed,
+                delayed=self._delayed,
+                avg_wait_time=self._wait_time / started if started else 0.0,
+                max_wait_time=self._max_wait_time,
+                run_time=self._run_time,
+                avg_run_time=(self._run_time / self._completed
+                              if self._completed else 0.0))
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait)
+
+
+class ActivityFormatter(logging.Formatter):
+    '''
+    Formats the activity log records, whose message is a dict that is
+    encoded in json here, in the thread writing the log
+    '''
+    def __init__(self):
+        super(ActivityFormatter, self).__init__(
+            '{"time": "%(asctime)s", "activity":%(message)s}')
+
+    def formatMessage(self, record):
+        from .utils import dumps
+
+        if isinstance(record.msg, dict):
+            try:
+                record.message = dumps(record.msg)
+            except (TypeError, ValueError):
+                record.message = dumps(record.msg, default=str)
+        return super(ActivityFormatter, self).formatMessage(record)
+
+
+class ActivityQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Queues the activity log records to be formatted and written by the
+    QueueListener thread, so that the scheduler threads don't wait for it.
+    Debug records are only queued with a probability of
+    ACTIVITY_LOG_DEBUG_SAMPLE_RATE.
+    '''
+    def __init__(self, queue, debug_sample_rate=1.0):
+        super(ActivityQueueHandler, self).__init__(queue)
+        self.debug_sample_rate = debug_sample_rate
+
+    def emit(self, record):
+        if record.levelno <= logging.DEBUG and self.debug_sample_rate < 1.0\
+                and random.random() >= self.debug_sample_rate:
+            return
+        super(ActivityQueueHandler, self).emit(record)
+
+    def prepare(self, record):
+        # unlike QueueHandler.prepare, the record is not formatted here, as
+        # it's not going to be pickled
+        return record
+
+
+def compress_rotated_log(source, dest):
+    '''
+    Rotator of the activity log that compresses the rotated segment
+    '''
+    with open(source, 'rb') as source_f, gzip.open(dest, 'wb') as dest_f:
+        shutil.copyfileobj(source_f, dest_f)
+    os.remove(source)
+
+
+def autocommit(func):
+    '''
+    Wraps the function of a job so that the session is committed after it's
+    executed, or rolled back if there was a database error, to avoid dangling
+    sessions
+    '''
+    from .app import db
+
+    def autocommit_wrapper(*args, **kwargs):
+        try:
+            func(*args, **kwargs)
+            db.session.commit()
+        except exc.SQLAlchemyError:
+            logging.exception("SQLAlchemy exception in job %s, doing a "
+                              "rollback for recovery" % func.__name__)
+            db.session.rollback()
+
+    autocommit_wrapper.__name__ = func.__name__
+    return autocommit_wrapper
+
+
 class FScheduler(Scheduler):
     _schedulers = dict()
 
     queue_name = None
 
+    # number of threads (or processes) executing the jobs of the queue
+    max_threads = 10
+
+    # "thread" or "process", see run_process_job
+    executor = "thread"
+
+    # autoscaling options of the queue, None if its number of threads is
+    # fixed. See autoscaler.py
+    autoscale = None
+
+    # jobs scheduled while executing a job in a worker process, which are
+    # forwarded to the parent process to be scheduled there. None if this is
+    # not a worker process executing a job
+    _forwarded = None
+
     logger = logging.getLogger('fscheduler')
 
-    def __init__(self, **options):
-        from .app import app
+    # thread writing the activity log, see start_activity_log
+    _activity_listener = None
 
-        if len(FScheduler.logger.handlers) == 0:
-            root_path = app.config.get('ROOT_PATH', "")
-            hdlr = logging.FileHandler(os.path.join(root_path, "activity.json.log"))
-            formatter = logging.Formatter('{"time": "%(asctime)s", "activity":%(message)s}')
-            hdlr.setFormatter(formatter)
-            FScheduler.logger.propagate = False
-            FScheduler.logger.addHandler(hdlr)
-            FScheduler.logger.setLevel(logging.DEBUG)
+    def __init__(self, **options):
+        FScheduler.logger.propagate = False
+        FScheduler.logger.setLevel(logging.DEBUG)
 
         super(FScheduler, self).__init__(**options)
         self.add_listener(self)
 
+    @staticmethod
+    def start_activity_log():
+        '''
+        Starts writing the activity log of the schedulers in
+        activity.json.log. The records are written by a QueueListener thread,
+        and the log is rotated by size, or by time if ACTIVITY_LOG_ROTATE_WHEN
+        is set, compressing the old segments.
+
+        Only the process running the schedulers writes the activity log, so
+        that the command line processes don't rotate it.
+        '''
+        from .app import app
+
+        if FScheduler._activity_listener is not None:
+            return
+
+        path = os.path.join(app.config.get('ROOT_PATH', ""), "activity.json.log")
+        backup_count = app.config.get('ACTIVITY_LOG_BACKUP_COUNT', 10)
+        when = app.config.get('ACTIVITY_LOG_ROTATE_WHEN', None)
+        if when:
+            hdlr = logging.handlers.TimedRotatingFileHandler(
+                path, when=when, backupCount=backup_count, utc=True)
+        else:
+            hdlr = logging.handlers.RotatingFileHandler(
+                path, maxBytes=app.config.get('ACTIVITY_LOG_MAX_BYTES', 0),
+                backupCount=backup_count)
+        if app.config.get('ACTIVITY_LOG_COMPRESS', True):
+            hdlr.rotator = compress_rotated_log
+            hdlr.namer = lambda name: name + ".gz"
+        hdlr.setFormatter(ActivityFormatter())
+
+        records = queue.SimpleQueue()
+        FScheduler.logger.addHandler(ActivityQueueHandler(
+            records, app.config.get('ACTIVITY_LOG_DEBUG_SAMPLE_RATE', 1.0)))
+        FScheduler._activity_listener = logging.handlers.QueueListener(
+            records, hdlr)
+        FScheduler._activity_listener.start()
+        atexit.register(FScheduler._activity_listener.stop)
+
     @staticmethod
     def get_scheduler(queue_name):
         '''
         returns a scheduler for a spefic queue name
         '''
-        from .app import app
-        from .utils import dumps
         if queue_name in FScheduler._schedulers:
             return FScheduler._schedulers[queue_name]
 
+        FScheduler._schedulers[queue_name] = sched = FScheduler()
+        sched.queue_name = queue_name
+        sched.configure_queue()
+        FScheduler.logger.info({"action": "CREATE_QUEUE", "queue": queue_name})
+        return sched
+
+    def configure_queue(self):
+        '''
+        Configures the executor of the scheduler with the QUEUES_OPTIONS of
+        its queue. Can only be done when the scheduler isn't running.
+        '''
+        from .app import app
+
         options = {}
         queues_opts = app.config.get('QUEUES_OPTIONS', dict())
-        opts = queues_opts.get(queue_name, dict())
-        if 'max_threads' in opts:
+        opts = queues_opts.get(self.queue_name, dict())
+        setting = INTERNAL_MAX_THREADS_SETTINGS.get(self.queue_name, None)
+        if setting and 'max_threads' not in opts:
+            opts = dict(opts, max_threads=app.config.get(setting,
+                                                         FScheduler.max_threads))
+
+        executor = opts.get('executor', FScheduler.executor)
+        max_threads = opts.get('max_threads', FScheduler.max_threads)
+        if executor == 'process':
+            max_threads = opts.get('max_processes', os.cpu_count() or 1)
             logging.info("setting scheduler for queue %s with "\
-                "max_threads = %d " %(queue_name, opts['max_threads']))
+                "max_processes = %d " %(self.queue_name, max_threads))
+            options['apscheduler.executors.default'] = {
+                'class': 'apscheduler.executors.pool:ProcessPoolExecutor',
+                'max_workers': max_threads,
+            }
+        else:
+            if 'max_threads' in opts:
+                logging.info("setting scheduler for queue %s with "\
+                    "max_threads = %d " %(self.queue_name, opts['max_threads']))
             options['apscheduler.executors.default'] = {
-                'class': 'apscheduler.executors.pool:ThreadPoolExecutor',
-                'max_workers': opts['max_threads'],
+                'class': 'frestq.fscheduler:PriorityThreadPoolExecutor',
+                'max_workers': max_threads,
             }
 
-        FScheduler._schedulers[queue_name] = sched = FScheduler(gconfig=options)
-        sched.queue_name = queue_name
-        FScheduler.logger.info(dumps({"action": "CREATE_QUEUE", "queue": queue_name}))
-        return sched
+        self.configure(gconfig=options)
+        self.executor = executor
+        self.max_threads = max_threads
+        self.autoscale = opts.get('autoscale', None)\
+            if executor != 'process' else None
+
+    def log_max_threads(self):
+        FScheduler.logger.info({"action": "SET_QUEUE_MAX",
+                                "queue": self.queue_name,
+                                "max": self.max_threads})
+
+    def set_max_threads(self, max_threads):
+        '''
+        Changes the number of threads of the queue while it's running.
+        Returns False if it can't be changed because the queue uses the
+        "process" executor.
+        '''
+        from .ready_queue import ReadyQueue
+
+        executor = self._executors.get('default', None)
+        if not isinstance(executor, PriorityThreadPoolExecutor):
+            return False
+
+        executor.resize(max_threads)
+        if executor.max_workers != self.max_threads:
+            logging.info("setting scheduler for queue %s with "\
+                "max_threads = %d " %(self.queue_name, executor.max_workers))
+            self.max_threads = executor.max_workers
+            self.log_max_threads()
+
+            # the ready queue claims jobs for the free threads of the queue
+            ReadyQueue._wakeup.set()
+        return True
 
     @staticmethod
     def reserve_scheduler(queue_name):
@@ -105,91 +483,251 @@ class FScheduler(Scheduler):
         because in frestq the app config is not guaranteed to be completely
         setup until this moment.
         '''
-        from .utils import dumps
-
-        FScheduler.logger.info(dumps({"action": "START"}))
-        FScheduler.reserve_scheduler(INTERNAL_SCHEDULER_NAME)
+        FScheduler.start_activity_log()
+        FScheduler.logger.info({"action": "START"})
+        for queue_name in INTERNAL_MAX_THREADS_SETTINGS:
+            FScheduler.reserve_scheduler(queue_name)
 
         for queue_name, sched in FScheduler._schedulers.items():
             logging.info("starting %s scheduler" % queue_name)
+            sched.configure_queue()
+            sched.log_max_threads()
             sched.start()
 
+    def get_stats(self):
+        '''
+        Returns the saturation statistics of the executor of the queue. Only
+        the thread executor keeps them, for the "process" executor only the
+        number of processes is returned.
+        '''
+        executor = self._executors.get('default', None)
+        if isinstance(executor, PriorityThreadPoolExecutor):
+            stats = executor.get_stats()
+        else:
+            stats = dict(max_workers=self.max_threads)
+        stats['executor'] = self.executor
+        return stats
+
+    @staticmethod
+    def get_all_stats():
+        '''
+        Returns the statistics of all the queues, by queue name
+        '''
+        return dict(
+            (queue_name, sched.get_stats())
+            for queue_name, sched in list(FScheduler._schedulers.items()))
+
     def __call__(self, event):
-        from .utils import dumps
-        def decode(code):
-            if isinstance(code, int):
-                for key, value in EVENT_IDS.items():
-                    if value == code:
-                        return key
-            return code
+        if self.executor == 'process' and event.code == EVENT_JOB_EXECUTED\
+                and event.retval:
+            schedule_forwarded_jobs(event.retval)
 
-        d = {"action": decode(event.code), "queue": self.queue_name}
+        if isinstance(event, JobExecutionEvent):
+            result = {EVENT_JOB_EXECUTED: "executed", EVENT_JOB_ERROR: "error",
+                      EVENT_JOB_MISSED: "missed"}.get(event.code, None)
+            if result:
+                JOBS_FINISHED.inc(queue=self.queue_name, result=result)
+
+        d = {"action": EVENT_NAMES.get(event.code, event.code),
+             "queue": self.queue_name}
 
         if isinstance(event, JobExecutionEvent):
             d["scheduled_run_time"] = event.scheduled_run_time
             d["retval"] = event.retval
-            d["exception"] = event.exception
+            d["exception"] = repr(event.exception)\
+                if event.exception is not None else None
             d["traceback"] = event.traceback
-        elif isinstance(event, JobEvent):
-            if event.code in [EVENT_JOBSTORE_ADDED, EVENT_JOBSTORE_REMOVED]:
-                d["alias"] = event.alias
-
-        if hasattr(event, "job"):
-            d['job_name'] = event.job.name
-            if callable(event.job.func) and hasattr(event.job.func, "__name__"):
-                d['func_name'] = event.job.func.__name__
-
-        FScheduler.logger.info(dumps(d))
-
-    def add_now_job(self, func, args=None, kwargs=None, **options):
+        elif event.code in [EVENT_JOBSTORE_ADDED, EVENT_JOBSTORE_REMOVED]:
+            d["alias"] = event.alias
+
+        if isinstance(event, JobEvent):
+            d['job_id'] = event.job_id
+
+        if event.code == EVENT_JOB_ADDED:
+            # the other job events only have the id of the job
+            job = self.get_job(event.job_id)
+            if job is not None:
+                d['job_name'] = job.name
+                d['func_name'] = getattr(job.func, '__name__', None)
+
+        if event.code in [EVENT_JOB_ERROR, EVENT_JOB_MISSED]:
+            level = logging.WARNING
+        elif isinstance(event, JobEvent) and\
+                event.code not in ACTIVITY_JOB_EVENTS:
+            level = logging.DEBUG
+        else:
+            level = logging.INFO
+        FScheduler.logger.log(level, d)
+
+    def add_now_job(self, func, args=None, kwargs=None, priority=0,
+                    fair_key=None, **options):
         """
         Schedules a job to be completed as soon as possible.
         Any extra keyword arguments are passed along to the constructor of the
         :class:`~apscheduler.job.Job` class (see :ref:`job_options`).
 
         :param func: callable to run at the given time
+        :param priority: jobs with higher priority are executed first
+        :param fair_key: jobs with the same priority are executed in turns by
+            fair_key, usually the id of the parent task
         :param name: name of the job
         :param jobstore: stored the job in the named (or given) job store
         :param misfire_grace_time: seconds after the designated run time that
             the job is still allowed to be run
         :type date: :class:`datetime.date`
         :rtype: :class:`~apscheduler.job.Job`
+
+        If READY_QUEUE is enabled, the job is instead inserted in the ready
+        queue of the database in the current transaction, and executed by any
+        of the frestq processes sharing the database once it's committed. In
+        that case None is returned. See ready_queue.py for details.
         """
-        from .app import db
+        from .ready_queue import ReadyQueue
 
+        if not options and ReadyQueue.handles(self.queue_name, func):
+            ReadyQueue.add(self.queue_name, func, args, kwargs, priority,
+                           fair_key)
+            return None
+
+        if FScheduler._forwarded is not None:
+            return self._forward('now', func, args, kwargs,
+                                 dict(options, priority=priority,
+                                      fair_key=fair_key))
+
+        return self.add_local_job(func, args, kwargs, priority, fair_key,
+                                  **options)
+
+    def _forward(self, kind, func, args, kwargs, options):
+        '''
+        Records a job scheduled in a worker process, to be scheduled by the
+        parent process with add_<kind>_job() when the running job finishes
+        '''
+        FScheduler._forwarded.append(dict(
+            queue_name=self.queue_name,
+            kind=kind,
+            func=obj_to_ref(func),
+            args=list(args or []),
+            kwargs=dict(kwargs or {}),
+            options=options))
+        return None
+
+    def add_local_job(self, func, args=None, kwargs=None, priority=0,
+                      fair_key=None, **options):
+        """
+        Schedules a job to be completed as soon as possible by this process,
+        in memory. See add_now_job.
+        """
         logging.info("adding job in sched for queue %s" % self.queue_name)
         trigger = NowTrigger()
 
         # autocommit to avoid dangling sessions
-        def autocommit_wrapper(*args, **kwargs2):
-            try:
-              func(*args, **kwargs2)
-              db.session.commit()
-            except exc.SQLAlchemyError:
-              import traceback; traceback.print_exc()
-              logging.info("SQLAlchemy exception, doing a rollback for recovery.")
-              db.session.rollback()
-
-        autocommit_wrapper.__name__ = func.__name__
+        autocommit_wrapper = autocommit(func)
+        autocommit_wrapper.priority = priority
+        autocommit_wrapper.fair_key = fair_key
 
         if 'misfire_grace_time' not in options:
             # default to misfire_grace_time of 24 hours!
             options['misfire_grace_time'] = 3600*24
 
+        if self.executor == 'process':
+            return self.add_job(run_process_job,
+                                args=[obj_to_ref(func), args, kwargs],
+                                **options)
+
         return self.add_job(autocommit_wrapper, args=args, kwargs=kwargs,
                             **options)
 
-    def add_date_job(self, func, date, args=None, kwargs=None, **options):
-        from .app import db
+    def add_date_job(self, func, date, args=None, kwargs=None, priority=0,
+                     fair_key=None, **options):
+        if FScheduler._forwarded is not None:
+            return self._forward('date', func, args, kwargs,
+                                 dict(options, date=date, priority=priority,
+                                      fair_key=fair_key))
 
-        # autocommit to avoid dangling sessions
-        def autocommit_wrapper(*args, **kwargs2):
-            func(*args, **kwargs2)
-            db.session.commit()
+        if self.executor == 'process':
+            return super(FScheduler, self).add_job(
+                run_process_job, 'date', [obj_to_ref(func), args, kwargs],
+                run_date=date, **options)
 
-        autocommit_wrapper.__name__ = func.__name__
+        # autocommit to avoid dangling sessions
+        autocommit_wrapper = autocommit(func)
+        autocommit_wrapper.priority = priority
+        autocommit_wrapper.fair_key = fair_key
 
         return super(FScheduler, self).add_job(autocommit_wrapper,
                                                'date', args, kwargs,
                                                run_date=date,
                                                **options)
+
+    def add_interval_job(self, func, args=None, kwargs=None, **options):
+        '''
+        Schedules a job to be run periodically. The interval is given with
+        the weeks, days, hours, minutes or seconds keyword arguments.
+        '''
+        if FScheduler._forwarded is not None:
+            return self._forward('interval', func, args, kwargs, options)
+
+        if self.executor == 'process':
+            return super(FScheduler, self).add_job(
+                run_process_job, 'interval', [obj_to_ref(func), args, kwargs],
+                **options)
+
+        # autocommit to avoid dangling sessions
+        autocommit_wrapper = autocommit(func)
+
+        return super(FScheduler, self).add_job(autocommit_wrapper,
+                                               'interval', args, kwargs,
+                                               **options)
+
+
+# pid of the process whose database engine connections are being used
+_engine_pid = os.getpid()
+
+def run_process_job(func_ref, args, kwargs):
+    '''
+    Executes a job of a queue with the "process" executor in a worker
+    process, so that CPU bound action handlers are not limited by the GIL.
+
+    The worker process is forked from the frestq process, so it uses its own
+    connections to the database and commits its changes there. The jobs it
+    schedules are returned, so that the parent process schedules them when
+    the job finishes (see schedule_forwarded_jobs), as the schedulers only
+    run in the parent process.
+    '''
+    global _engine_pid
+    from .app import db
+
+    if _engine_pid != os.getpid():
+        # do not share with the parent process the connections of the pool
+        db.engine.dispose()
+        _engine_pid = os.getpid()
+
+    FScheduler._forwarded = []
+    try:
+        ref_to_obj(func_ref)(*(args or []), **(kwargs or {}))
+        db.session.commit()
+    except Exception:
+        logging.exception("error executing job %s in a worker process" % (
+            func_ref))
+        db.session.rollback()
+    finally:
+        forwarded = FScheduler._forwarded
+        FScheduler._forwarded = None
+        db.session.remove()
+    return forwarded
+
+def schedule_forwarded_jobs(forwarded):
+    '''
+    Schedules the jobs scheduled by a job executed in a worker process
+    '''
+    from .app import db
+
+    try:
+        for job in forwarded:
+            sched = FScheduler.get_scheduler(job['queue_name'])
+            add_job = getattr(sched, 'add_%s_job' % job['kind'])
+            add_job(ref_to_obj(job['func']), args=job['args'],
+                    kwargs=job['kwargs'], **job['options'])
+        db.session.commit()
+    finally:
+        db.session.remove()
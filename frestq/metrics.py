@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+# SPDX-FileCopyrightText: 2014-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import math
+from bisect import bisect_left
+from threading import Lock
+
+# Metrics of this frestq process, exposed in the Prometheus text format in
+# GET /api/metrics.
+#
+# Counters and histograms are updated where things happen, for example when
+# a message is sent or a job finishes. Values that are already kept somewhere
+# else, like the statistics of the thread pools of the queues, are read when
+# the metrics are requested by the collectors registered with
+# Metrics.add_collector.
+
+# default buckets of the histograms, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                                    .replace('"', '\\"')
+                                    .replace('\n', '\\n'))
+        for key, value in labels)
+
+
+class Metrics(object):
+    '''
+    Registry of the metrics of this process
+    '''
+    _metrics = []
+
+    _collectors = []
+
+    @staticmethod
+    def register(metric):
+        Metrics._metrics.append(metric)
+        return metric
+
+    @staticmethod
+    def add_collector(func):
+        '''
+        Registers a function that returns a list of metrics read when the
+        metrics are requested, as tuples (name, type, help, samples), where
+        samples is a list of (labels dict, value) tuples
+        '''
+        Metrics._collectors.append(func)
+        return func
+
+    @staticmethod
+    def render():
+        '''
+        Returns all the metrics in the Prometheus text format
+        '''
+        lines = []
+        for metric in Metrics._metrics:
+            lines.extend(metric.render())
+        for collector in Metrics._collectors:
+            for name, type_, help_, samples in collector():
+                lines.append("# HELP %s %s" % (name, help_))
+                lines.append("# TYPE %s %s" % (name, type_))
+                for labels, value in samples:
+                    lines.append("%s%s %s" % (
+                        name, format_labels(sorted(labels.items())),
+                        format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class Counter(object):
+    '''
+    Counter with labels. Each combination of labels is a different counter.
+    '''
+    type_ = "counter"
+
+    def __init__(self, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self._values = dict()
+        self._lock = Lock()
+        Metrics.register(self)
+
+    def _key(self, labels):
+        return tuple((name, labels[name]) for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value)
+                    for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.type_)]
+        for name, key, value in self.samples():
+            lines.append("%s%s %s" % (name, format_labels(key),
+                                      format_value(value)))
+        return lines
+
+
+class Histogram(Counter):
+    '''
+    Histogram with labels, counting the observed values in cumulative
+    buckets of upper bounds
+    '''
+    type_ = "histogram"
+
+    def __init__(self, name, help_, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key, None)
+            if counts is None:
+                # counts by bucket and sum of the values
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0]
+            counts[0][bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                accumulated = 0
+                for bound, count in zip(self.buckets, counts):
+                    accumulated += count
+                    samples.append((self.name + "_bucket",
+                                    key + (("le", format_value(bound)),),
+                                    accumulated))
+                samples.append((self.name + "_sum", key, total))
+                samples.append((self.name + "_count", key, accumulated))
+        return samples
+
+
+JOB_LATENCY = Histogram(
+    "frestq_job_latency_seconds",
+    "Time from the scheduled run time of a job until a thread started "
+    "executing it. Not measured in the queues with the process executor",
+    ["queue"])
+
+JOBS_FINISHED = Counter(
+    "frestq_jobs_finished_total",
+    "Jobs finished, by queue and result (executed, error or missed)",
+    ["queue", "result"])
+
+HANDLER_DURATION = Histogram(
+    "frestq_handler_duration_seconds",
+    "Duration of the execution of the action handlers",
+    ["queue", "action"])
+
+MESSAGES_RECEIVED = Counter(
+    "frestq_messages_received_total",
+    "Messages received, by queue",
+    ["queue"])
+
+SEND_DURATION = Histogram(
+    "frestq_send_duration_seconds",
+    "Duration of the requests sending messages to other peers, by peer and "
+    "HTTP status code (\"error\" if the request failed)",
+    ["peer", "status"])
+
+TASK_TRANSITIONS = Counter(
+    "frestq_task_status_transitions_total",
+    "Changes of the status of the tasks",
+    ["from_status", "to_status"])
+
+
+@Metrics.add_collector
+def collect_queues():
+    '''
+    Metrics of the thread pools of the queues, see FScheduler.get_stats
+    '''
+    from .fscheduler import FScheduler
+
+    metrics = [
+        ("frestq_queue_max_threads", "gauge", "Threads of the queue",
+         "max_workers"),
+        ("frestq_queue_busy_threads", "gauge", "Threads executing jobs",
+         "busy"),
+        ("frestq_queue_waiting_jobs", "gauge", "Jobs waiting for a thread",
+         "waiting"),
+        ("frestq_queue_jobs_submitted_total", "counter",
+         "Jobs submitted to the thread pool", "submitted"),
+        ("frestq_queue_jobs_delayed_total", "counter",
+         "Jobs that waited because all the threads were busy", "delayed"),
+    ]
+    stats = FScheduler.get_all_stats()
+    return [
+        (name, type_, help_, [
+            (dict(queue=queue_name), queue_stats[key])
+            for queue_name, queue_stats in sorted(stats.items())
+            if key in queue_stats
+        ])
+        for name, type_, help_, key in metrics
+    ]
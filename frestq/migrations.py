@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+# SPDX-FileCopyrightText: 2014-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import logging
+
+import OpenSSL
+import sqlalchemy
+
+from .app import db
+from .models import SchemaMigration
+
+# ordered list of (name, function) schema migrations
+_migrations = []
+
+def migration(name):
+    '''
+    Decorator that registers a schema migration. Migrations are applied in
+    the order they are registered, and only once.
+    '''
+    def decorator(func):
+        _migrations.append((name, func))
+        return func
+    return decorator
+
+def get_columns(table_name):
+    '''
+    Returns the names of the columns of a table in the database
+    '''
+    inspector = sqlalchemy.inspect(db.engine)
+    return [column['name'] for column in inspector.get_columns(table_name)]
+
+def add_column(table_name, column):
+    '''
+    Adds a column to a table in the database if it doesn't exist yet. The
+    column must be a column of one of the models.
+    '''
+    if column.name in get_columns(table_name):
+        return
+
+    column_type = column.type.compile(dialect=db.engine.dialect)
+    logging.info("adding column %s.%s" % (table_name, column.name))
+    db.session.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+        table_name,
+        db.engine.dialect.identifier_preparer.quote(column.name),
+        column_type))
+
+def get_indexes(table_name):
+    '''
+    Returns the names of the indexes of a table in the database
+    '''
+    inspector = sqlalchemy.inspect(db.engine)
+    return [index['name'] for index in inspector.get_indexes(table_name)]
+
+def create_indexes(model):
+    '''
+    Creates the indexes of a model that don't exist yet in the database
+    '''
+    existing = get_indexes(model.__tablename__)
+    for index in model.__table__.indexes:
+        if index.name in existing:
+            continue
+        logging.info("creating index %s" % index.name)
+        index.create(bind=db.session.connection())
+
+def drop_column(table_name, column_name):
+    '''
+    Drops a column of a table in the database if it exists
+    '''
+    if column_name not in get_columns(table_name):
+        return
+
+    logging.info("dropping column %s.%s" % (table_name, column_name))
+    db.session.execute('ALTER TABLE %s DROP COLUMN %s' % (
+        table_name,
+        db.engine.dialect.identifier_preparer.quote(column_name)))
+
+def create_db():
+    '''
+    Creates the database. As it's created with the latest schema, all the
+    migrations are marked as already applied.
+    '''
+    db.create_all()
+    for name, func in _migrations:
+        if not SchemaMigration.query.get(name):
+            db.session.add(SchemaMigration(name=name))
+    db.session.commit()
+
+def upgrade_db():
+    '''
+    Upgrades the schema of an existing database, creating any missing table
+    and applying the pending migrations.
+    '''
+    db.create_all()
+    applied = set(migration.name for migration in SchemaMigration.query)
+    for name, func in _migrations:
+        if name in applied:
+            continue
+        print("applying migration %s" % name)
+        func()
+        db.session.add(SchemaMigration(name=name))
+        db.session.commit()
+
+@migration("0001_message_outbox")
+def message_outbox():
+    from .models import Message
+    for column in ['send_status', 'send_attempts', 'next_send_date',
+                   'send_error', 'update_task_receiver_ssl_cert']:
+        add_column('message', Message.__table__.columns[column])
+
+@migration("0002_certificate_storage")
+def certificate_storage():
+    '''
+    Moves the PEM certificates stored in each message and task row to the
+    certificate table, referencing them by fingerprint.
+    '''
+    from .models import Certificate, Message, Task
+    for model in [Message, Task]:
+        table_name = model.__tablename__
+        for column in ['sender_ssl_cert_id', 'receiver_ssl_cert_id']:
+            add_column(table_name, model.__table__.columns[column])
+
+        legacy_columns = get_columns(table_name)
+        for column in ['sender_ssl_cert', 'receiver_ssl_cert']:
+            if column not in legacy_columns:
+                continue
+
+            pems = db.session.execute(
+                'SELECT DISTINCT %s FROM %s WHERE %s IS NOT NULL' % (
+                    column, table_name, column)).fetchall()
+            invalid = 0
+            for pem, in pems:
+                if not pem:
+                    continue
+                try:
+                    fingerprint = Certificate.register(pem)
+                except OpenSSL.crypto.Error:
+                    invalid += 1
+                    continue
+                db.session.execute(
+                    sqlalchemy.text(
+                        'UPDATE %s SET %s_id = :fingerprint WHERE %s = :pem' % (
+                            table_name, column, column)),
+                    dict(fingerprint=fingerprint, pem=pem))
+
+            # the legacy column is kept if it has certificates that couldn't
+            # be moved, so that they are not lost
+            if invalid:
+                logging.error("%d invalid certificates in %s.%s, keeping the "\
+                    "column" % (invalid, table_name, column))
+                continue
+            drop_column(table_name, column)
+
+@migration("0003_task_message_indexes")
+def task_message_indexes():
+    from .models import Message, Task, id_pattern_index_ddl
+    for model in [Message, Task]:
+        create_indexes(model)
+        if "ix_%s_id_pattern" % model.__tablename__ not in\
+                get_indexes(model.__tablename__):
+            id_pattern_index_ddl(model.__tablename__)(
+                model.__table__, db.session.connection())
+
+@migration("0004_subtask_counters")
+def subtask_counters():
+    '''
+    Adds the subtask counters to the tasks, and initializes them counting the
+    subtasks of each task
+    '''
+    from .models import Task
+    for column in ['num_subtasks', 'num_finished_subtasks',
+                   'num_errored_subtasks', 'counted_status']:
+        add_column('task', Task.__table__.columns[column])
+
+    # the subtasks are counted with a single query and then set per parent
+    # task, because MySQL doesn't allow a subquery on the table being updated
+    db.session.execute('''
+        UPDATE task SET
+            counted_status = status,
+            num_subtasks = 0,
+            num_finished_subtasks = 0,
+            num_errored_subtasks = 0
+    ''')
+    counts = db.session.execute('''
+        SELECT
+            parent_id,
+            COUNT(*),
+            SUM(CASE WHEN status = 'finished' THEN 1 ELSE 0 END),
+            SUM(CASE WHEN status = 'error' THEN 1 ELSE 0 END)
+        FROM task
+        WHERE parent_id IS NOT NULL
+        GROUP BY parent_id
+    ''').fetchall()
+    if counts:
+        db.session.execute(
+            sqlalchemy.text('''
+                UPDATE task SET
+                    num_subtasks = :num_subtasks,
+                    num_finished_subtasks = :num_finished_subtasks,
+                    num_errored_subtasks = :num_errored_subtasks
+                WHERE id = :id
+            '''),
+            [
+                dict(id=parent_id, num_subtasks=num_subtasks,
+                     num_finished_subtasks=num_finished,
+                     num_errored_subtasks=num_errored)
+                for parent_id, num_subtasks, num_finished, num_errored
+                in counts
+            ])
+
+@migration("0005_priorities")
+def priorities():
+    '''
+    Adds the priority of messages, tasks and ready jobs
+    '''
+    from .models import Message, Task, ReadyJob
+    for model in [Message, Task]:
+        add_column(model.__tablename__, model.__table__.columns['priority'])
+    for column in ['priority', 'fair_key']:
+        add_column('ready_job', ReadyJob.__table__.columns[column])
+    db.session.execute('UPDATE ready_job SET priority = 0')
+
+@migration("0006_ready_job_attempts")
+def ready_job_attempts():
+    from .models import ReadyJob
+    add_column('ready_job', ReadyJob.__table__.columns['attempts'])
+    db.session.execute('UPDATE ready_job SET attempts = 0')
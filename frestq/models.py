@@ -6,7 +6,9 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import json
+from collections import OrderedDict
 from datetime import datetime
+from threading import Lock
 
 import sqlalchemy
 from sqlalchemy.ext.mutable import Mutable
@@ -15,32 +17,76 @@ from flask import Flask, jsonify
 from flask_sqlalchemy import SQLAlchemy
 
 from .app import db
-from .utils import dumps, loads
+from .blobs import dump_blobs, load_blobs
+from .utils import loads, cert_fingerprint
 
 
 class JSONEncodedDict(TypeDecorator):
+    '''
+    Json column. Big values are stored in the blob store, see blobs.py
+    '''
     impl = UnicodeText
 
     def process_bind_param(self, value, dialect):
         if value is None:
             return None
-        return dumps(value)
+        return dump_blobs(value)
 
     def process_result_value(self, value, dialect):
         if not value:
             return None
-        return loads(value)
+        return load_blobs(loads(value))
 
 
 class MutationObj(Mutable):
+    '''
+    Tracks the changes of the values of the json columns. Only the top level
+    dict or list is wrapped when a column is loaded or set. Nested dicts and
+    lists are wrapped when they are accessed by key or index through their
+    container, and notify their changes through it, so that loading a big
+    value does not build a copy of it.
+
+    Changes to nested values obtained otherwise, for example iterating a list
+    or the items() of a dict, are not tracked. In that case set the column
+    again or call flag_modified().
+    '''
+    # the MutationObj that contains this one, if it's nested
+    _container = None
+
+    _key = None
+
     @classmethod
     def coerce(cls, key, value):
-        if isinstance(value, dict) and not isinstance(value, MutationDict):
+        if isinstance(value, dict) and (not isinstance(value, MutationDict) or
+                                        value._container is not None):
             return MutationDict.coerce(key, value)
-        if isinstance(value, list) and not isinstance(value, MutationList):
+        if isinstance(value, list) and (not isinstance(value, MutationList) or
+                                        value._container is not None):
             return MutationList.coerce(key, value)
         return value
 
+    def _wrap(self, value):
+        '''
+        Returns a nested value, wrapped if it's a dict or a list so that its
+        changes are tracked
+        '''
+        if not isinstance(value, (dict, list)) or\
+                getattr(value, '_container', None) is self:
+            return value
+        if isinstance(value, dict):
+            wrapped = MutationDict(value)
+        else:
+            wrapped = MutationList(value)
+        wrapped._key = self._key
+        wrapped._container = self
+        return wrapped
+
+    def changed(self):
+        if self._container is not None:
+            self._container.changed()
+        else:
+            super(MutationObj, self).changed()
+
     @classmethod
     def _listen_on_attribute(cls, attribute, coerce, parent_cls):
         key = attribute.key
@@ -51,13 +97,23 @@ class MutationObj(Mutable):
         parent_cls = attribute.class_
 
         def load(state, *args):
-            val = state.dict.get(key, None)
+            # the attribute is not in the dict if it's not loaded, for example
+            # if it's deferred
+            if key not in state.dict:
+                return
+            val = state.dict[key]
             if coerce:
                 val = cls.coerce(key, val)
                 state.dict[key] = val
             if isinstance(val, cls):
                 val._parents[state.obj()] = key
 
+        def load_attrs(state, context, attrs):
+            # attrs are the refreshed attributes, for example a deferred
+            # attribute loaded when it's accessed, or None for all of them
+            if not attrs or key in attrs:
+                load(state)
+
         def set(target, value, oldvalue, initiator):
             if not isinstance(value, cls):
                 value = cls.coerce(key, value)
@@ -80,7 +136,7 @@ class MutationObj(Mutable):
                     val._parents[state.obj()] = key
 
         sqlalchemy.event.listen(parent_cls, 'load', load, raw=True, propagate=True)
-        sqlalchemy.event.listen(parent_cls, 'refresh', load, raw=True, propagate=True)
+        sqlalchemy.event.listen(parent_cls, 'refresh', load_attrs, raw=True, propagate=True)
         sqlalchemy.event.listen(attribute, 'set', set, raw=True, retval=True, propagate=True)
         sqlalchemy.event.listen(parent_cls, 'pickle', pickle, raw=True, propagate=True)
         sqlalchemy.event.listen(parent_cls, 'unpickle', unpickle, raw=True, propagate=True)
@@ -89,52 +145,93 @@ class MutationDict(MutationObj, dict):
     @classmethod
     def coerce(cls, key, value):
         """Convert plain dictionary to MutationDict"""
-        self = MutationDict((k,MutationObj.coerce(key,v)) for (k,v) in value.items())
+        self = MutationDict(value)
         self._key = key
         return self
 
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        wrapped = self._wrap(value)
+        if wrapped is not value:
+            dict.__setitem__(self, key, wrapped)
+        return wrapped
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
     def __setitem__(self, key, value):
-        dict.__setitem__(self, key, MutationObj.coerce(self._key, value))
+        dict.__setitem__(self, key, value)
         self.changed()
 
     def __delitem__(self, key):
         dict.__delitem__(self, key)
         self.changed()
 
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.changed()
+
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self.changed()
+        return value
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self.changed()
+        return item
+
+    def clear(self):
+        dict.clear(self)
+        self.changed()
+
 class MutationList(MutationObj, list):
     @classmethod
     def coerce(cls, key, value):
         """Convert plain list to MutationList"""
-        self = MutationList((MutationObj.coerce(key, v) for v in value))
+        self = MutationList(value)
         self._key = key
         return self
 
-    def __setitem__(self, idx, value):
-        list.__setitem__(self, idx, MutationObj.coerce(self._key, value))
-        self.changed()
+    def __getitem__(self, idx):
+        value = list.__getitem__(self, idx)
+        if isinstance(idx, slice):
+            return value
+        wrapped = self._wrap(value)
+        if wrapped is not value:
+            list.__setitem__(self, idx, wrapped)
+        return wrapped
 
-    def __setslice__(self, start, stop, values):
-        list.__setslice__(self, start, stop, (MutationObj.coerce(self._key, v) for v in values))
+    def __setitem__(self, idx, value):
+        list.__setitem__(self, idx, value)
         self.changed()
 
     def __delitem__(self, idx):
         list.__delitem__(self, idx)
         self.changed()
 
-    def __delslice__(self, start, stop):
-        list.__delslice__(self, start, stop)
+    def __iadd__(self, values):
+        list.extend(self, values)
         self.changed()
+        return self
 
     def append(self, value):
-        list.append(self, MutationObj.coerce(self._key, value))
+        list.append(self, value)
         self.changed()
 
     def insert(self, idx, value):
-        list.insert(self, idx, MutationObj.coerce(self._key, value))
+        list.insert(self, idx, value)
         self.changed()
 
     def extend(self, values):
-        list.extend(self, (MutationObj.coerce(self._key, v) for v in values))
+        list.extend(self, values)
         self.changed()
 
     def pop(self, *args, **kw):
@@ -146,14 +243,187 @@ class MutationList(MutationObj, list):
         list.remove(self, value)
         self.changed()
 
+    def clear(self):
+        list.clear(self)
+        self.changed()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self.changed()
+
 MutationObj.associate_with(JSONEncodedDict)
 
-class Message(db.Model):
+class Certificate(db.Model):
+    '''
+    Represents a peer SSL certificate. There are only a few distinct
+    certificates, so messages and tasks reference them by fingerprint instead
+    of storing the PEM text in each row.
+    '''
+    __tablename__ = 'certificate'
+
+    # SHA-256 fingerprint of the certificate, see utils.cert_fingerprint
+    fingerprint = db.Column(db.Unicode(64), primary_key=True)
+
+    pem = db.Column(db.UnicodeText)
+
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # certificates are immutable, so we cache the PEM of the certificates
+    # already seen by fingerprint. When full, the least recently used one is
+    # evicted
+    _pems = OrderedDict()
+
+    _max_cached = 1024
+
+    _lock = Lock()
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<Certificate %r>' % self.fingerprint
+
+    @staticmethod
+    def _cache(fingerprint, pem):
+        with Certificate._lock:
+            Certificate._pems[fingerprint] = pem
+            Certificate._pems.move_to_end(fingerprint)
+            if len(Certificate._pems) > Certificate._max_cached:
+                Certificate._pems.popitem(last=False)
+
+    @staticmethod
+    def _cached(fingerprint):
+        '''
+        Returns the cached PEM of a certificate, or None
+        '''
+        with Certificate._lock:
+            pem = Certificate._pems.get(fingerprint, None)
+            if pem is not None:
+                Certificate._pems.move_to_end(fingerprint)
+            return pem
+
+    @staticmethod
+    def register(pem):
+        '''
+        Stores a PEM certificate if it wasn't already stored, and returns its
+        fingerprint. Returns None if there's no certificate.
+
+        The certificate is inserted in the current transaction, ignoring it if
+        it already exists, so that concurrent registrations of the same
+        certificate do not fail.
+        '''
+        if not pem:
+            return None
+
+        fingerprint = cert_fingerprint(pem)
+        if Certificate._cached(fingerprint) is not None:
+            return fingerprint
+
+        values = dict(fingerprint=fingerprint, pem=pem,
+                      created_date=datetime.utcnow())
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(Certificate.__table__).values(**values)\
+                .on_conflict_do_nothing(index_elements=['fingerprint'])
+        elif dialect == 'sqlite':
+            stmt = Certificate.__table__.insert().values(**values)\
+                .prefix_with('OR IGNORE')
+        elif dialect == 'mysql':
+            stmt = Certificate.__table__.insert().values(**values)\
+                .prefix_with('IGNORE')
+        else:
+            if db.session.query(Certificate).get(fingerprint) is None:
+                db.session.add(Certificate(**values))
+            stmt = None
+
+        if stmt is not None:
+            db.session.execute(stmt)
+
+        # only cache it once it's committed, so that it's not assumed to be
+        # stored if the transaction is rolled back
+        db.session.info.setdefault('frestq_new_certificates', dict())\
+            [fingerprint] = pem
+        return fingerprint
+
+    @staticmethod
+    def get_pem(fingerprint):
+        '''
+        Returns the PEM text of the certificate with the given fingerprint
+        '''
+        if fingerprint is None:
+            return None
+
+        pem = Certificate._cached(fingerprint)
+        if pem is not None:
+            return pem
+
+        pem = db.session.query(Certificate.pem)\
+            .filter(Certificate.fingerprint == fingerprint)\
+            .scalar()
+        if pem is not None:
+            Certificate._cache(fingerprint, pem)
+        return pem
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_commit')
+def cache_new_certificates(session):
+    for fingerprint, pem in session.info.pop('frestq_new_certificates',
+                                             dict()).items():
+        Certificate._cache(fingerprint, pem)
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_rollback')
+def forget_new_certificates(session):
+    session.info.pop('frestq_new_certificates', None)
+
+
+class SSLCertificatesMixin(object):
+    '''
+    Stores the sender and receiver SSL certificates of a message or a task as
+    references to the certificate table. sender_ssl_cert and
+    receiver_ssl_cert are kept as properties that get and set the PEM text.
+    '''
+    sender_ssl_cert_id = db.Column(db.Unicode(64))
+
+    receiver_ssl_cert_id = db.Column(db.Unicode(64))
+
+    @property
+    def sender_ssl_cert(self):
+        return Certificate.get_pem(self.sender_ssl_cert_id)
+
+    @sender_ssl_cert.setter
+    def sender_ssl_cert(self, pem):
+        self.sender_ssl_cert_id = Certificate.register(pem)
+
+    @property
+    def receiver_ssl_cert(self):
+        return Certificate.get_pem(self.receiver_ssl_cert_id)
+
+    @receiver_ssl_cert.setter
+    def receiver_ssl_cert(self, pem):
+        self.receiver_ssl_cert_id = Certificate.register(pem)
+
+
+class Message(SSLCertificatesMixin, db.Model):
     '''
     Represents an election
     '''
     __tablename__ = 'message'
 
+    __table_args__ = (
+        db.Index('ix_message_task_id', 'task_id'),
+        db.Index('ix_message_created_date', 'created_date'),
+        # used by the outbox to find due messages
+        db.Index('ix_message_send_status_next_send_date',
+                 'send_status', 'next_send_date'),
+    )
+
     id = db.Column(db.Unicode(128), primary_key=True)
 
     sender_url = db.Column(db.Unicode(1024))
@@ -164,15 +434,12 @@ class Message(db.Model):
 
     receiver_url = db.Column(db.Unicode(1024))
 
-    sender_ssl_cert = db.Column(db.UnicodeText)
-
-    receiver_ssl_cert = db.Column(db.UnicodeText)
-
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
 
     action = db.Column(db.Unicode(1024))
 
-    input_data = db.Column(JSONEncodedDict)
+    # deferred, so that it's only loaded and decoded when it's accessed
+    input_data = db.deferred(db.Column(JSONEncodedDict))
 
     output_status = db.Column(db.Integer)
 
@@ -188,6 +455,25 @@ class Message(db.Model):
     #    backref=db.backref('messages', lazy='dynamic'))
     task_id = db.Column(db.Unicode(128))
 
+    # outbox delivery state of sent messages. It can be "pending", "sending",
+    # "sent" or "dead" (delivery failed and it won't be retried). It's None
+    # for received messages.
+    send_status = db.Column(db.Unicode(64))
+
+    send_attempts = db.Column(db.Integer, default=0)
+
+    next_send_date = db.Column(db.DateTime, default=None)
+
+    send_error = db.Column(db.UnicodeText)
+
+    # whether to set the receiver certificate of the task once delivered
+    update_task_receiver_ssl_cert = db.Column(db.Boolean, default=False)
+
+    # priority of the call to the action handler of the message, see
+    # fscheduler.PriorityThreadPoolExecutor. None to use the priority of the
+    # action handler
+    priority = db.Column(db.Integer, default=None)
+
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -214,22 +500,36 @@ class Message(db.Model):
             'pingback_date': self.pingback_date,
             'expiration_date': self.expiration_date,
             'info_text': self.info_text,
+            'priority': self.priority,
+            'send_status': self.send_status,
+            'send_attempts': self.send_attempts,
+            'next_send_date': self.next_send_date,
+            'send_error': self.send_error,
         }
 
         if full:
-            ret['task'] = self.task.to_dict()
+            task = db.session.query(Task).get(self.task_id)
+            ret['task'] = task.to_dict() if task else None
         else:
-            ret['task_id'] = self.task.id
+            ret['task_id'] = self.task_id
 
         return ret
 
 
-class Task(db.Model):
+class Task(SSLCertificatesMixin, db.Model):
     '''
     Represents a task
     '''
     __tablename__ = 'task'
 
+    __table_args__ = (
+        # used to find the subtasks of a task by status, order and label
+        db.Index('ix_task_parent_id_status', 'parent_id', 'status'),
+        db.Index('ix_task_parent_id_order', 'parent_id', 'order'),
+        db.Index('ix_task_parent_id_label', 'parent_id', 'label'),
+        db.Index('ix_task_created_date', 'created_date'),
+    )
+
     id = db.Column(db.Unicode(128), primary_key=True)
 
     # this can be "simple", "sequential", "parallel", "external" or
@@ -237,7 +537,7 @@ class Task(db.Model):
     task_type = db.Column(db.Unicode(1024))
 
     # for example used in synchronous tasks to store the algorithm
-    task_metadata = db.Column(JSONEncodedDict)
+    task_metadata = db.deferred(db.Column(JSONEncodedDict))
 
     label = db.Column(db.Unicode(1024))
 
@@ -251,9 +551,27 @@ class Task(db.Model):
 
     is_local = db.Column(db.Boolean, default=False)
 
-    parent_id = db.Column(db.Unicode(128), db.ForeignKey('task.id'))
+    # the previous parent is always loaded when it changes, to maintain the
+    # subtask counters of the parent tasks
+    parent_id = db.column_property(
+        db.Column(db.Unicode(128), db.ForeignKey('task.id')),
+        active_history=True)
+
+    # not loaded eagerly, as a task can have lots of subtasks and they are
+    # queried with with_parent() when needed
+    subtasks = db.relationship("Task", lazy="select")
+
+    # counters of subtasks, and of finished and errored subtasks. They are
+    # updated atomically when a subtask is created or changes its status. They
+    # are None in tasks created before the counters existed.
+    num_subtasks = db.Column(db.Integer, default=0)
 
-    subtasks = db.relationship("Task", lazy="joined", join_depth=1)
+    num_finished_subtasks = db.Column(db.Integer, default=0)
+
+    num_errored_subtasks = db.Column(db.Integer, default=0)
+
+    # status of this task as accounted in the counters of its parent
+    counted_status = db.Column(db.Unicode(1024))
 
     # used if it's a subtask
     order = db.Column(db.Integer)
@@ -262,19 +580,18 @@ class Task(db.Model):
 
     sender_url = db.Column(db.Unicode(1024))
 
-    sender_ssl_cert = db.Column(db.UnicodeText)
-
-    receiver_ssl_cert = db.Column(db.UnicodeText)
-
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
 
     last_modified_date = db.Column(db.DateTime, default=datetime.utcnow)
 
-    input_data = db.Column(JSONEncodedDict)
+    # the data of the tasks is deferred, so that it's only loaded and decoded
+    # when it's accessed. Most queries, like the ones checking the status of
+    # the subtasks, only need the other columns
+    input_data = db.deferred(db.Column(JSONEncodedDict))
 
-    output_data = db.Column(JSONEncodedDict)
+    output_data = db.deferred(db.Column(JSONEncodedDict))
 
-    reservation_data = db.Column(JSONEncodedDict)
+    reservation_data = db.deferred(db.Column(JSONEncodedDict))
 
     pingback_date = db.Column(db.DateTime, default=None)
 
@@ -284,6 +601,9 @@ class Task(db.Model):
 
     expiration_pending = db.Column(db.Boolean, default=False)
 
+    # priority of the jobs of the task, and of the message that sends it
+    priority = db.Column(db.Integer, default=None)
+
     # used to store scheduled jobs and remove them when they have finished
     # or need to be removed
     jobs = dict()
@@ -324,6 +644,7 @@ class Task(db.Model):
             'expiration_date': self.expiration_date,
             'pingback_pending': self.pingback_pending,
             'expiration_pending': self.expiration_pending,
+            'priority': self.priority,
         }
 
         if full:
@@ -333,3 +654,199 @@ class Task(db.Model):
             ret['parent_id'] = self.parent_id
 
         return ret
+
+
+def subtask_counters(status):
+    '''
+    Returns the counters of the parent task a subtask with the given status
+    counts in
+    '''
+    counters = ['num_subtasks']
+    if status == 'finished':
+        counters.append('num_finished_subtasks')
+    elif status == 'error':
+        counters.append('num_errored_subtasks')
+    return counters
+
+
+@sqlalchemy.event.listens_for(db.session, 'before_flush')
+def count_new_subtasks(session, flush_context, instances):
+    '''
+    New tasks are inserted already accounted with their initial status
+    '''
+    for obj in session.new:
+        if isinstance(obj, Task):
+            obj.counted_status = obj.status
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_flush')
+def update_subtask_counters(session, flush_context):
+    '''
+    Updates the subtask counters of the parent tasks of the tasks created,
+    moved or whose status changed in this flush.
+
+    The counters are updated with an atomic UPDATE in the same transaction,
+    so that concurrent updates of different subtasks of the same parent do not
+    overwrite each other. The status accounted for a subtask is read from the
+    database after the subtask row has been updated (and thus locked) in this
+    flush, so that it's accounted only once even if the subtask status is
+    concurrently changed in another transaction.
+
+    The changes of status are also counted in the metrics, see metrics.py.
+    '''
+    from .metrics import TASK_TRANSITIONS
+
+    table = Task.__table__
+    deltas = dict()
+
+    def add(parent_id, status, delta):
+        if parent_id is None:
+            return
+        for counter in subtask_counters(status):
+            key = (parent_id, counter)
+            deltas[key] = deltas.get(key, 0) + delta
+
+    for obj in session.new:
+        if isinstance(obj, Task):
+            add(obj.parent_id, obj.status, 1)
+            TASK_TRANSITIONS.inc(from_status="", to_status=obj.status or "")
+
+    for obj in session.dirty:
+        if not isinstance(obj, Task):
+            continue
+        status = sqlalchemy.orm.attributes.get_history(obj, 'status')
+        parent = sqlalchemy.orm.attributes.get_history(obj, 'parent_id')
+        if not status.has_changes() and not parent.has_changes():
+            continue
+
+        old_parent_id = (parent.deleted or parent.unchanged or [None])[0]
+        counted_status = session.execute(
+            sqlalchemy.select([table.c.counted_status])
+                .where(table.c.id == obj.id)).scalar()
+        if status.has_changes():
+            # counted_status is only updated when the counters change
+            old_status = status.deleted[0] if status.deleted else counted_status
+            if old_status != obj.status:
+                TASK_TRANSITIONS.inc(from_status=old_status or "",
+                                     to_status=obj.status or "")
+        if old_parent_id == obj.parent_id and\
+                subtask_counters(counted_status) == subtask_counters(obj.status):
+            continue
+
+        add(old_parent_id, counted_status, -1)
+        add(obj.parent_id, obj.status, 1)
+        session.execute(
+            table.update()
+                .where(table.c.id == obj.id)
+                .values(counted_status=obj.status))
+
+    updated = set()
+    for (parent_id, key), delta in deltas.items():
+        if delta == 0:
+            continue
+        column = table.c[key]
+        session.execute(
+            table.update()
+                .where(table.c.id == parent_id)
+                .values({column: column + delta}))
+        updated.add(parent_id)
+
+    session.info.setdefault('frestq_updated_counters', set()).update(updated)
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_flush_postexec')
+def expire_subtask_counters(session, flush_context):
+    '''
+    Expires the counters updated in the database of the parent tasks that are
+    loaded in the session, so that they are reloaded when accessed
+    '''
+    for parent_id in session.info.pop('frestq_updated_counters', set()):
+        parent = session.identity_map.get(
+            sqlalchemy.orm.util.identity_key(Task, parent_id), None)
+        if parent is not None:
+            session.expire(parent, ['num_subtasks', 'num_finished_subtasks',
+                                    'num_errored_subtasks'])
+
+
+class ReadyJob(db.Model):
+    '''
+    A job ready to be executed in a queue, stored in the database when
+    READY_QUEUE is enabled so that it can be claimed by any of the frestq
+    processes sharing the database. See ready_queue.py.
+    '''
+    __tablename__ = 'ready_job'
+
+    __table_args__ = (
+        db.Index('ix_ready_job_queue_name_claimed_date_id',
+                 'queue_name', 'claimed_date', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    queue_name = db.Column(db.Unicode(1024))
+
+    # reference to the function to execute, as "module:qualified_name"
+    func = db.Column(db.Unicode(1024))
+
+    args = db.Column(JSONEncodedDict)
+
+    kwargs = db.Column(JSONEncodedDict)
+
+    # jobs are claimed in order of priority, and executed in turns by
+    # fair_key, see fscheduler.PriorityThreadPoolExecutor
+    priority = db.Column(db.Integer, default=0)
+
+    fair_key = db.Column(db.Unicode(1024))
+
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # worker that claimed the job, and when. The claim is renewed while the
+    # job is running, and expires after READY_QUEUE_CLAIM_TIMEOUT seconds
+    claimed_by = db.Column(db.Unicode(255))
+
+    claimed_date = db.Column(db.DateTime)
+
+    # failed executions of the job. It's released to be claimed again until it
+    # fails READY_QUEUE_MAX_ATTEMPTS times
+    attempts = db.Column(db.Integer, default=0)
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<ReadyJob %r>' % self.id
+
+
+class SchemaMigration(db.Model):
+    '''
+    Records a schema migration applied to the database
+    '''
+    __tablename__ = 'schema_migration'
+
+    name = db.Column(db.Unicode(255), primary_key=True)
+
+    applied_date = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<SchemaMigration %r>' % self.name
+
+
+def id_pattern_index_ddl(table_name):
+    '''
+    The command line finds tasks and messages by id prefix. In postgresql the
+    primary key index can only be used for that with the C collation, so an
+    index with the pattern operator class is created.
+    '''
+    return sqlalchemy.DDL(
+        'CREATE INDEX ix_%(table)s_id_pattern ON %(table)s (id varchar_pattern_ops)',
+        context=dict(table=table_name))\
+        .execute_if(dialect='postgresql')
+
+for model in [Message, Task]:
+    sqlalchemy.event.listen(model.__table__, 'after_create',
+                            id_pattern_index_ddl(model.__tablename__))
@@ -0,0 +1,620 @@
+# -*- coding: utf-8 -*-
+
+# SPDX-FileCopyrightText: 2014-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import time
+import random
+import logging
+from collections import deque
+from threading import Lock
+from datetime import datetime, timedelta
+
+import OpenSSL
+import requests
+import sqlalchemy
+from sqlalchemy.types import UnicodeText
+
+from .app import db, app
+from .blobs import BlobStore, StoredValue, blob_ids, load_blobs
+from .fscheduler import FScheduler, OUTBOX_SCHEDULER_NAME
+from .metrics import SEND_DURATION
+from .models import Task as ModelTask, Message as ModelMessage
+from .peers import PeerSessions
+from .utils import dumps, loads, encode_body, decode_body, wire_formats,\
+    JSON_MIMETYPE, MSGPACK_MIMETYPE
+
+# Outbox of sent messages.
+#
+# send_message() stores the messages in the database with send_status
+# "pending" in the current transaction, and once it's committed they are
+# delivered asynchronously by the outbox scheduler, so that the threads
+# executing the tasks do not wait for the network. If the delivery fails, it's
+# retried with exponential backoff until OUTBOX_MAX_ATTEMPTS is reached, and
+# then the message is marked as "dead". The messages sent to ourselves are
+# delivered by the outbox scheduler too, without an HTTP request unless
+# LOCAL_MESSAGES_SHORTCUT is disabled.
+
+class OutboxPeers(object):
+    '''
+    Limits the number of messages being delivered concurrently to the same
+    peer, so that a slow or down peer does not use all the outbox threads.
+    Messages that exceed the limit wait in a per peer queue, and are scheduled
+    when a delivery to that peer finishes.
+    '''
+    _sending = dict()
+
+    _waiting = dict()
+
+    # peers that answered that they don't support batch requests
+    _without_batch_support = set()
+
+    # peers that announced that they accept messages in msgpack
+    _with_msgpack_support = set()
+
+    # peers that announced that they have a blob store
+    _with_blob_support = set()
+
+    _lock = Lock()
+
+    @staticmethod
+    def acquire(receiver_url, msg_id):
+        '''
+        Returns True if the message can be delivered now. Otherwise, the
+        message is queued and False is returned.
+        '''
+        max_concurrency = app.config.get('OUTBOX_MAX_PEER_CONCURRENCY', 4)
+        with OutboxPeers._lock:
+            sending = OutboxPeers._sending.get(receiver_url, 0)
+            if sending >= max_concurrency:
+                OutboxPeers._waiting.setdefault(receiver_url, deque())\
+                    .append(msg_id)
+                return False
+            OutboxPeers._sending[receiver_url] = sending + 1
+            return True
+
+    @staticmethod
+    def release(receiver_url, delivered_ids=()):
+        '''
+        Called when a delivery to a peer finishes. Returns the id of the next
+        message waiting to be delivered to that peer, if any. Waiting messages
+        that were just delivered in the same batch are skipped.
+        '''
+        with OutboxPeers._lock:
+            sending = OutboxPeers._sending.get(receiver_url, 1) - 1
+            if sending > 0:
+                OutboxPeers._sending[receiver_url] = sending
+            else:
+                OutboxPeers._sending.pop(receiver_url, None)
+
+            waiting = OutboxPeers._waiting.get(receiver_url, None)
+            msg_id = None
+            while waiting and msg_id is None:
+                msg_id = waiting.popleft()
+                if msg_id in delivered_ids:
+                    msg_id = None
+            if waiting is not None and not waiting:
+                del OutboxPeers._waiting[receiver_url]
+            return msg_id
+
+    @staticmethod
+    def supports_batches(receiver_url):
+        return receiver_url not in OutboxPeers._without_batch_support
+
+    @staticmethod
+    def set_without_batch_support(receiver_url):
+        logging.info("peer %s does not support batches" % receiver_url)
+        OutboxPeers._without_batch_support.add(receiver_url)
+
+    @staticmethod
+    def wire_format(receiver_url):
+        '''
+        Returns the mimetype of the wire format used to send messages to a peer
+        '''
+        if receiver_url in OutboxPeers._with_msgpack_support and\
+                MSGPACK_MIMETYPE in wire_formats():
+            return MSGPACK_MIMETYPE
+        return JSON_MIMETYPE
+
+    @staticmethod
+    def set_wire_formats(receiver_url, r):
+        '''
+        Records if a peer accepts msgpack, as announced in the Accept-Post
+        header of its responses. Peers that don't announce it, like older
+        versions of frestq, are sent json.
+        '''
+        accepted = [
+            mimetype.split(';')[0].strip()
+            for mimetype in r.headers.get('Accept-Post', '').split(',')
+        ]
+        if MSGPACK_MIMETYPE in accepted:
+            if receiver_url not in OutboxPeers._with_msgpack_support:
+                logging.info("peer %s accepts msgpack" % receiver_url)
+                OutboxPeers._with_msgpack_support.add(receiver_url)
+        elif receiver_url in OutboxPeers._with_msgpack_support:
+            logging.info("peer %s does not accept msgpack" % receiver_url)
+            OutboxPeers._with_msgpack_support.discard(receiver_url)
+
+    @staticmethod
+    def supports_blobs(receiver_url):
+        return receiver_url in OutboxPeers._with_blob_support and\
+            BlobStore.enabled()
+
+    @staticmethod
+    def set_blob_support(receiver_url, r):
+        '''
+        Records if a peer has a blob store, as announced in the
+        X-Frestq-Features header of its responses
+        '''
+        features = [
+            feature.strip()
+            for feature in r.headers.get('X-Frestq-Features', '').split(',')
+        ]
+        if 'blobs' in features:
+            if receiver_url not in OutboxPeers._with_blob_support:
+                logging.info("peer %s has a blob store" % receiver_url)
+                OutboxPeers._with_blob_support.add(receiver_url)
+        elif receiver_url in OutboxPeers._with_blob_support:
+            logging.info("peer %s does not have a blob store" % receiver_url)
+            OutboxPeers._with_blob_support.discard(receiver_url)
+
+
+def queue_message(msg):
+    '''
+    Adds a message to the outbox in the current transaction. Its delivery is
+    scheduled when the transaction is committed, so that the delivery finds
+    it, see schedule_queued_messages.
+    '''
+    db.session.add(msg)
+    db.session.info.setdefault('frestq_outbox', []).append(msg.id)
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_commit')
+def schedule_queued_messages(session):
+    for msg_id in session.info.pop('frestq_outbox', []):
+        schedule_delivery(msg_id)
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_soft_rollback')
+def discard_queued_messages(session, previous_transaction):
+    session.info.pop('frestq_outbox', None)
+
+
+def schedule_delivery(msg_id, delay=0):
+    '''
+    Schedules the delivery of an outbox message in the outbox scheduler,
+    after the given delay in seconds. The delivery is delayed at least
+    OUTBOX_BATCH_WINDOW seconds, so that messages to the same peer sent in
+    that window are delivered in a single batch request.
+    '''
+    sched = FScheduler.get_scheduler(OUTBOX_SCHEDULER_NAME)
+    delay = max(delay, app.config.get('OUTBOX_BATCH_WINDOW', 0))
+    if delay <= 0:
+        sched.add_now_job(deliver_message, [msg_id])
+    else:
+        date = datetime.now() + timedelta(seconds=delay)
+        sched.add_date_job(deliver_message, date, [msg_id],
+                           misfire_grace_time=3600*24)
+
+
+def retry_delay(attempts):
+    '''
+    Returns the number of seconds to wait before the next delivery attempt,
+    using exponential backoff with jitter.
+    '''
+    delay = min(
+        app.config.get('OUTBOX_RETRY_DELAY', 1) * 2**(attempts - 1),
+        app.config.get('OUTBOX_MAX_RETRY_DELAY', 300))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def stored_data(msgs):
+    '''
+    Returns the data of the messages by id as it's stored, with references
+    to blobs instead of their values, if any. See blobs.py
+    '''
+    rows = db.session.query(
+            ModelMessage.id,
+            sqlalchemy.type_coerce(ModelMessage.input_data, UnicodeText))\
+        .filter(ModelMessage.id.in_([msg.id for msg in msgs]))
+    return dict(
+        (msg_id, loads(data) if data else None)
+        for msg_id, data in rows
+    )
+
+
+def upload_blobs(receiver_url, data):
+    '''
+    Returns the data to send to a peer, given the stored data of a message.
+    If the peer has a blob store, the blobs referenced in the data that it
+    doesn't have yet are uploaded to it, and the data is sent as it's stored,
+    as a StoredValue. Otherwise, or if an upload fails, the values are sent.
+    '''
+    if OutboxPeers.supports_blobs(receiver_url) and\
+            all(_upload_blob(receiver_url, blob_id)
+                for blob_id in blob_ids(data)):
+        return StoredValue(data)
+    return load_blobs(data)
+
+
+def _upload_blob(receiver_url, blob_id):
+    '''
+    Uploads a blob to a peer, unless it already has it. The file of the blob
+    is streamed, so it's never whole in memory. Returns whether the peer has
+    the blob.
+    '''
+    url = "%s/blobs/%s/" % (receiver_url, blob_id)
+    try:
+        with PeerSessions.session(receiver_url) as session:
+            r = session.request('head', url, timeout=send_timeout())
+            if r.status_code == 200:
+                return True
+            logging.debug("UPLOADING BLOB %s to %s" % (blob_id, url))
+            with open(BlobStore.path(blob_id), 'rb') as f:
+                r = session.request('put', url, data=f,
+                                    headers={'Content-Type': JSON_MIMETYPE},
+                                    timeout=send_timeout())
+    except (requests.exceptions.RequestException, OSError) as e:
+        logging.warning("could not upload blob %s to %s: %s" % (
+            blob_id, url, str(e)))
+        return False
+
+    if r.status_code not in [200, 201]:
+        logging.warning("could not upload blob %s to %s: status %d" % (
+            blob_id, url, r.status_code))
+        return False
+    return True
+
+
+def message_payload(msg, data):
+    '''
+    Returns the RESTQP payload of a message, given the data to send. See
+    upload_blobs()
+    '''
+    payload = {
+        'message_id': msg.id,
+        'action': msg.action,
+        'sender_url': msg.sender_url,
+        "data": data
+    }
+    if isinstance(data, StoredValue):
+        payload['data'] = data.value
+        payload['stored_data'] = True
+    opts = ['task_id', 'pingback_date', 'expiration_date', 'priority']
+    for opt in opts:
+        if getattr(msg, opt) != None:
+            payload[opt] = getattr(msg, opt)
+    return payload
+
+
+def deliver_message(msg_id):
+    '''
+    Delivers a pending message of the outbox, if the concurrency limit of the
+    receiver peer allows it. Other pending messages for the same peer and
+    queue are delivered along with it in a single batch request.
+    '''
+    msg = ModelMessage.query.get(msg_id)
+    if not msg or msg.send_status != 'pending':
+        return
+
+    if msg.receiver_url == app.config.get('ROOT_URL') and\
+            app.config.get('LOCAL_MESSAGES_SHORTCUT', True):
+        _deliver_local_message(msg)
+        return
+
+    receiver_url = msg.receiver_url
+    if not OutboxPeers.acquire(receiver_url, msg_id):
+        return
+
+    delivered_ids = set()
+    try:
+        delivered_ids = _deliver_messages(msg_id)
+    finally:
+        next_msg_id = OutboxPeers.release(receiver_url, delivered_ids)
+        if next_msg_id:
+            schedule_delivery(next_msg_id)
+
+
+def _deliver_local_message(msg):
+    '''
+    Delivers a pending message sent to ourselves, without an HTTP request
+    '''
+    from .tasks import send_local_message
+
+    if not _claim_message(msg.id):
+        db.session.commit()
+        return
+    task = None
+    if msg.update_task_receiver_ssl_cert and msg.task_id:
+        task = ModelTask.query.get(msg.task_id)
+    send_local_message(msg, task)
+
+
+def _claim_message(msg_id):
+    '''
+    Claims a pending message, so that it's not delivered twice. The claim
+    expires after OUTBOX_SENDING_TIMEOUT seconds, in case we die while
+    sending. Returns whether the message was claimed.
+    '''
+    lease = timedelta(seconds=app.config.get('OUTBOX_SENDING_TIMEOUT', 600))
+    return db.session.query(ModelMessage)\
+        .filter(ModelMessage.id == msg_id,
+                ModelMessage.send_status == 'pending')\
+        .update({
+            'send_status': 'sending',
+            'next_send_date': datetime.utcnow() + lease
+        }, synchronize_session=False) > 0
+
+
+def _claim_batch(msg_id):
+    '''
+    Claims the given message and up to OUTBOX_BATCH_SIZE - 1 other due
+    messages with the same receiver and queue. Returns the claimed messages.
+    '''
+    if not _claim_message(msg_id):
+        db.session.commit()
+        return []
+    msg = ModelMessage.query.get(msg_id)
+    msg_ids = [msg_id]
+
+    batch_size = app.config.get('OUTBOX_BATCH_SIZE', 100)
+    if batch_size > 1 and OutboxPeers.supports_batches(msg.receiver_url):
+        due = db.session.query(ModelMessage.id)\
+            .filter(ModelMessage.receiver_url == msg.receiver_url,
+                    ModelMessage.queue_name == msg.queue_name,
+                    ModelMessage.send_status == 'pending',
+                    ModelMessage.next_send_date <= datetime.utcnow(),
+                    ModelMessage.id != msg_id)\
+            .order_by(ModelMessage.next_send_date)\
+            .limit(batch_size - 1)\
+            .all()
+        msg_ids += [due_id for due_id, in due if _claim_message(due_id)]
+    db.session.commit()
+
+    msgs = ModelMessage.query.filter(ModelMessage.id.in_(msg_ids)).all()
+    return sorted(msgs, key=lambda msg: msg_ids.index(msg.id))
+
+
+def send_timeout():
+    '''
+    Returns the (connect, read) timeout in seconds of the requests to the
+    peers. Each is capped to a quarter of OUTBOX_SENDING_TIMEOUT, so that a
+    hung peer can't keep a delivery running after its lease expired, when
+    sweep_outbox() would send the message again.
+    '''
+    limit = app.config.get('OUTBOX_SENDING_TIMEOUT', 600) / 4.0
+    return (min(app.config.get('OUTBOX_CONNECT_TIMEOUT', 10), limit),
+            min(app.config.get('OUTBOX_READ_TIMEOUT', 60), limit))
+
+
+def _post(receiver_url, url, payload):
+    '''
+    Posts a payload to a peer in the wire format it accepts. If the peer
+    rejects a msgpack body and stops announcing msgpack, for example because
+    it was downgraded, the payload is posted again in json.
+    '''
+    with PeerSessions.session(receiver_url) as session:
+        data, mimetype = encode_body(payload,
+                                     OutboxPeers.wire_format(receiver_url))
+        r = session.request('post', url, data=data,
+                            headers={'Content-Type': mimetype},
+                            timeout=send_timeout())
+        OutboxPeers.set_wire_formats(receiver_url, r)
+        OutboxPeers.set_blob_support(receiver_url, r)
+        if mimetype == MSGPACK_MIMETYPE and r.status_code in [400, 415] and\
+                OutboxPeers.wire_format(receiver_url) == JSON_MIMETYPE:
+            r = session.request('post', url, data=dumps(payload),
+                                headers={'Content-Type': JSON_MIMETYPE},
+                                timeout=send_timeout())
+    return r
+
+
+def _deliver_messages(msg_id):
+    '''
+    Does a delivery attempt of a message, coalesced with other due messages
+    to the same peer and queue. Returns the set of ids of the messages
+    delivered.
+    '''
+    msgs = _claim_batch(msg_id)
+    if not msgs:
+        return set()
+
+    data = stored_data(msgs)
+    for msg in msgs:
+        data[msg.id] = upload_blobs(msg.receiver_url, data[msg.id])
+
+    if len(msgs) > 1:
+        results = _post_batch(msgs, data)
+        if results is None:
+            # the peer does not support batches, send messages one by one
+            results = [_post_message(msg, data[msg.id]) for msg in msgs]
+    else:
+        results = [_post_message(msgs[0], data[msgs[0].id])]
+
+    for msg, (status, error, r) in zip(msgs, results):
+        _record_result(msg, status, error, r)
+    db.session.commit()
+    return set(msg.id for msg in msgs)
+
+
+def _post_message(msg, data):
+    '''
+    Posts a message to its receiver, given its stored data. Returns a tuple
+    (status, error, r)
+    '''
+    url = "%s/%s/" % (msg.receiver_url, msg.queue_name)
+    logging.debug('SENDING MESSAGE id %s with action %s to %s (attempt %d)' % (
+        msg.id, msg.action, url, (msg.send_attempts or 0) + 1))
+
+    start_time = time.monotonic()
+    try:
+        r = _post(msg.receiver_url, url, message_payload(msg, data))
+    except requests.exceptions.RequestException as e:
+        SEND_DURATION.observe(time.monotonic() - start_time,
+                              peer=msg.receiver_url, status="error")
+        return None, str(e), None
+    SEND_DURATION.observe(time.monotonic() - start_time,
+                          peer=msg.receiver_url, status=r.status_code)
+
+    if r.status_code >= 400:
+        print("!!! ERROR request to url = '%s' and status = '%d' answered:\n%s" % (
+            url, r.status_code, r.text))
+        return r.status_code, r.text, r
+    return r.status_code, None, r
+
+
+def _post_batch(msgs, data):
+    '''
+    Posts a list of messages for the same receiver and queue in a single
+    request, given their stored data by id. Returns a list of tuples
+    (status, error, r), one per message, or None if the receiver does not
+    support batches.
+    '''
+    receiver_url = msgs[0].receiver_url
+    url = "%s/%s/batch/" % (receiver_url, msgs[0].queue_name)
+    logging.debug('SENDING BATCH of %d MESSAGES to %s' % (len(msgs), url))
+
+    start_time = time.monotonic()
+    try:
+        r = _post(receiver_url, url,
+                  [message_payload(msg, data[msg.id]) for msg in msgs])
+    except requests.exceptions.RequestException as e:
+        SEND_DURATION.observe(time.monotonic() - start_time,
+                              peer=receiver_url, status="error")
+        return [(None, str(e), None)] * len(msgs)
+    SEND_DURATION.observe(time.monotonic() - start_time,
+                          peer=receiver_url, status=r.status_code)
+
+    if r.status_code in [404, 405]:
+        OutboxPeers.set_without_batch_support(receiver_url)
+        return None
+
+    if r.status_code >= 400:
+        print("!!! ERROR request to url = '%s' and status = '%d' answered:\n%s" % (
+            url, r.status_code, r.text))
+        return [(r.status_code, r.text, r)] * len(msgs)
+
+    try:
+        statuses = dict(
+            (result['message_id'], result)
+            for result in decode_body(
+                r.content,
+                r.headers.get('Content-Type', '').split(';')[0].strip())
+        )
+    except (ValueError, TypeError, KeyError) as e:
+        return [(500, "invalid batch response: %s" % str(e), r)] * len(msgs)
+
+    results = []
+    for msg in msgs:
+        result = statuses.get(msg.id, dict(status=500, message="not answered"))
+        if result['status'] >= 400:
+            results.append((result['status'], result.get('message', ''), r))
+        else:
+            results.append((result['status'], None, r))
+    return results
+
+
+def _record_result(msg, status, error, r):
+    '''
+    Records the result of a delivery attempt of a message, scheduling a retry
+    if it failed and it makes sense.
+    '''
+    url = "%s/%s/" % (msg.receiver_url, msg.queue_name)
+    msg.send_attempts = (msg.send_attempts or 0) + 1
+    msg.output_status = status
+    msg.send_error = error
+
+    # delivered
+    if status is not None and status < 400:
+        msg.send_status = 'sent'
+        msg.next_send_date = None
+        if app.config.get('SSL_CERT_PATH', ''):
+            _set_receiver_ssl_cert(msg, r)
+
+    # the receiver is overloaded, down or unreachable: retry later
+    elif (status is None or status >= 500 or status == 429) and\
+            msg.send_attempts < app.config.get('OUTBOX_MAX_ATTEMPTS', 10):
+        delay = retry_delay(msg.send_attempts)
+        logging.warning("delivery of MESSAGE id %s to %s failed, retrying "\
+            "in %.1f seconds" % (msg.id, url, delay))
+        msg.send_status = 'pending'
+        msg.next_send_date = datetime.utcnow() + timedelta(seconds=delay)
+        schedule_delivery(msg.id, delay)
+
+    else:
+        logging.error("delivery of MESSAGE id %s to %s failed after %d "\
+            "attempts, marking it as dead" % (msg.id, url, msg.send_attempts))
+        msg.send_status = 'dead'
+        msg.next_send_date = None
+
+    db.session.add(msg)
+
+
+def _set_receiver_ssl_cert(msg, r):
+    '''
+    Sets the receiver certificate of the message, and of its task if
+    requested, from the certificate retrieved from the socket
+    '''
+    # convert the asn1 cert retrieved from the socket into pem format
+    try:
+        cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, r.raw.peer_cert)
+        msg.receiver_ssl_cert = OpenSSL.crypto\
+            .dump_certificate(OpenSSL.crypto.FILETYPE_PEM, cert)\
+            .decode('utf-8')
+        if msg.update_task_receiver_ssl_cert and msg.task_id:
+            task = ModelTask.query.get(msg.task_id)
+            if task:
+                task.receiver_ssl_cert = msg.receiver_ssl_cert
+                db.session.add(task)
+
+    except Exception as e:
+        logging.warning("could not get the certificate of the receiver of "
+                        "MESSAGE id %s: %s" % (msg.id, str(e)))
+
+
+def sweep_outbox(startup=False):
+    '''
+    Schedules the delivery of the messages of the outbox that are overdue,
+    which happens for example with messages whose sender died while
+    delivering them. On startup, all the pending messages of the previous
+    execution are scheduled.
+    '''
+    interval = app.config.get('OUTBOX_SWEEP_INTERVAL', 60)
+    now = datetime.utcnow()
+    pending = ModelMessage.send_status == 'pending'
+    if not startup:
+        pending = db.and_(pending,
+            ModelMessage.next_send_date <= now - timedelta(seconds=interval))
+    overdue = db.session.query(ModelMessage.id, ModelMessage.send_status,
+                               ModelMessage.next_send_date)\
+        .filter(
+            db.or_(
+                pending,
+                db.and_(ModelMessage.send_status == 'sending',
+                        ModelMessage.next_send_date <= now)))\
+        .order_by(ModelMessage.next_send_date)\
+        .all()
+
+    for msg_id, send_status, next_send_date in overdue:
+        delay = 0
+        if send_status == 'sending':
+            logging.warning("delivery lease of MESSAGE id %s expired" % msg_id)
+            db.session.query(ModelMessage)\
+                .filter(ModelMessage.id == msg_id,
+                        ModelMessage.send_status == 'sending')\
+                .update({'send_status': 'pending'}, synchronize_session=False)
+            db.session.commit()
+        elif next_send_date:
+            delay = (next_send_date - now).total_seconds()
+        schedule_delivery(msg_id, delay)
+
+
+def start_outbox():
+    '''
+    Schedules the pending messages and starts sweeping periodically the outbox
+    '''
+    sched = FScheduler.get_scheduler(OUTBOX_SCHEDULER_NAME)
+    sched.add_now_job(sweep_outbox, [True])
+    sched.add_interval_job(sweep_outbox,
+                           seconds=app.config.get('OUTBOX_SWEEP_INTERVAL', 60))
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+# SPDX-FileCopyrightText: 2014-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import time
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PeerSession(object):
+    '''
+    A keep-alive HTTP session to a peer, along with the bookkeeping needed to
+    know when it can be safely closed.
+    '''
+    def __init__(self, session):
+        self.session = session
+        self.last_used = time.monotonic()
+        self.users = 0
+        self.evicted = False
+
+    def close(self):
+        try:
+            self.session.close()
+        except Exception:
+            logging.exception("error closing peer session")
+
+
+class PeerSessions(object):
+    '''
+    Bounded pool of keep-alive HTTP sessions, one per receiver url, shared by
+    all the scheduler threads. This way sending a message to a peer reuses an
+    already established TCP (and TLS) connection instead of doing a new
+    handshake for each message.
+
+    Sessions not used in HTTP_POOL_IDLE_TIMEOUT seconds are closed, and when
+    there are more than HTTP_POOL_MAX_PEERS peers the least recently used
+    session is closed. A session is never closed while it's in use.
+    '''
+    _sessions = OrderedDict()
+
+    _lock = Lock()
+
+    @staticmethod
+    def _create_session():
+        from .app import app
+
+        session = requests.sessions.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=app.config.get('HTTP_POOL_MAXSIZE', 10))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        if app.config.get('SSL_CERT_PATH', ''):
+            # further verification is done later. for now we verify that it's
+            # in the list of allowed peers, but not which peer exactly should
+            # it be
+            session.verify = app.config.get('SSL_CALIST_PATH', '')
+            session.cert = (
+                app.config.get('SSL_CERT_PATH', ''),
+                app.config.get('SSL_KEY_PATH', '')
+            )
+        return session
+
+    @staticmethod
+    def _release(peer):
+        '''
+        Marks as evicted a peer session and closes it if nobody is using it.
+        Must be called with the lock acquired.
+        '''
+        peer.evicted = True
+        if peer.users == 0:
+            peer.close()
+
+    @staticmethod
+    def _evict():
+        '''
+        Evicts idle sessions and the least recently used sessions that exceed
+        the maximum number of peers. Must be called with the lock acquired.
+        '''
+        from .app import app
+
+        idle_timeout = app.config.get('HTTP_POOL_IDLE_TIMEOUT', 300)
+        max_peers = app.config.get('HTTP_POOL_MAX_PEERS', 32)
+        now = time.monotonic()
+
+        for url, peer in list(PeerSessions._sessions.items()):
+            if peer.users == 0 and now - peer.last_used > idle_timeout:
+                logging.debug("closing idle session to peer %s" % url)
+                del PeerSessions._sessions[url]
+                PeerSessions._release(peer)
+
+        while len(PeerSessions._sessions) > max_peers:
+            url, peer = PeerSessions._sessions.popitem(last=False)
+            logging.debug("closing least recently used session to peer %s" % url)
+            PeerSessions._release(peer)
+
+    @staticmethod
+    @contextmanager
+    def session(receiver_url):
+        '''
+        Context manager that provides the session to be used to send messages
+        to the given receiver url.
+        '''
+        with PeerSessions._lock:
+            peer = PeerSessions._sessions.pop(receiver_url, None)
+            if peer is None:
+                logging.debug("opening session to peer %s" % receiver_url)
+                peer = PeerSession(PeerSessions._create_session())
+            # (re)insert it as the most recently used
+            PeerSessions._sessions[receiver_url] = peer
+            peer.users += 1
+            PeerSessions._evict()
+
+        try:
+            yield peer.session
+        finally:
+            with PeerSessions._lock:
+                peer.users -= 1
+                peer.last_used = time.monotonic()
+                if peer.evicted and peer.users == 0:
+                    peer.close()
+
+    @staticmethod
+    def close_all():
+        '''
+        Closes all the sessions that are not being used, and marks the others
+        to be closed when they are released.
+        '''
+        with PeerSessions._lock:
+            for peer in PeerSessions._sessions.values():
+                PeerSessions._release(peer)
+            PeerSessions._sessions.clear()
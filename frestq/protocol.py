@@ -6,17 +6,17 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import json
-import OpenSSL
 import logging
-from threading import Condition
 from datetime import datetime, timedelta
 
 from flask import Blueprint, request, make_response
+from sqlalchemy.exc import IntegrityError
 
 from .action_handlers import ActionHandlers
 from . import decorators
-from .fscheduler import FScheduler, INTERNAL_SCHEDULER_NAME
-from .utils import dumps, constant_time_compare
+from .fscheduler import (FScheduler, INTERNAL_SCHEDULER_NAME,
+                         INTERNAL_TIMER_SCHEDULER_NAME, PROTOCOL_PRIORITY)
+from .utils import dumps, constant_time_compare, cert_fingerprint
 
 def certs_differ(cert_a, cert_b):
     '''
@@ -39,23 +39,15 @@ def certs_differ(cert_a, cert_b):
         return True
 
     # now, compare the certs for real
-    ca = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, cert_a)
-    ca_dump = OpenSSL.crypto\
-        .dump_certificate(OpenSSL.crypto.FILETYPE_PEM, ca)\
-        .decode('utf-8')
-
-    cb = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, cert_b)
-    cb_dump = OpenSSL.crypto\
-        .dump_certificate(OpenSSL.crypto.FILETYPE_PEM, cb)\
-        .decode('utf-8')
-
-    return not constant_time_compare(ca_dump, cb_dump)
+    return not constant_time_compare(cert_fingerprint(cert_a),
+                                     cert_fingerprint(cert_b))
 
 
 class SecurityException(Exception):
     pass
 
-@decorators.message_action(action="frestq.update_task", queue=INTERNAL_SCHEDULER_NAME)
+@decorators.message_action(action="frestq.update_task", queue=INTERNAL_SCHEDULER_NAME,
+                            priority=PROTOCOL_PRIORITY)
 def update_task(msg):
     from .app import db
     from .models import Task as ModelTask
@@ -63,67 +55,73 @@ def update_task(msg):
 
     # fixed broken FK bug, when taskid exists in a non local db
     # task = msg.task
-    task = db.session.query(ModelTask).filter(ModelTask.id == msg.task_id).with_for_update(of=ModelTask).first()
-
-    logging.debug("UPDATING TASK with id %s" % task.id)
-    if not task or\
-            (task.status == "finished" and msg.input_data['status'] != 'error'):
-        # error, cannot update an already finished task (unless it's an error)!
+    task = db.session.query(ModelTask).filter(ModelTask.id == msg.task_id).first()
+    if not task:
         # TODO: send back an error update
         return
 
-    # check if its an invalid or insecure update
-    if certs_differ(task.receiver_ssl_cert, msg.sender_ssl_cert):
-        raise  SecurityException()
+    logging.debug("UPDATING TASK with id %s" % task.id)
 
-    keys = ['output_data', 'status']
-
-    for key in keys:
-        if key not in msg.input_data:
-            continue
-        str_data = (
-            msg.input_data[key]
-            if isinstance(msg.input_data[key], str)
-            else dumps(msg.input_data[key])
-        )
-        if (
-            key == 'status' and
-            hasattr(task, key) and
-            task.status == 'finished'
-        ):
-            logging.debug(
-                f"({task.id}) **NOT** SETTING TASK FIELD '{key}' to "
-                f"'{str_data}' because it's already 'finished'"
-            )
-            # do next (it might be a task with a parent task)
-            receiver_task = BaseTask.instance_by_model(task)
-            receiver_task.execute()
+    # the status is checked and changed with the task locked, because several
+    # updates of the same task can be received at the same time, for example
+    # in a batch, and an older one must not overwrite a "finished" status
+    receiver_task = BaseTask.instance_by_model(task)
+    with receiver_task.locked():
+        if task.status == "finished" and msg.input_data['status'] != 'error':
+            # error, cannot update an already finished task (unless it's an error)!
+            # TODO: send back an error update
             return
-        else:
-            logging.debug(
-                f"({task.id}) SETTING TASK FIELD '{key}' to '{str_data}'"
+
+        # check if its an invalid or insecure update
+        if certs_differ(task.receiver_ssl_cert, msg.sender_ssl_cert):
+            raise  SecurityException()
+
+        keys = ['output_data', 'status']
+
+        for key in keys:
+            if key not in msg.input_data:
+                continue
+            str_data = (
+                msg.input_data[key]
+                if isinstance(msg.input_data[key], str)
+                else dumps(msg.input_data[key])
             )
-            setattr(task, key, msg.input_data[key])
-    task.last_modified_date = datetime.utcnow()
-    db.session.add(task)
-    db.session.commit()
+            if (
+                key == 'status' and
+                hasattr(task, key) and
+                task.status == 'finished'
+            ):
+                logging.debug(
+                    f"({task.id}) **NOT** SETTING TASK FIELD '{key}' to "
+                    f"'{str_data}' because it's already 'finished'"
+                )
+                break
+            else:
+                logging.debug(
+                    f"({task.id}) SETTING TASK FIELD '{key}' to '{str_data}'"
+                )
+                setattr(task, key, msg.input_data[key])
+        else:
+            task.last_modified_date = datetime.utcnow()
+            db.session.add(task)
 
     # do next (it might be a task with a parent task)
-    receiver_task = BaseTask.instance_by_model(task)
     receiver_task.execute()
 
-# used to notify reserve threads about events
-_reserve_condition = Condition()
-
 def reserve_task(task_id):
     '''
     This executes the synchronization negotiation details for a synchronized
-    task from the receiver's point of view. When synced, this also executes the
-    task.
+    task from the receiver's point of view.
+
+    The reservation is recorded and acknowledged to the sender, and then the
+    thread is released. When the sender confirms the reservation with a
+    frestq.execute_synchronized message, the task is executed in a new job by
+    execute_reserved_task. If the confirmation doesn't arrive in time, the
+    reservation is cancelled by cancel_reserved_subtask.
     '''
     from .app import db, app
     from .models import Task as ModelTask
-    from .tasks import BaseTask, send_task_update
+    from .tasks import BaseTask
 
     # 1. get task and check everything is ok
     task = db.session.query(ModelTask).filter(ModelTask.id == task_id).first()
@@ -146,85 +144,88 @@ def reserve_task(task_id):
     ack_reservation(task_id)
 
     # 4. set reservation timeout
-    sched = FScheduler.get_scheduler(INTERNAL_SCHEDULER_NAME)
+    sched = FScheduler.get_scheduler(INTERNAL_TIMER_SCHEDULER_NAME)
     date = datetime.utcnow() + timedelta(seconds=app.config.get('RESERVATION_TIMEOUT'))
-    sched.add_date_job(cancel_reserved_subtask, date, [task.id])
+    sched.add_date_job(cancel_reserved_subtask, date, [task.id],
+                       priority=PROTOCOL_PRIORITY)
 
-    # 5. wait for a cancel or execute message
-    with _reserve_condition:
-        while True:
-            _reserve_condition.wait()
-            # fetch again the task to get the newly obtained status info
-            db.session.commit()
-            task = db.session.query(ModelTask).filter(ModelTask.id == task_id).first()
+def execute_reserved_task(task_id):
+    '''
+    Executes a synchronized task once the sender has confirmed its
+    reservation. It's scheduled in the queue of the task by
+    execute_synchronized.
+    '''
+    from .app import db
+    from .models import Task as ModelTask
+    from .tasks import BaseTask, update_task, send_task_update
 
-            # we probably received a _reserve_condition that was sent to another thread
-            # because our task didn't change state, so we ignore the signal
-            if task.status == 'reserved':
-                continue
+    task_model = db.session.query(ModelTask).get(task_id)
+    if not task_model:
+        return
+    task = BaseTask.instance_by_model(task_model)
 
-            # timedout, notify and exit thread
-            elif task.status == 'created':
-                logging.debug("TASK TIMEDOUT with id %s", task.id)
-                return
-
-            # 6. task received confirmation, we're ready to finally execute the task
-            elif task.status == 'confirmed':
-                logging.debug("EXECUTING synchronized SUBTASK with id %s, "\
-                    "action = %s" % (task.id, task.action))
-                # adapted from the final part of tasks.py:post_task() function
-                from .tasks import BaseTask, update_task
-                task_model = task
-                task_model.status = 'executing'
-                task_model.last_modified_date = datetime.utcnow()
-                db.session.add(task_model)
-                db.session.commit()
-
-                task = BaseTask.instance_by_model(task_model)
-                task_output = None
-                try:
-                    task_output = task.run_action_handler()
-                    db.session.commit()
-                except Exception as e:
-                    task.error = e
-                    task.propagate = True
-                    db.session.commit()
-                    import traceback; traceback.print_exc()
-                    if task.action_handler_object:
-                        task.action_handler_object.handle_error(e)
-
-                if task_output:
-                    update_task(task, task_output)
-
-                # 7. update asynchronously the task sender if requested
-                if task.propagate:
-                    task_model.status = "error"
-                    task_model.last_modified_date = datetime.utcnow()
-                    db.session.add(task_model)
-                    db.session.commit()
-                elif task.auto_finish_after_handler:
-                    task_model.status = "finished"
-                    task_model.last_modified_date = datetime.utcnow()
-                    db.session.add(task_model)
-                    db.session.commit()
-
-                if task.send_update_to_sender or task.propagate:
-                    sched = FScheduler.get_scheduler(INTERNAL_SCHEDULER_NAME)
-                    sched.add_now_job(send_task_update, [task_model.id])
-
-                # 8. execute the task synchronously
-                #
-                # for simple task this function does nothing. For sequential tasks this spawns
-                # the next subtask (or update sender status to finished), and for parallel
-                # tasks it launches all subtasks
-                task.execute()
-                return
+    # the reservation might have been cancelled meanwhile, so the status is
+    # checked and changed with the task locked
+    with task.locked():
+        confirmed = task_model.status == 'confirmed'
+        if confirmed:
+            task_model.status = 'executing'
+            task_model.last_modified_date = datetime.utcnow()
+            db.session.add(task_model)
+
+    if not confirmed:
+        logging.debug("NOT EXECUTING synchronized SUBTASK with id %s, "\
+            "status = %s" % (task_id, task_model.status))
+        return
+
+    logging.debug("EXECUTING synchronized SUBTASK with id %s, "\
+        "action = %s" % (task_model.id, task_model.action))
+    # adapted from the final part of tasks.py:post_task() function
+    task_output = None
+    try:
+        task_output = task.run_action_handler()
+        db.session.commit()
+    except Exception as e:
+        task.error = e
+        task.propagate = True
+        db.session.commit()
+        import traceback; traceback.print_exc()
+        if task.action_handler_object:
+            task.action_handler_object.handle_error(e)
+
+    if task_output:
+        update_task(task, task_output)
+
+    # update asynchronously the task sender if requested
+    if task.propagate:
+        task_model.status = "error"
+        task_model.last_modified_date = datetime.utcnow()
+        db.session.add(task_model)
+        db.session.commit()
+    elif task.auto_finish_after_handler:
+        task_model.status = "finished"
+        task_model.last_modified_date = datetime.utcnow()
+        db.session.add(task_model)
+        db.session.commit()
+
+    if task.send_update_to_sender or task.propagate:
+        sched = FScheduler.get_scheduler(INTERNAL_SCHEDULER_NAME)
+        sched.add_now_job(send_task_update, [task_model.id])
+
+    # execute the task synchronously
+    #
+    # for simple task this function does nothing. For sequential tasks this spawns
+    # the next subtask (or update sender status to finished), and for parallel
+    # tasks it launches all subtasks
+    task.execute()
 
 def cancel_reserved_subtask(task_id):
     '''
-    Cancels a reserved task. This is done by setting the task to created and
-    then sending a notification to the condition, so that the waiting threads
-    (among which the correct one will be) will wake up take the notice.
+    Cancels a reserved task whose reservation was not confirmed in time,
+    setting it back to created so that it can be reserved again. No thread
+    waits for the reservation, so there's nothing else to wake up: a
+    confirmation arriving later finds the task is no longer reserved and is
+    ignored by execute_synchronized.
 
     Note: this task is executed in cases where the task can be either local and
     not local.
@@ -242,15 +243,15 @@ def cancel_reserved_subtask(task_id):
             hasattr(task_instance.action_handler_object, "cancel_reservation"):
         task_instance.action_handler_object.cancel_reservation()
 
-    if task.status not in ['syncing', 'reserved']:
-        return
+    # the status is checked and changed with the task locked, because the
+    # reservation might be being confirmed at the same time
+    with task_instance.locked():
+        if task.status not in ['syncing', 'reserved']:
+            return
 
-    task.status = "created"
-    task.last_modified_date = datetime.utcnow()
-    db.session.add(task)
-    db.session.commit()
-    with _reserve_condition:
-        _reserve_condition.notify_all()
+        task.status = "created"
+        task.last_modified_date = datetime.utcnow()
+        db.session.add(task)
 
 def ack_reservation(task_id):
     '''
@@ -282,7 +283,8 @@ def ack_reservation(task_id):
     }
     send_message(msg)
 
-@decorators.message_action(action="frestq.synchronize_task", queue=INTERNAL_SCHEDULER_NAME)
+@decorators.message_action(action="frestq.synchronize_task", queue=INTERNAL_SCHEDULER_NAME,
+                            priority=PROTOCOL_PRIORITY)
 def synchronize_task(msg):
     '''
     Receives a task that needs to be synchronized because its parent is a
@@ -319,7 +321,14 @@ def synchronize_task(msg):
         }
         task = ModelTask(**kwargs)
         db.session.add(task)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # the director might send again the synchronization message while
+            # the task is not reserved, and another thread created the task
+            db.session.rollback()
+            logging.debug("TASK with id %s is already syncing" % msg.task_id)
+            return
     else:
         if certs_differ(task.sender_ssl_cert, msg.sender_ssl_cert):
             raise  SecurityException()
@@ -333,16 +342,18 @@ def synchronize_task(msg):
         db.session.commit()
 
     sched = FScheduler.get_scheduler(task.queue_name)
-    sched.add_now_job(reserve_task, [task.id])
+    sched.add_now_job(reserve_task, [task.id], priority=PROTOCOL_PRIORITY)
 
     # schedule expiration
     if task.expiration_date:
-        sched = FScheduler.get_scheduler(INTERNAL_SCHEDULER_NAME)
+        sched = FScheduler.get_scheduler(INTERNAL_TIMER_SCHEDULER_NAME)
         date = datetime.utcnow() + timedelta(seconds=app.config.get('RESERVATION_TIMEOUT'))
-        sched.add_date_job(cancel_reserved_subtask, date, [task.id])
+        sched.add_date_job(cancel_reserved_subtask, date, [task.id],
+                           priority=PROTOCOL_PRIORITY)
 
 
-@decorators.message_action(action="frestq.confirm_task_reservation", queue=INTERNAL_SCHEDULER_NAME)
+@decorators.message_action(action="frestq.confirm_task_reservation", queue=INTERNAL_SCHEDULER_NAME,
+                            priority=PROTOCOL_PRIORITY)
 def director_confirm_task_reservation(msg):
     '''
     Director of a synchronized task receives a task reservation
@@ -375,10 +386,11 @@ def director_confirm_task_reservation(msg):
     logging.debug("CONFIRMED TASK RESERVATION with id %s" % msg.task_id)
 
     # set reservation timeout
-    sched = FScheduler.get_scheduler(INTERNAL_SCHEDULER_NAME)
+    timer_sched = FScheduler.get_scheduler(INTERNAL_TIMER_SCHEDULER_NAME)
     expire_secs = msg.input_data['reservation_expiration_seconds']
     date = msg.created_date + timedelta(seconds=expire_secs)
-    sched.add_date_job(director_cancel_reserved_subtask, date, [task.id])
+    timer_sched.add_date_job(director_cancel_reserved_subtask, date, [task.id],
+                       priority=PROTOCOL_PRIORITY)
 
     # call to the new_reservation handler
     if parent_instance.action_handler_object and\
@@ -386,11 +398,15 @@ def director_confirm_task_reservation(msg):
         parent_instance.action_handler_object.new_reservation(task_instance)
 
     # find any unreserved task, send reservation
+    sched = FScheduler.get_scheduler(INTERNAL_SCHEDULER_NAME)
     not_reserved_children_num = 0
     for child in parent_instance.get_children():
         if child.task_model.status == 'created':
             not_reserved_children_num += 1
-            sched.add_now_job(send_synchronization_message, [child.task_model.id])
+            sched.add_now_job(send_synchronization_message,
+                              [child.task_model.id],
+                              priority=PROTOCOL_PRIORITY,
+                              fair_key=parent_instance.task_model.id)
 
     # continue to do subtasks starting only if all are reserved
     if not_reserved_children_num != 0:
@@ -401,8 +417,12 @@ def director_confirm_task_reservation(msg):
         parent_instance.action_handler_object.pre_execute()
 
     # start all children in parallel
+    sched = FScheduler.get_scheduler(INTERNAL_SCHEDULER_NAME)
     for child in parent_instance.get_children():
-        sched.add_now_job(director_synchronized_subtask_start, [child.task_model.id])
+        sched.add_now_job(director_synchronized_subtask_start,
+                          [child.task_model.id],
+                          priority=PROTOCOL_PRIORITY,
+                          fair_key=parent_instance.task_model.id)
 
 def director_cancel_reserved_subtask(task_id):
     '''
@@ -439,7 +459,10 @@ def director_cancel_reserved_subtask(task_id):
     # find any unreserved task, send reservation
     for child in parent_instance.get_children():
         if child.task_model.status == 'created':
-            sched.add_now_job(send_synchronization_message, [child.task_model.id])
+            sched.add_now_job(send_synchronization_message,
+                              [child.task_model.id],
+                              priority=PROTOCOL_PRIORITY,
+                              fair_key=parent_instance.task_model.id)
 
 def director_synchronized_subtask_start(task_id):
     '''
@@ -471,7 +494,8 @@ def director_synchronized_subtask_start(task_id):
     send_message(msg)
 
 
-@decorators.message_action(action="frestq.execute_synchronized", queue=INTERNAL_SCHEDULER_NAME)
+@decorators.message_action(action="frestq.execute_synchronized", queue=INTERNAL_SCHEDULER_NAME,
+                            priority=PROTOCOL_PRIORITY)
 def execute_synchronized(msg):
 
     from .app import db
@@ -489,14 +513,23 @@ def execute_synchronized(msg):
     if certs_differ(task.sender_ssl_cert, msg.sender_ssl_cert):
         raise  SecurityException()
 
+    # the status is checked and changed with the task locked, because the
+    # reservation might be being cancelled at the same time
     task_instance = BaseTask.instance_by_model(task)
-    task.input_data = msg.input_data['input_data']
-    task.status = "confirmed"
-    task.last_modified_date = datetime.utcnow()
-    db.session.add(task)
-    db.session.commit()
-    with _reserve_condition:
-        _reserve_condition.notify_all()
+    with task_instance.locked():
+        if task.status != 'reserved':
+            return
+
+        task.input_data = msg.input_data['input_data']
+        task.status = "confirmed"
+        task.last_modified_date = datetime.utcnow()
+        db.session.add(task)
+
+    # the other peers are holding their reservations until this task is
+    # executed, so it goes before the user tasks waiting in its queue
+    sched = FScheduler.get_scheduler(task.queue_name)
+    sched.add_now_job(execute_reserved_task, [task.id],
+                      priority=max(PROTOCOL_PRIORITY, task.priority or 0))
 
 
 @decorators.message_action(action="frestq.finish_external_task", queue=INTERNAL_SCHEDULER_NAME)
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+# SPDX-FileCopyrightText: 2014-2021 Sequent Tech Inc <legal@sequentech.io>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import os
+import socket
+import logging
+import importlib
+from uuid import uuid4
+from threading import Event, Lock, Thread
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from apscheduler.events import (EVENT_JOB_EXECUTED, EVENT_JOB_ERROR,
+                                EVENT_JOB_MISSED)
+
+from .app import db, app
+from .fscheduler import FScheduler, OUTBOX_SCHEDULER_NAME
+from .metrics import Metrics
+from .models import ReadyJob
+
+# Ready queue of jobs stored in the database.
+#
+# When READY_QUEUE is enabled, FScheduler.add_now_job() does not schedule the
+# job in memory. Instead, it's inserted in the ready_job table within the
+# current transaction, so that the job becomes runnable when the change that
+# made it runnable is committed, and it's not lost if the process dies.
+#
+# Each frestq process sharing the database runs a poller thread that claims
+# ready jobs of its queues with SELECT ... FOR UPDATE SKIP LOCKED, never more
+# than the free threads of each queue, and executes them in the in-memory
+# scheduler of the queue. This way the work of a queue is spread among all the
+# processes. Claims of running jobs are renewed periodically, and the jobs of
+# a claim that expired, because the process that claimed them died, are
+# claimed again by other process. Thus jobs are executed at least once.
+#
+# Unlike the jobs scheduled in memory, a job that raises an exception, for
+# example because of a transient database error, is released to be claimed
+# again, and only removed once it failed READY_QUEUE_MAX_ATTEMPTS times.
+#
+# Jobs must be module level functions with json serializable arguments.
+# Other jobs are scheduled in memory as usual.
+
+class ReadyQueue(object):
+    '''
+    Keeps track of the jobs of the ready queue claimed and being executed by
+    this process
+    '''
+    # identifies this process in the claims
+    worker_id = "%s:%d:%s" % (socket.gethostname(), os.getpid(),
+                              uuid4().hex[:8])
+
+    # ids of the jobs being executed, by queue name
+    _running = dict()
+
+    _last_renewal = datetime.utcnow()
+
+    _funcs = dict()
+
+    _lock = Lock()
+
+    # set to poll the ready queue without waiting for READY_QUEUE_POLL_INTERVAL
+    _wakeup = Event()
+
+    _thread = None
+
+    # queues whose scheduler has the job_done listener
+    _listening = set()
+
+    @staticmethod
+    def func_ref(func):
+        '''
+        Returns the reference to a function stored in the ready queue, or None
+        if it's not a module level function
+        '''
+        module = getattr(func, '__module__', None)
+        qualname = getattr(func, '__qualname__', '')
+        if not module or not qualname or '<locals>' in qualname:
+            return None
+        return "%s:%s" % (module, qualname)
+
+    @staticmethod
+    def resolve(func_ref):
+        '''
+        Returns the function referenced by func_ref
+        '''
+        func = ReadyQueue._funcs.get(func_ref, None)
+        if func is None:
+            module_name, qualname = func_ref.split(':', 1)
+            func = importlib.import_module(module_name)
+            for name in qualname.split('.'):
+                func = getattr(func, name)
+            ReadyQueue._funcs[func_ref] = func
+        return func
+
+    @staticmethod
+    def handles(queue_name, func):
+        '''
+        Returns whether a job for the given queue and function should be
+        stored in the ready queue
+        '''
+        return app.config.get('READY_QUEUE', False) and\
+            queue_name != OUTBOX_SCHEDULER_NAME and\
+            ReadyQueue.func_ref(func) is not None
+
+    @staticmethod
+    def add(queue_name, func, args=None, kwargs=None, priority=0,
+            fair_key=None):
+        '''
+        Inserts a job in the ready queue, in the current transaction
+        '''
+        job = ReadyJob(
+            queue_name=queue_name,
+            func=ReadyQueue.func_ref(func),
+            args=list(args or []),
+            kwargs=dict(kwargs or {}),
+            priority=priority or 0,
+            fair_key=fair_key)
+        db.session.add(job)
+        db.session.info['frestq_ready_jobs'] = True
+
+    @staticmethod
+    def claimable(now):
+        '''
+        Filter of the jobs that are not claimed or whose claim expired
+        '''
+        timeout = app.config.get('READY_QUEUE_CLAIM_TIMEOUT', 300)
+        return db.or_(
+            ReadyJob.claimed_date == None,
+            ReadyJob.claimed_date < now - timedelta(seconds=timeout))
+
+    @staticmethod
+    def claim(queue_name, limit):
+        '''
+        Claims up to limit ready jobs of a queue, skipping those locked by
+        other processes that are claiming them. Returns the claimed jobs.
+        '''
+        now = datetime.utcnow()
+        job_ids = [
+            job_id
+            for job_id, in db.session.query(ReadyJob.id)\
+                .filter(ReadyJob.queue_name == queue_name,
+                        ReadyQueue.claimable(now))\
+                .order_by(ReadyJob.priority.desc(), ReadyJob.id)\
+                .limit(limit)\
+                .with_for_update(skip_locked=True)
+        ]
+        if not job_ids:
+            db.session.commit()
+            return []
+
+        # the claimable filter is repeated, because the databases that do
+        # not support row locks (sqlite) ignore FOR UPDATE
+        db.session.query(ReadyJob)\
+            .filter(ReadyJob.id.in_(job_ids), ReadyQueue.claimable(now))\
+            .update({'claimed_by': ReadyQueue.worker_id, 'claimed_date': now},
+                    synchronize_session=False)
+        db.session.commit()
+
+        return db.session.query(ReadyJob)\
+            .filter(ReadyJob.id.in_(job_ids),
+                    ReadyJob.claimed_by == ReadyQueue.worker_id)\
+            .order_by(ReadyJob.priority.desc(), ReadyJob.id)\
+            .all()
+
+    @staticmethod
+    def renew_claims():
+        '''
+        Renews the claims of the jobs being executed, so that they don't
+        expire while they run
+        '''
+        timeout = app.config.get('READY_QUEUE_CLAIM_TIMEOUT', 300)
+        now = datetime.utcnow()
+        if now - ReadyQueue._last_renewal < timedelta(seconds=timeout/3.0):
+            return
+
+        with ReadyQueue._lock:
+            job_ids = [
+                job_id
+                for running in ReadyQueue._running.values()
+                for job_id in running
+            ]
+        ReadyQueue._last_renewal = now
+        if not job_ids:
+            return
+
+        db.session.query(ReadyJob)\
+            .filter(ReadyJob.id.in_(job_ids),
+                    ReadyJob.claimed_by == ReadyQueue.worker_id)\
+            .update({'claimed_date': now}, synchronize_session=False)
+        db.session.commit()
+
+    @staticmethod
+    def poll():
+        '''
+        Claims ready jobs for the free threads of each queue, and schedules
+        them in the queue
+        '''
+        ReadyQueue.renew_claims()
+
+        for queue_name, sched in list(FScheduler._schedulers.items()):
+            if queue_name == OUTBOX_SCHEDULER_NAME:
+                continue
+
+            with ReadyQueue._lock:
+                running = ReadyQueue._running.setdefault(queue_name, set())
+                free = sched.max_threads - len(running)
+            if free <= 0:
+                continue
+
+            if queue_name not in ReadyQueue._listening:
+                sched.add_listener(ReadyQueue.job_done,
+                                   EVENT_JOB_EXECUTED | EVENT_JOB_ERROR |
+                                   EVENT_JOB_MISSED)
+                ReadyQueue._listening.add(queue_name)
+
+            for job in ReadyQueue.claim(queue_name, free):
+                with ReadyQueue._lock:
+                    running.add(job.id)
+                logging.debug("CLAIMED ready job %d (%s) in queue %s" % (
+                    job.id, job.func, queue_name))
+                sched.add_local_job(
+                    run_ready_job,
+                    [job.id, job.func, list(job.args or []),
+                     dict(job.kwargs or {})],
+                    priority=job.priority,
+                    fair_key=job.fair_key,
+                    id="ready_job:%s:%d" % (queue_name, job.id),
+                    name=job.func)
+
+    @staticmethod
+    def job_done(event):
+        '''
+        Listener of the schedulers called when a job finishes. If it's a job
+        of the ready queue, there's a free thread in the queue, so we poll
+        again. This is done here instead of in run_ready_job because that
+        might be executed in a worker process.
+        '''
+        if not event.job_id.startswith("ready_job:"):
+            return
+
+        queue_name, job_id = event.job_id[len("ready_job:"):].rsplit(':', 1)
+        with ReadyQueue._lock:
+            ReadyQueue._running.get(queue_name, set()).discard(int(job_id))
+        ReadyQueue._wakeup.set()
+
+    @staticmethod
+    def finish(job_id):
+        '''
+        Removes a job from the ready queue once executed
+        '''
+        db.session.query(ReadyJob)\
+            .filter(ReadyJob.id == job_id)\
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+    @staticmethod
+    def release(job_id):
+        '''
+        Releases the claim of a job that failed, so that it's claimed again,
+        or removes it if it failed READY_QUEUE_MAX_ATTEMPTS times
+        '''
+        job = db.session.query(ReadyJob).get(job_id)
+        if job is None:
+            return
+
+        job.attempts = (job.attempts or 0) + 1
+        if job.attempts >= app.config.get('READY_QUEUE_MAX_ATTEMPTS', 3):
+            logging.error("ready job %d (%s) failed %d times, removing it" % (
+                job_id, job.func, job.attempts))
+            db.session.delete(job)
+        else:
+            job.claimed_by = None
+            job.claimed_date = None
+            db.session.info['frestq_ready_jobs'] = True
+        db.session.commit()
+
+    @staticmethod
+    def run():
+        '''
+        Main loop of the poller thread
+        '''
+        interval = app.config.get('READY_QUEUE_POLL_INTERVAL', 1)
+        while True:
+            ReadyQueue._wakeup.wait(interval)
+            ReadyQueue._wakeup.clear()
+            try:
+                ReadyQueue.poll()
+            except Exception:
+                logging.exception("error polling the ready queue")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+
+def run_ready_job(job_id, func_ref, args, kwargs):
+    '''
+    Executes a job claimed from the ready queue, and removes it from there.
+    If it fails, the job is released to be claimed again. If the job can't
+    be removed or released, its claim expires and it's claimed again.
+    '''
+    try:
+        ReadyQueue.resolve(func_ref)(*args, **kwargs)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        ReadyQueue.release(job_id)
+        raise
+    ReadyQueue.finish(job_id)
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_commit')
+def wakeup_ready_queue(session):
+    '''
+    Polls the ready queue when jobs are committed, so that they don't wait
+    for the poll interval if they can be executed by this process
+    '''
+    if session.info.pop('frestq_ready_jobs', False):
+        ReadyQueue._wakeup.set()
+
+
+@sqlalchemy.event.listens_for(db.session, 'after_soft_rollback')
+def discard_ready_jobs(session, previous_transaction):
+    session.info.pop('frestq_ready_jobs', None)
+
+
+@Metrics.add_collector
+def collect_ready_jobs():
+    '''
+    Number of jobs in the ready queue by queue, claimed or not by any process
+    '''
+    if not app.config.get('READY_QUEUE', False):
+        return []
+
+    counts = db.session.query(ReadyJob.queue_name,
+                              ReadyJob.claimed_by != None,
+                              db.func.count(ReadyJob.id))\
+        .group_by(ReadyJob.queue_name, ReadyJob.claimed_by != None)\
+        .all()
+    return [("frestq_ready_jobs", "gauge",
+             "Jobs in the ready queue of the database",
+             [(dict(queue=queue_name, claimed=str(bool(claimed)).lower()),
+               count)
+              for queue_name, claimed, count in counts])]
+
+
+def start_ready_queue():
+    '''
+    Starts the poller thread of the ready queue, if enabled
+    '''
+    if not app.config.get('READY_QUEUE', False) or ReadyQueue._thread:
+        return
+
+    logging.info("starting ready queue poller %s" % ReadyQueue.worker_id)
+    ReadyQueue._thread = Thread(target=ReadyQueue.run,
+                                name="frestq-ready-queue", daemon=True)
+    ReadyQueue._thread.start()
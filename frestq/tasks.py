@@ -5,12 +5,11 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
-import requests
 import logging
 import json
-import OpenSSL
-from threading import Lock
+from threading import RLock
 from inspect import isfunction
+from contextlib import contextmanager
 
 import copy
 from uuid import uuid4
@@ -19,10 +18,26 @@ from datetime import datetime
 from flask import request
 
 from .app import db, app
-from .fscheduler import FScheduler, INTERNAL_SCHEDULER_NAME
+from .fscheduler import (FScheduler, INTERNAL_SCHEDULER_NAME,
+                         PROTOCOL_PRIORITY)
 from .models import Task as ModelTask, Message as ModelMessage
+from .outbox import queue_message
 from .utils import dumps
 
+class TaskLocks(object):
+    '''
+    Striped in-process locks for tasks. Concurrent executions of the same
+    task in different threads wait on its lock instead of on the database row
+    lock, while unrelated tasks (most likely in different stripes) progress
+    concurrently.
+    '''
+    _locks = [RLock() for i in range(64)]
+
+    @staticmethod
+    def lock(task_id):
+        return TaskLocks._locks[hash(task_id) % len(TaskLocks._locks)]
+
+
 class BaseTask(object):
     '''
     Base task to be inherited by SimpleTask, SequentialTask, etc.
@@ -89,7 +104,8 @@ class BaseTask(object):
             'sender_ssl_cert': app.config.get('SSL_CERT_STRING', ''),
             'receiver_url': self.task_model.receiver_url,
             'input_data': self.task_model.input_data,
-            'task_id': self.task_model.id
+            'task_id': self.task_model.id,
+            'priority': self.task_model.priority
         }
         logging.debug('SEND task MESSAGE to %s, TASK id = %s' % (
             self.task_model.receiver_url, msg_data['task_id']))
@@ -97,9 +113,8 @@ class BaseTask(object):
         # update db
         self.task_model.status = "sent"
         db.session.add(self.task_model)
-        db.session.commit()
-
         send_message(msg_data, update_task_receiver_ssl_cert=True, task=self.task_model)
+        db.session.commit()
 
     def set_reservation_data(self, data):
         '''
@@ -290,6 +305,34 @@ class BaseTask(object):
         '''
         pass
 
+    @contextmanager
+    def locked(self):
+        '''
+        Context manager that locks the task, both in this process and in the
+        database with SELECT ... FOR UPDATE, so that it can be safely updated
+        even by other processes using the same database. The task model is
+        refreshed once locked. When leaving the context the transaction is
+        committed, releasing the lock, or rolled back if there was an error.
+        '''
+        # commit before waiting for the lock, so that we don't wait for it
+        # while keeping database locks of any previous write
+        db.session.commit()
+        with TaskLocks.lock(self.task_model.id):
+            try:
+                # only the row of the task is locked and refreshed, not the
+                # rows of its subtasks
+                db.session.query(ModelTask)\
+                    .options(db.lazyload(ModelTask.subtasks))\
+                    .filter(ModelTask.id == self.task_model.id)\
+                    .with_for_update()\
+                    .populate_existing()\
+                    .one()
+                yield
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
     def execute_parent(self):
         '''
         Executes parent task if there's any.
@@ -323,16 +366,21 @@ class SimpleTask(BaseTask):
     info_text = None
     expiration_date = None
     pingback_date = None
+    priority = None
 
     auto_finish_after_handler = True
 
     def __init__(self, receiver_url, action, queue, data=None, label=None,
             info_text=None, pingback_date=None, expiration_date=None,
-            receiver_ssl_cert=None):
+            receiver_ssl_cert=None, priority=None):
         '''
         Constructor of a simple tasks. It takes as input all the information
         needed to send the single task to the receiver end.
 
+        priority is the priority of the jobs of the task, both in the sender
+        and in the receiver. If None, the priority of the action handler of the
+        receiver is used.
+
         Note: to save the task in the database of the sender you need to call
         to create(), and to send it to the receiver, call to send().
         '''
@@ -346,6 +394,7 @@ class SimpleTask(BaseTask):
         self.expiration_date = expiration_date
         self.pingback_date = pingback_date
         self.receiver_ssl_cert = receiver_ssl_cert
+        self.priority = priority
 
     @classmethod
     def _create_from_model(cls, task_model):
@@ -356,7 +405,8 @@ class SimpleTask(BaseTask):
             data=task_model.input_data,
             pingback_date=task_model.pingback_date,
             expiration_date=task_model.expiration_date,
-            label=task_model.label
+            label=task_model.label,
+            priority=task_model.priority
        )
         ret.task_model = task_model
         # local task do not need updates
@@ -387,6 +437,7 @@ class SimpleTask(BaseTask):
             'pingback_date': self.pingback_date,
             'expiration_date': self.expiration_date,
             'info_text': self.info_text,
+            'priority': self.priority,
             'id': task_id,
             'status': 'created',
             'task_type': 'simple',
@@ -503,7 +554,9 @@ class ExternalTask(SimpleTask):
             'input_data': data,
             'task_id': self.task_model.id
         }
-        send_message(msg_data)
+        msg = send_message(msg_data)
+        db.session.commit()
+        return msg
 
     def execute(self):
         '''
@@ -647,7 +700,7 @@ class SequentialTask(BaseTask):
 
             # update the sender if any
             if not self.task_model.is_local:
-                sched = FScheduler.get_scheduler(self.task_model.queue_name)
+                sched = FScheduler.get_scheduler(INTERNAL_SCHEDULER_NAME)
                 sched.add_now_job(send_task_update, [self.task_model.id])
 
 
@@ -705,9 +758,6 @@ class ParallelTask(BaseTask):
     '''
     _subtasks = []
 
-    # used to remove race conditions
-    _db_lock = Lock()
-
     def __init__(self, label=""):
         '''
         Constructor, takes no arguments as it is a virtual task.
@@ -782,9 +832,22 @@ class ParallelTask(BaseTask):
         '''
         Count the number of subtasks
         '''
+        if self.task_model.num_subtasks is not None:
+            return self.task_model.num_subtasks -\
+                self.task_model.num_finished_subtasks
+
         return db.session.query(ModelTask).with_parent(self.task_model,
             "subtasks").filter(ModelTask.status != 'finished').count()
 
+    def count_errored_subtasks(self):
+        '''
+        Count the number of subtasks with error
+        '''
+        if self.task_model.num_errored_subtasks is not None:
+            return self.task_model.num_errored_subtasks
+
+        return self.errored_tasks().count()
+
     def next_subtask(self):
         '''
         Returns next subtask if any or None
@@ -808,68 +871,96 @@ class ParallelTask(BaseTask):
         if self.task_model.status == 'error':
             return
 
-        try:
-            self._db_lock.acquire()
-            db.session.commit()
+        # the next step is done once this task is unlocked, so that the lock
+        # of the parent task is never acquired while holding this one
+        with self.locked():
+            next_step = self._update_status()
 
-            # paranoid mode, do not trust old tasks. check if task finished
-            db.session.expire(self.task_model)
-            db.session.refresh(self.task_model)
-            # should have been already dealt with
-            if self.task_model.status == 'finished':
-              return
-
-            num_unfinished_subtasks = self.count_unfinished_subtasks()
-
-            # if we find an error, propagate, as this kind of task do not have an
-            # action handler that can stop it
-            errored_tasks = self.errored_tasks()
-            if errored_tasks.count() > 0:
-                self.error = SubTasksFailed(errored_tasks)
-                self.task_model.status = "error"
-                db.session.add(self.task_model)
-                db.session.commit()
-                self._db_lock.release()
-
-                # propagate
-                self.execute_parent()
-                return
-
-            # if this is the first time do next is called and there are subtasks,
-            # let's mark this task as executing and start all the subtasks in
-            # parallel
-            if self.task_model.status in ['created', 'sent'] and num_unfinished_subtasks > 0:
-                # mark as executing this task
-                self.task_model.status = "executing"
-                db.session.add(self.task_model)
-                db.session.commit()
-                self._db_lock.release()
+        if next_step:
+            next_step()
 
-                # start subtasks in parallel
-                subtasks = db.session.query(ModelTask).with_parent(self.task_model, "subtasks")
-                for subtask in subtasks:
-                    sched = FScheduler.get_scheduler(subtask.queue_name)
-                    sched.add_now_job(execute_task, [subtask.id])
-                return
+    def _update_status(self):
+        '''
+        Updates the status of the task depending on the status of its subtasks.
+        Called with the task locked. Returns the function to call once the
+        task is unlocked, if any.
+        '''
+        # should have been already dealt with
+        if self.task_model.status == 'finished':
+            return None
 
+        num_unfinished_subtasks = self.count_unfinished_subtasks()
 
-            # check if there's no subtask left to do, and send the do next signal
-            # for parent task if it has one
-            if num_unfinished_subtasks == 0:
-                # mark as finished
-                self.task_model.status = "finished"
-                db.session.add(self.task_model)
-                db.session.commit()
-                self._db_lock.release()
+        # if we find an error, propagate, as this kind of task do not have an
+        # action handler that can stop it
+        if self.count_errored_subtasks() > 0:
+            self.error = SubTasksFailed(self.errored_tasks())
+            self.task_model.status = "error"
+            db.session.add(self.task_model)
 
-                # check if there's a parent task, and if so execute() it
-                self.execute_parent()
-        finally:
-            try:
-                self._db_lock.release()
-            except:
-                # we might have released it already, don't wory about that
-                pass
+            # propagate
+            return self.execute_parent
+
+        # if this is the first time do next is called and there are subtasks,
+        # let's mark this task as executing and start all the subtasks in
+        # parallel
+        if self.task_model.status in ['created', 'sent'] and num_unfinished_subtasks > 0:
+            # mark as executing this task
+            self.task_model.status = "executing"
+            db.session.add(self.task_model)
+            return self._start_subtasks()
+
+        # check if there's no subtask left to do, and send the do next signal
+        # for parent task if it has one
+        if num_unfinished_subtasks == 0:
+            # mark as finished
+            self.task_model.status = "finished"
+            db.session.add(self.task_model)
+
+            # check if there's a parent task, and if so execute() it
+            return self.execute_parent
+
+        return None
+
+    def _start_subtasks(self):
+        '''
+        Starts all the subtasks in parallel. Called with the task locked, see
+        add_now_jobs().
+        '''
+        subtasks = db.session.query(ModelTask).with_parent(self.task_model, "subtasks")
+        return add_now_jobs([
+            (FScheduler.get_scheduler(subtask.queue_name), execute_task,
+             [subtask.id], dict(priority=subtask.priority or 0,
+                                fair_key=self.task_model.id))
+            for subtask in subtasks
+        ])
+
+
+def add_now_jobs(jobs):
+    '''
+    Schedules a list of (scheduler, func, args, kwargs) jobs started by a
+    locked task. The jobs stored in the ready queue are inserted right away,
+    in the same transaction that changes the status of the task. The rest
+    are scheduled in memory by the returned function, to be called once the
+    task is unlocked, so that they don't run before the status change is
+    committed. Returns None if there's nothing left to schedule.
+    '''
+    from .ready_queue import ReadyQueue
+
+    deferred = []
+    for sched, func, args, kwargs in jobs:
+        if ReadyQueue.handles(sched.queue_name, func):
+            sched.add_now_job(func, args, **kwargs)
+        else:
+            deferred.append((sched, func, args, kwargs))
+
+    if not deferred:
+        return None
+
+    def schedule_deferred():
+        for sched, func, args, kwargs in deferred:
+            sched.add_now_job(func, args, **kwargs)
+    return schedule_deferred
 
 
 def send_synchronization_message(task_id):
@@ -919,9 +1010,6 @@ class SynchronizedTask(BaseTask):
     '''
     _subtasks = []
 
-    # used to remove race conditions
-    _db_lock = Lock()
-
     handler = None
 
     def __init__(self, label="", handler=None):
@@ -1002,9 +1090,22 @@ class SynchronizedTask(BaseTask):
         '''
         Count the number of subtasks
         '''
+        if self.task_model.num_subtasks is not None:
+            return self.task_model.num_subtasks -\
+                self.task_model.num_finished_subtasks
+
         return db.session.query(ModelTask).with_parent(self.task_model,
             "subtasks").filter(ModelTask.status != 'finished').count()
 
+    def count_errored_subtasks(self):
+        '''
+        Count the number of subtasks with error
+        '''
+        if self.task_model.num_errored_subtasks is not None:
+            return self.task_model.num_errored_subtasks
+
+        return self.errored_tasks().count()
+
     def next_subtask(self):
         '''
         Returns next subtask if any or None
@@ -1027,75 +1128,64 @@ class SynchronizedTask(BaseTask):
         if self.task_model.status == 'error':
             return
 
-        try:
-            self._db_lock.acquire()
-            db.session.commit()
+        # the next step is done once this task is unlocked, so that the lock
+        # of the parent task is never acquired while holding this one
+        with self.locked():
+            next_step = self._update_status()
 
-            # paranoid mode, do not trust old tasks. check if task finished
-            db.session.expire(self.task_model)
-            db.session.refresh(self.task_model)
-            # should have been already dealt with
-            if self.task_model.status == 'finished':
-              return
+        if next_step:
+            next_step()
 
-            num_unfinished_subtasks = self.count_unfinished_subtasks()
+    def _update_status(self):
+        '''
+        Updates the status of the task depending on the status of its subtasks.
+        Called with the task locked. Returns the function to call once the
+        task is unlocked, if any.
+        '''
+        # should have been already dealt with
+        if self.task_model.status == 'finished':
+            return None
 
+        num_unfinished_subtasks = self.count_unfinished_subtasks()
 
-            # if we find an error, propagate, as this kind of task do not have an
-            # action handler that can stop it
-            errored_tasks = self.errored_tasks()
-            if errored_tasks.count() > 0:
-                self.error = SubTasksFailed(errored_tasks)
-                self.task_model.status = "error"
-                db.session.add(self.task_model)
-                db.session.commit()
-                self._db_lock.release()
-
-                # propagate
-                self.execute_parent()
-                return
-
-            # if this is the first time do next is called and there are subtasks,
-            # let's mark this task as executing and start doing the synchronization
-            if self.task_model.status in ['created', 'sent']:
-                self._synchronize()
-
-            # check if there's no subtask left to do, and send the do next signal
-            # for parent task if it has one
-            elif num_unfinished_subtasks == 0:
-                self._finish()
-        finally:
-            try:
-                self._db_lock.release()
-            except:
-                # we might have released it already, don't wory about that
-                pass
+        # if we find an error, propagate, as this kind of task do not have an
+        # action handler that can stop it
+        if self.count_errored_subtasks() > 0:
+            self.error = SubTasksFailed(self.errored_tasks())
+            self.task_model.status = "error"
+            db.session.add(self.task_model)
 
-    def _synchronize(self):
-        # mark as executing this task
-        self.task_model.status = "executing"
-        db.session.add(self.task_model)
-        db.session.commit()
-        self._db_lock.release()
+            # propagate
+            return self.execute_parent
 
-        # send initial synchronization message to subtasks
-        subtasks = db.session.query(ModelTask).with_parent(self.task_model, "subtasks")
-        for subtask in subtasks:
-            sched = FScheduler.get_scheduler(INTERNAL_SCHEDULER_NAME)
-            sched.add_now_job(send_synchronization_message, [subtask.id])
+        # if this is the first time do next is called and there are subtasks,
+        # let's mark this task as executing and start doing the synchronization
+        if self.task_model.status in ['created', 'sent']:
+            self.task_model.status = "executing"
+            db.session.add(self.task_model)
+            return self._synchronize()
 
-    def _finish(self):
+        # check if there's no subtask left to do, and send the do next signal
+        # for parent task if it has one
+        elif num_unfinished_subtasks == 0:
+            self.task_model.status = "finished"
+            db.session.add(self.task_model)
+            return self.execute_parent
+
+        return None
+
+    def _synchronize(self):
         '''
-        Called by execute when all tasks have finished
+        Sends the initial synchronization message to the subtasks. Called with
+        the task locked, see add_now_jobs().
         '''
-        # mark as finished
-        self.task_model.status = "finished"
-        db.session.add(self.task_model)
-        db.session.commit()
-        self._db_lock.release()
-
-        # check if there's a parent task, and if so execute() it
-        self.execute_parent()
+        subtasks = db.session.query(ModelTask).with_parent(self.task_model, "subtasks")
+        sched = FScheduler.get_scheduler(INTERNAL_SCHEDULER_NAME)
+        return add_now_jobs([
+            (sched, send_synchronization_message, [subtask.id],
+             dict(priority=PROTOCOL_PRIORITY, fair_key=self.task_model.id))
+            for subtask in subtasks
+        ])
 
 
 def send_message(msg_data, update_task_receiver_ssl_cert=False, task=None):
@@ -1112,7 +1202,15 @@ def send_message(msg_data, update_task_receiver_ssl_cert=False, task=None):
     * task_id
     * pingback_date
     * expiration_date
-    * info
+    * priority
+
+    The message is stored in the outbox in the current transaction, without
+    committing it, and delivered asynchronously by the outbox scheduler once
+    it's committed, retrying if needed. See outbox.py for details. Messages
+    sent to ourselves are delivered without any HTTP request, unless
+    LOCAL_MESSAGES_SHORTCUT is disabled.
+
+    Returns the message model.
     '''
 
     # create message and save it in the database
@@ -1121,69 +1219,37 @@ def send_message(msg_data, update_task_receiver_ssl_cert=False, task=None):
     msg_data['is_received'] = False
     msg_data['sender_url'] = app.config.get('ROOT_URL')
     msg_data['sender_ssl_cert'] = app.config.get('SSL_CERT_STRING', '')
+    msg_data['send_status'] = 'pending'
+    msg_data['send_attempts'] = 0
+    msg_data['next_send_date'] = datetime.utcnow()
+    msg_data['update_task_receiver_ssl_cert'] = bool(
+        update_task_receiver_ssl_cert and task)
     msg = ModelMessage(**msg_data)
 
-    # send it to the peer
-    url =  "%s/%s/" % (msg_data['receiver_url'], msg_data['queue_name'])
-    payload = {
-        'message_id': msg.id,
-        'action': msg.action,
-        'sender_url': msg.sender_url,
-        "data": msg_data.get('input_data', '')
-    }
-    opts = ['async_data', 'task_id', 'pingback_date', 'expiration_date', 'info']
-    for opt in opts:
-        if opt in msg_data and msg_data[opt] != None:
-            payload[opt] = msg_data[opt]
+    logging.debug('QUEUING MESSAGE id %s with action %s to %s' % (
+        msg.id, msg.action, msg.receiver_url))
 
-    logging.debug('SENDING MESSAGE id %s with action %s to %s' % (
-        msg.id, msg.action, url))
+    queue_message(msg)
+    return msg
 
-    # msg is saved before sending the message so that it's registered (it might
-    # get even be retrieved from DB by api.py:post_message() if it's a local
-    # message, but it's also updated when the msg is sent to update output
-    db.session.add(msg)
-    db.session.commit()
 
-    session = requests.sessions.Session()
+def send_local_message(msg, task=None):
+    '''
+    Delivers a message of the outbox sent to ourselves. If task is given, its
+    receiver certificate is updated.
+    '''
+    from .api import deliver_local_message
 
+    msg.send_attempts = 1
+    msg.output_status = deliver_local_message(msg)
+    msg.send_status = 'sent' if msg.output_status < 400 else 'dead'
+    msg.next_send_date = None
     if app.config.get('SSL_CERT_PATH', ''):
-        # further verification is done later. for now we verify that it's in
-        # the list of allowed peers, but not which peer exactly should it be
-        r = session.request(
-            'post', 
-            url, 
-            data=dumps(payload), 
-            verify=app.config.get('SSL_CALIST_PATH', ''),
-            cert=(
-                app.config.get('SSL_CERT_PATH', ''),
-                app.config.get('SSL_KEY_PATH', '')
-            )
-        )
-
-        # convert the asn1 cert retrieved from the socket into pem format
-        try:
-            cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, r.raw.peer_cert)
-            msg.receiver_ssl_cert = OpenSSL.crypto\
-                .dump_certificate(OpenSSL.crypto.FILETYPE_PEM, cert)\
-                .decode('utf-8')
-            if update_task_receiver_ssl_cert and task:
-                task.receiver_ssl_cert = msg.receiver_ssl_cert
-                db.session.add(task)
-                db.session.commit()
-
-        except Exception as e:
-            pass
-
-    else:
-        r = session.request('post', url, data=dumps(payload))
-
-
-    # TODO: check r.status_code and do some retries if it failed
-    msg.output_status = r.status_code
-    if r.status_code >= 400:
-        print("!!! ERROR request to url = '%s' and status = '%d' answered:\n%s" % (url, r.status_code, r.text))
-
+        # we are the receiver, so the receiver certificate is our own
+        msg.receiver_ssl_cert = app.config.get('SSL_CERT_STRING', '')
+        if task:
+            task.receiver_ssl_cert = msg.receiver_ssl_cert
+            db.session.add(task)
     db.session.add(msg)
     db.session.commit()
 
@@ -1218,22 +1284,27 @@ def send_task_update(task_id):
     '''
     logging.debug("SENDING UPDATE to TASK with id %s" % task_id)
     task = ModelTask.query.get(task_id)
-    update_msg = {
-        "action": "frestq.update_task",
-        "queue_name": INTERNAL_SCHEDULER_NAME,
-        "receiver_url": task.sender_url,
-        "receiver_ssl_cert": task.sender_ssl_cert,
-        "input_data": {
-            'output_data': task.output_data,
-            'status': task.status
-        },
-        "task_id": task.id
-    }
-    logging.debug("update_msg.inputdata: %s" % dumps(update_msg["input_data"]))
-    send_message(update_msg)
-    task.last_modified_date = datetime.utcnow()
-    db.session.add(task)
-    db.session.commit()
+
+    # the updates of a task can be sent concurrently by several jobs, so the
+    # task is read and its update queued with the task locked. Otherwise an
+    # update with an older status could be queued after a newer one, and
+    # overwrite it in the sender
+    with BaseTask.instance_by_model(task).locked():
+        update_msg = {
+            "action": "frestq.update_task",
+            "queue_name": INTERNAL_SCHEDULER_NAME,
+            "receiver_url": task.sender_url,
+            "receiver_ssl_cert": task.sender_ssl_cert,
+            "input_data": {
+                'output_data': task.output_data,
+                'status': task.status
+            },
+            "task_id": task.id
+        }
+        logging.debug("update_msg.inputdata: %s" % dumps(update_msg["input_data"]))
+        send_message(update_msg)
+        task.last_modified_date = datetime.utcnow()
+        db.session.add(task)
 
     # task finished. check if there's a parent task, and if so execute() it
     if task.parent_id:
@@ -1285,6 +1356,7 @@ def post_task(msg, action_handler):
         'expiration_date': msg.expiration_date,
         'status': 'executing',
         'info_text': msg.info_text,
+        'priority': msg.priority,
         'id': msg.task_id,
         'task_type': 'sequential'
     }
@@ -7,52 +7,353 @@
 
 import datetime
 import os
+import glob
+import gzip
+import re
 import json
-import codecs
+import hashlib
+import functools
 
+import OpenSSL
 from prettytable import PrettyTable
 
 __all__ = ['dumps', 'loads']
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Datetimes are encoded in json in ISO format. By default, in the "strings"
+# mode, the decoded strings within a dict that are datetimes in that format
+# are decoded as datetimes. In the "tagged" mode, datetimes are encoded as
+# {"$datetime": "<ISO format>"}, and only those and the strings of the keys in
+# DATETIME_KEYS are decoded, so that no time is spent trying to parse the other
+# strings. Tagged datetimes are decoded in both modes, so that all the peers
+# can be upgraded before changing to the tagged mode, see set_json_datetimes.
+DATETIME_TAG = '$datetime'
+
+# keys of the RESTQP messages that are datetimes, decoded in the tagged mode
+# too because older peers send them as strings
+DATETIME_KEYS = frozenset(['pingback_date', 'expiration_date'])
+
+# '%Y-%m-%dT%H:%M:%S.%f', the ISO format of the datetimes with microseconds
+DATETIME_RE = re.compile(
+    r'(\d{4})-(\d{1,2})-(\d{1,2})T(\d{1,2}):(\d{1,2}):(\d{1,2})\.(\d{1,6})')
+
+_tagged_datetimes = False
+
+def set_json_datetimes(mode):
+    '''
+    Sets how datetimes are encoded and decoded in json: "strings" or "tagged"
+    '''
+    global _tagged_datetimes
+    if mode not in ['strings', 'tagged']:
+        raise ValueError("invalid json datetimes mode %s" % mode)
+    _tagged_datetimes = (mode == 'tagged')
+
+def parse_datetime(value):
+    '''
+    Parses a datetime in the format '%Y-%m-%dT%H:%M:%S.%f' like strptime,
+    but much faster. Returns None if it's not a valid datetime.
+    '''
+    match = DATETIME_RE.fullmatch(value)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction = match.groups()
+    try:
+        return datetime.datetime(int(year), int(month), int(day), int(hour),
+                                 int(minute), int(second),
+                                 int(fraction.ljust(6, '0')))
+    except ValueError:
+        return None
+
+def encode_datetime(obj):
+    if _tagged_datetimes and isinstance(obj, datetime.datetime):
+        return {DATETIME_TAG: obj.isoformat()}
+    return obj.isoformat()
+
+def tagged_datetime(d):
+    '''
+    Returns the datetime of a dict that is a tagged datetime, or None
+    '''
+    if len(d) == 1 and DATETIME_TAG in d:
+        try:
+            return datetime.datetime.fromisoformat(d[DATETIME_TAG])
+        except (TypeError, ValueError):
+            pass
+    return None
+
 class JSONDateTimeEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, (datetime.date, datetime.datetime)):
-            return obj.isoformat()
+            return encode_datetime(obj)
         else:
             return json.JSONEncoder.default(self, obj)
 
+def _decode_list_datetimes(l):
+    for i, v in enumerate(l):
+        if isinstance(v, str):
+            # NOTE: change in year 2099
+            if v.startswith("20"):
+                value = parse_datetime(v)
+                if value is not None:
+                    l[i] = value
+        elif isinstance(v, list):
+            _decode_list_datetimes(v)
+
 def datetime_decoder(d):
-    if isinstance(d, list):
-        pairs = enumerate(d)
-    elif isinstance(d, dict):
-        pairs = d.items()
-    result = []
-    for k,v in pairs:
-        # NOTE: change in year 2099
-        if isinstance(v, str) and v.startswith("20"):
+    '''
+    object_hook of json.loads for the strings mode. Nested dicts have already
+    been decoded by their own call, so only the strings of this dict and of
+    the lists within it are decoded here.
+    '''
+    value = tagged_datetime(d)
+    if value is not None:
+        return value
+    for k, v in d.items():
+        if isinstance(v, str):
+            # NOTE: change in year 2099
+            if v.startswith("20"):
+                value = parse_datetime(v)
+                if value is not None:
+                    d[k] = value
+        elif isinstance(v, list):
+            _decode_list_datetimes(v)
+    return d
+
+def tagged_datetime_decoder(d):
+    '''
+    object_hook of json.loads for the tagged mode
+    '''
+    value = tagged_datetime(d)
+    if value is not None:
+        return value
+    for key in DATETIME_KEYS:
+        v = d.get(key, None)
+        if isinstance(v, str):
+            value = parse_datetime(v)
+            if value is not None:
+                d[key] = value
+    return d
+
+class JSONCodec(object):
+    '''
+    Encodes and decodes json with the json module of the standard library.
+    Datetimes are encoded in ISO format, and decoded as set with
+    set_json_datetimes.
+    '''
+    name = 'json'
+
+    def dumps(self, obj, **kwargs):
+        return json.dumps(obj, cls=JSONDateTimeEncoder, **kwargs)
+
+    def loads(self, obj, **kwargs):
+        if _tagged_datetimes:
+            return json.loads(obj, object_hook=tagged_datetime_decoder,
+                              **kwargs)
+        return json.loads(obj, object_hook=datetime_decoder, **kwargs)
+
+
+def decode_datetimes(obj, in_dict=False):
+    '''
+    Decodes in place the datetimes of a decoded json object, as the
+    datetime_decoder object_hook does: tagged datetimes and the strings within
+    a dict, at any depth. Returns the decoded object.
+    '''
+    if isinstance(obj, dict):
+        value = tagged_datetime(obj)
+        if value is not None:
+            return value
+        items = obj.items()
+        in_dict = True
+    elif isinstance(obj, list):
+        items = enumerate(obj)
+    else:
+        return obj
+
+    for k, v in items:
+        if isinstance(v, str):
+            # NOTE: change in year 2099
+            if in_dict and v.startswith("20"):
+                value = parse_datetime(v)
+                if value is not None:
+                    obj[k] = value
+        elif isinstance(v, (dict, list)):
+            value = decode_datetimes(v, in_dict)
+            if value is not v:
+                obj[k] = value
+    return obj
+
+def decode_tagged_datetimes(obj):
+    '''
+    Decodes in place the datetimes of a decoded json object, as the
+    tagged_datetime_decoder object_hook does. Returns the decoded object.
+    '''
+    if isinstance(obj, dict):
+        if len(obj) == 1 or not DATETIME_KEYS.isdisjoint(obj):
+            value = tagged_datetime_decoder(obj)
+            if value is not obj:
+                return value
+        items = obj.items()
+    elif isinstance(obj, list):
+        items = enumerate(obj)
+    else:
+        return obj
+
+    for k, v in items:
+        if isinstance(v, (dict, list)):
+            value = decode_tagged_datetimes(v)
+            if value is not v:
+                obj[k] = value
+    return obj
+
+def _isoformat(obj):
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return encode_datetime(obj)
+    raise TypeError("Object of type %s is not JSON serializable" %
+                    obj.__class__.__name__)
+
+class OrjsonCodec(JSONCodec):
+    '''
+    Encodes and decodes json with orjson, which is several times faster than
+    the json module. The output is the same json, without spaces after the
+    separators. The json module is still used when orjson can't do the same
+    (other arguments, non ASCII output that must be escaped, integers that
+    don't fit in 64 bits).
+    '''
+    name = 'orjson'
+
+    def dumps(self, obj, sort_keys=False, ensure_ascii=True, **kwargs):
+        if not kwargs:
+            option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+            if sort_keys:
+                option |= orjson.OPT_SORT_KEYS
             try:
-                v = datetime.datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%f')
-            except ValueError:
+                data = orjson.dumps(obj, default=_isoformat, option=option)
+            except TypeError:
                 pass
-        elif isinstance(v, (dict, list)):
-            v = datetime_decoder(v)
-        result.append((k, v))
-    if isinstance(d, list):
-        return [x[1] for x in result]
-    elif isinstance(d, dict):
-        return dict(result)
+            else:
+                if not ensure_ascii or data.isascii():
+                    return data.decode('utf-8')
+        return super(OrjsonCodec, self).dumps(
+            obj, sort_keys=sort_keys, ensure_ascii=ensure_ascii, **kwargs)
+
+    def loads(self, obj, **kwargs):
+        if kwargs:
+            return super(OrjsonCodec, self).loads(obj, **kwargs)
+        if _tagged_datetimes:
+            return decode_tagged_datetimes(orjson.loads(obj))
+        return decode_datetimes(orjson.loads(obj))
+
+
+JSON_CODECS = dict(json=JSONCodec)
+if orjson is not None:
+    JSON_CODECS['orjson'] = OrjsonCodec
+
+_codec = (OrjsonCodec if orjson is not None else JSONCodec)()
+
+def set_json_codec(name):
+    '''
+    Sets the codec used by dumps and loads: "json", "orjson" or "auto" to
+    use orjson if it's installed
+    '''
+    global _codec
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in JSON_CODECS:
+        raise ValueError("json codec %s not available" % name)
+    _codec = JSON_CODECS[name]()
 
 def dumps(obj, **kwargs):
     '''
     dumps that also decodes datetimes
     '''
-    return json.dumps(obj, cls=JSONDateTimeEncoder, **kwargs)
+    return _codec.dumps(obj, **kwargs)
 
 def loads(obj, **kwargs):
     '''
     loads that also encodes datetimes
     '''
-    return json.loads(obj, object_hook=datetime_decoder, **kwargs)
+    return _codec.loads(obj, **kwargs)
+
+# Wire formats of the bodies of the RESTQP requests, by mimetype. Messages are
+# sent in msgpack only to the peers that announced they accept it, see
+# OutboxPeers in outbox.py. Otherwise json is used.
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+def _msgpack_default(obj):
+    if isinstance(obj, datetime.datetime):
+        # our datetimes are naive and in UTC
+        return msgpack.Timestamp.from_datetime(
+            obj.replace(tzinfo=datetime.timezone.utc))
+    elif isinstance(obj, datetime.date):
+        return obj.isoformat()
+    raise TypeError("Object of type %s is not msgpack serializable" %
+                    obj.__class__.__name__)
+
+def naive_datetimes(obj):
+    '''
+    Converts in place the datetimes decoded by msgpack, which are in UTC, to
+    naive datetimes like the ones decoded from json
+    '''
+    if isinstance(obj, dict):
+        items = obj.items()
+    elif isinstance(obj, list):
+        items = enumerate(obj)
+    else:
+        return obj
+
+    for k, v in items:
+        if isinstance(v, datetime.datetime):
+            obj[k] = v.replace(tzinfo=None)
+        elif isinstance(v, (dict, list)):
+            naive_datetimes(v)
+    return obj
+
+def wire_formats():
+    '''
+    Returns the mimetypes of the wire formats supported, preferred first
+    '''
+    from .app import app
+    if msgpack is not None and app.config.get('WIRE_FORMAT', 'auto') == 'auto':
+        return [MSGPACK_MIMETYPE, JSON_MIMETYPE]
+    return [JSON_MIMETYPE]
+
+def encode_body(obj, mimetype=JSON_MIMETYPE):
+    '''
+    Encodes the body of a request or response in the given wire format.
+    Returns a tuple (data, mimetype), with json as the mimetype if the object
+    can't be encoded in that format, for example integers that don't fit in
+    64 bits.
+    '''
+    if mimetype == MSGPACK_MIMETYPE and msgpack is not None:
+        try:
+            return msgpack.packb(obj, default=_msgpack_default,
+                                 use_bin_type=True, datetime=True),\
+                MSGPACK_MIMETYPE
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return dumps(obj), JSON_MIMETYPE
+
+def decode_body(data, mimetype=JSON_MIMETYPE):
+    '''
+    Decodes the body of a request or response, in bytes, encoded in the wire
+    format of the given mimetype. Raises ValueError if it's not valid.
+    '''
+    if mimetype == MSGPACK_MIMETYPE:
+        if msgpack is None:
+            raise ValueError("msgpack is not installed")
+        return naive_datetimes(msgpack.unpackb(
+            data, raw=False, timestamp=3, strict_map_key=False))
+    # the json codecs decode utf-8 bytes without a decoded copy
+    return loads(data)
 
 # drb
 def get_tasks(args):
@@ -83,7 +384,6 @@ def list_tasks(args):
                          'task_type', 'status', 'created_date'])
 
     for task in tasks:
-        dict = task.to_dict()
         table.add_row([str(task.id)[:8], task.sender_url, task.action,
                        task.queue_name, task.task_type, task.status,
                        task.created_date])
@@ -106,7 +406,8 @@ def list_messages(args):
     else:
         msgs = db.session.query(Message)
 
-    msgs = msgs.order_by(Message.created_date.desc()).limit(args.limit)
+    msgs = msgs.options(db.undefer(Message.input_data))\
+        .order_by(Message.created_date.desc()).limit(args.limit)
     table = PrettyTable(['small id', 'sender_url', 'action', 'queue', 'created_date', 'input_data'])
     for msg in msgs:
         table.add_row([str(msg.id)[:8], msg.sender_url, msg.action, msg.queue_name,
@@ -181,80 +482,305 @@ def constant_time_compare(val1, val2):
         result |= ord(x) ^ ord(y)
     return result == 0
 
+def normalize_pem(cert):
+    '''
+    Normalizes the text of a PEM certificate, removing surrounding whitespace
+    from each line and carriage returns or tabs added when transmitting it
+    '''
+    return u"\n".join(
+        line.strip()
+        for line in cert.replace("\t", "").strip().splitlines()
+    )
+
+@functools.lru_cache(maxsize=256)
+def _pem_fingerprint(normalized_cert):
+    cert = OpenSSL.crypto.load_certificate(
+        OpenSSL.crypto.FILETYPE_PEM, normalized_cert)
+    der = OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_ASN1, cert)
+    return hashlib.sha256(der).hexdigest()
+
+def cert_fingerprint(cert):
+    '''
+    Returns the SHA-256 fingerprint of a PEM certificate, as an hex string.
+
+    Parsing the X.509 certificate is expensive, and the same few peer
+    certificates are compared over and over, so fingerprints are kept in a
+    bounded LRU cache keyed by the normalized PEM text. Raises
+    OpenSSL.crypto.Error if the certificate is invalid.
+    '''
+    return _pem_fingerprint(normalize_pem(cert))
+
+# file where show_activity keeps its checkpoint, in ROOT_PATH
+ACTIVITY_CHECKPOINT = "activity.checkpoint.json"
+
+ACTIVITY_TIME_FORMAT = '%Y-%m-%d %H:%M:%S,%f'
+
+def parse_since(since):
+    '''
+    Returns the --since argument in the format of the times of the activity
+    log, which can be compared as strings. It's either a local date and time
+    "YYYY-MM-DD[ HH:MM[:SS]]" or a time ago like "30m", "2h" or "1d".
+    '''
+    units = dict(s='seconds', m='minutes', h='hours', d='days')
+    if since[-1:] in units and since[:-1].isdigit():
+        date = datetime.datetime.now() - datetime.timedelta(
+            **{units[since[-1]]: int(since[:-1])})
+        return date.strftime('%Y-%m-%d %H:%M:%S')
+    for date_format in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
+        try:
+            date = datetime.datetime.strptime(since, date_format)
+            return date.strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            pass
+    raise ValueError("invalid --since: %s" % since)
+
+
+class ActivityState(object):
+    '''
+    Aggregated state of the activity log: the queues since the last START,
+    the jobs each queue is executing and how many it executed, and how long
+    they took. It's updated incrementally with each line of the log, and
+    can be stored in the checkpoint of show_activity.
+    '''
+    def __init__(self, data=None, reset_on_start=True):
+        self.data = data or self.empty(None)
+        self.reset_on_start = reset_on_start
+
+    # maximum number of jobs remembered in unseen_finished
+    max_unseen_finished = 1024
+
+    @staticmethod
+    def empty(start_date):
+        # job_names has the function of the added jobs by job id, as the
+        # other job events only have the id. removed_names has those of the
+        # jobs already removed from the scheduler, waiting to be submitted.
+        # unseen_finished has the ids of the last jobs that finished without
+        # having been seen submitted, as the job events can be sampled out or
+        # logged out of order, so that their submission is ignored if it
+        # comes later
+        return dict(start_date=start_date, pools=dict(), job_names=dict(),
+                    removed_names=dict(), unseen_finished=dict())
+
+    def pool(self, queue_name, time):
+        pool = self.data['pools'].get(queue_name, None)
+        if pool is None:
+            pool = self.data['pools'][queue_name] = dict(
+                creation_date=time,
+                executing=dict(),
+                executed=0,
+                errors=0,
+                missed=0,
+                duration=0.0,
+                max_duration=0.0)
+        return pool
+
+    def process(self, line):
+        '''
+        Processes a line of the activity log. Returns its time.
+        '''
+        entry = json.loads(line)
+        time = entry['time']
+        action = entry['activity']
+        action_name = action['action']
+        queue_name = action.get('queue', None)
+        job_id = action.get('job_id', None)
+
+        if action_name == 'START':
+            if self.reset_on_start:
+                self.data = self.empty(time)
+        elif action_name in ['CREATE_QUEUE', 'SET_QUEUE_MAX']:
+            pool = self.pool(queue_name, time)
+            if 'max' in action:
+                pool['max'] = action['max']
+        elif action_name == 'EVENT_JOB_ADDED':
+            self.data['job_names'][job_id] = action.get('func_name', None)
+        elif action_name == 'EVENT_JOB_REMOVED':
+            if job_id in self.data['job_names']:
+                self.data['removed_names'][job_id] =\
+                    self.data['job_names'].pop(job_id)
+        elif action_name in ['EVENT_JOB_SUBMITTED', 'EVENT_JOB_LAUNCHING']:
+            func_name = self.data['job_names'].get(job_id, None) or\
+                self.data['removed_names'].pop(job_id, None) or\
+                action.get('func_name', None)
+            unseen_finished = self.data.setdefault('unseen_finished', dict())
+            if job_id is not None and job_id in unseen_finished:
+                # it already finished
+                del unseen_finished[job_id]
+                self.data['job_names'].pop(job_id, None)
+                return time
+            self.pool(queue_name, time)['executing'][job_id or func_name] =\
+                dict(func_name=func_name, launch_time=time)
+        elif action_name in ['EVENT_JOB_EXECUTED', 'EVENT_JOB_ERROR',
+                             'EVENT_JOB_MISSED']:
+            # the job is not going to be submitted again
+            self.data['job_names'].pop(job_id, None)
+            self.data['removed_names'].pop(job_id, None)
+
+            pool = self.pool(queue_name, time)
+            job = pool['executing'].pop(job_id or action.get('func_name'), None)
+            if job is None and action_name != 'EVENT_JOB_MISSED':
+                # the job was never seen submitted, so it's ignored
+                if job_id is not None:
+                    unseen_finished = self.data.setdefault('unseen_finished',
+                                                           dict())
+                    unseen_finished[job_id] = time
+                    if len(unseen_finished) > self.max_unseen_finished:
+                        del unseen_finished[next(iter(unseen_finished))]
+                return time
+            if action_name == 'EVENT_JOB_EXECUTED':
+                pool['executed'] += 1
+            elif action_name == 'EVENT_JOB_ERROR':
+                pool['errors'] += 1
+            else:
+                pool['missed'] += 1
+            if job is not None:
+                duration = (
+                    datetime.datetime.strptime(time, ACTIVITY_TIME_FORMAT) -
+                    datetime.datetime.strptime(job['launch_time'],
+                                               ACTIVITY_TIME_FORMAT)
+                ).total_seconds()
+                pool['duration'] += duration
+                pool['max_duration'] = max(pool['max_duration'], duration)
+        return time
+
+    def summary(self):
+        '''
+        Returns the state to be shown by show_activity
+        '''
+        pools = dict()
+        for queue_name, pool in self.data['pools'].items():
+            pool = dict(pool)
+            pool['executing'] = sorted(pool['executing'].values(),
+                                       key=lambda job: job['launch_time'])
+            finished = pool['executed'] + pool['errors']
+            duration = pool.pop('duration')
+            pool['avg_duration'] = duration / finished if finished else 0.0
+            pools[queue_name] = pool
+        return dict(start_date=self.data['start_date'], pools=pools)
+
+
+def read_activity(activity_f, state, index=None):
+    '''
+    Processes the complete lines of the activity log from the current
+    position of activity_f. If index is given, the offset of the first line of
+    each minute is appended to it. Returns the offset after the last line
+    processed.
+    '''
+    offset = activity_f.tell()
+    for line in activity_f:
+        if not line.endswith(b'\n'):
+            # the line is still being written
+            break
+        time = state.process(line.decode('utf-8'))
+        if index is not None and (not index or index[-1][0] != time[:16]):
+            index.append([time[:16], offset])
+        offset += len(line)
+    return offset
+
+
+def rotated_activity_log(activity_path):
+    '''
+    Returns the path of the last rotated segment of the activity log, if any
+    '''
+    segments = [
+        path
+        for path in glob.glob(activity_path + ".*")
+        if not path.endswith(ACTIVITY_CHECKPOINT)
+    ]
+    return max(segments, key=os.path.getmtime) if segments else None
+
+
 def show_activity(args):
+    '''
+    Shows the state of the queues from the activity log of the schedulers.
+
+    The log is not replayed every time: the aggregated state and the offset
+    of the last line processed are stored in a checkpoint, and only the new
+    lines are processed. When the log was rotated, the rest of the rotated
+    segment is processed first (if the log was rotated more than once since
+    the last call, the segments in between are not accounted).
+
+    With --since, the number of jobs executed, failed and missed and their
+    duration are only those since the given time, using the index of the
+    offsets of each minute in the checkpoint. Only the current segment of the
+    log is taken into account then.
+    '''
     from .app import app
     root_path = app.config.get('ROOT_PATH', "")
     activity_path = os.path.join(root_path, "activity.json.log")
-    data = dict(
-      start_date=None,
-      pools=dict()
-    )
-    with codecs.open(activity_path, encoding='utf-8', mode='r') as activity_f:
-        for line in activity_f:
-            action = json.loads(line)
-            action_name = action['activity']['action']
-            if action_name == 'START':
-                data = dict(
-                    start_date=action['time'],
-                    pools=dict()
-                )
-            elif action_name == 'CREATE_QUEUE':
-                queue_name = action['activity']['queue']
-                if queue_name in data['pools']:
-                    continue
-                data['pools'][queue_name] = dict(
-                    creation_date=action['time'],
-                    executing=[],
-                    errors=0)
-            elif action_name == 'SET_QUEUE_MAX':
-                queue_name = action['activity']['queue']
-                if queue_name not in data['pools']:
-                    data['pools'][queue_name] = dict(
-                        creation_date=action['time'],
-                        executing=[],
-                        errors=0)
-                data['pools'][queue_name]['max'] = action['activity']['max']
-            elif action_name == 'EVENT_JOB_LAUNCHING':
-                queue_name = action['activity']['queue']
-                task = dict(
-                    func_name=action['activity']['func_name'],
-                    launch_time=action['time']
-                )
-                if queue_name not in data['pools']:
-                    print("error, launching event in an inexistant queue? queue '%s'" % queue_name)
-                    continue
-                data['pools'][queue_name]['executing'].append(task)
-            elif action_name == 'EVENT_JOB_ERROR':
-                queue_name = action['activity']['queue']
-                func_name=action['activity']['func_name']
-                found = False
-                if queue_name not in data['pools']:
-                    print("error, error of an event in an inexistant queue? queue '%s'" % queue_name)
-                    continue
-                for task in data['pools'][queue_name]['executing']:
-                    if task['func_name'] == func_name:
-                        data['pools'][queue_name]['executing'].remove(task)
-                        found = True
-                        break
-                if not found:
-                    print("error,r error of an unregistered event in queue '%s'" % queue_name)
-                ['pools'][queue_name]['errors'] += 1
-            elif action_name == 'EVENT_JOB_EXECUTED':
-                queue_name = action['activity']['queue']
-                func_name=action['activity']['func_name']
-                found = False
-                if queue_name not in data['pools']:
-                    print("error, error of an event in an inexistant queue? queue '%s'" % queue_name)
-                    continue
-                for task in data['pools'][queue_name]['executing']:
-                    if task['func_name'] == func_name:
-                        data['pools'][queue_name]['executing'].remove(task)
-                        found = True
-                        break
-                if not found:
-                    print("error, finished an unregistered event in queue '%s'" % queue_name)
-
-    print(json.dumps(data, indent=4, sort_keys=True, ensure_ascii=False))
+    checkpoint_path = os.path.join(root_path, ACTIVITY_CHECKPOINT)
+
+    since = None
+    if args.since:
+        try:
+            since = parse_since(args.since)
+        except ValueError as e:
+            print(str(e))
+            return
+
+    try:
+        stat = os.stat(activity_path)
+        with open(activity_path, 'rb') as activity_f:
+            head = activity_f.readline().decode('utf-8')
+    except OSError:
+        print("activity log %s not found" % activity_path)
+        return
+
+    try:
+        with open(checkpoint_path, 'r') as checkpoint_f:
+            checkpoint = json.load(checkpoint_f)
+    except (IOError, ValueError):
+        checkpoint = dict(inode=stat.st_ino, head=head, offset=0, data=None,
+                          index=[])
+
+    # the log was rotated if it's another file, or it starts differently
+    state = ActivityState(checkpoint['data'])
+    if checkpoint['inode'] != stat.st_ino or stat.st_size < checkpoint['offset']\
+            or (checkpoint['offset'] and checkpoint['head'] != head):
+        rotated_path = rotated_activity_log(activity_path)
+        if rotated_path and checkpoint['offset']:
+            opener = gzip.open if rotated_path.endswith('.gz') else open
+            with opener(rotated_path, 'rb') as rotated_f:
+                rotated_f.seek(checkpoint['offset'])
+                read_activity(rotated_f, state)
+        checkpoint.update(inode=stat.st_ino, head=head, offset=0, index=[])
+
+    with open(activity_path, 'rb') as activity_f:
+        activity_f.seek(checkpoint['offset'])
+        checkpoint['offset'] = read_activity(activity_f, state,
+                                             checkpoint['index'])
+
+        checkpoint['data'] = state.data
+        checkpoint['head'] = head
+        tmp_path = checkpoint_path + ".tmp"
+        with open(tmp_path, 'w') as checkpoint_f:
+            json.dump(checkpoint, checkpoint_f)
+        os.replace(tmp_path, checkpoint_path)
+
+        summary = state.summary()
+        if since is not None:
+            # count again from the first minute of the window
+            starts = [offset for minute, offset in checkpoint['index']
+                      if minute <= since[:16]]
+            offset = starts[-1] if starts else 0
+            activity_f.seek(offset)
+            window = ActivityState(reset_on_start=False)
+            for line in activity_f:
+                offset += len(line)
+                if offset > checkpoint['offset']:
+                    break
+                # lines start with '{"time": "<time>"', see ActivityFormatter
+                if line[10:33].decode('utf-8') >= since:
+                    window.process(line.decode('utf-8'))
+            summary['since'] = since
+            window_pools = window.summary()['pools']
+            for queue_name, pool in summary['pools'].items():
+                window_pool = window_pools.get(queue_name, dict())
+                for key in ['executed', 'errors', 'missed', 'avg_duration',
+                            'max_duration']:
+                    pool[key] = window_pool.get(key, 0)
+
+    print(json.dumps(summary, indent=4, sort_keys=True, ensure_ascii=False))
 
 
 def show_message(args):
@@ -320,8 +846,48 @@ def finish_task(args):
         print("task %s is not external" % task_id)
         return
 
+    # the message must reach the server process, which is not this one, so
+    # it's sent through HTTP and delivered right now
+    from .app import app
+    from .outbox import deliver_message
+    app.config['LOCAL_MESSAGES_SHORTCUT'] = False
+
     task = ExternalTask.instance_by_id(task_model.id)
-    task.finish(data=finish_data)
+    msg = task.finish(data=finish_data)
+    deliver_message(msg.id)
+
+
+def set_queue_max(args):
+    '''
+    Changes the number of threads of a queue of the running server, which is
+    not this process, through its API
+    '''
+    from .app import app
+    from .peers import PeerSessions
+    import requests
+
+    queue_name = str(args.set_queue_max[0])
+    try:
+        max_threads = int(args.set_queue_max[1])
+    except ValueError:
+        print("invalid number of threads: %s" % args.set_queue_max[1])
+        return
+
+    root_url = app.config.get('ROOT_URL')
+    url = "%s/%s/max/" % (root_url, queue_name)
+    try:
+        with PeerSessions.session(root_url) as session:
+            r = session.request('post', url,
+                                data=dumps(dict(max_threads=max_threads)))
+    except requests.exceptions.RequestException as e:
+        print("error connecting to the server: %s" % str(e))
+        return
+
+    if r.status_code >= 400:
+        print("error changing the threads of queue %s: %s" % (
+            queue_name, r.text))
+        return
+    print("queue %s has now max_threads = %d" % (queue_name, max_threads))
 
 
 def deny_task(args):
@@ -37,6 +37,12 @@ setup(
         'enum34==1.1.6',
         'ipaddress==1.0.22',
     ],
+    extras_require={
+        # faster json encoding and decoding, see utils.JSON_CODECS
+        'orjson': ['orjson>=3.6'],
+        # messages in msgpack, see WIRE_FORMAT in app.py
+        'msgpack': ['msgpack>=1.0'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "OSI Approved :: GNU Affero General Public License v3"